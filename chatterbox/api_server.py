@@ -117,6 +117,11 @@ except ImportError as e:
         print("❌ Critical dependency missing - cannot start server")
         sys.exit(1)
 
+from chatterbox.mtl_tts import Conditionals
+from chatterbox.voice_store import VoiceConditioningStore, content_hash, CONDS_ARTIFACT_VERSION
+from chatterbox.asset_cache import ReferenceAssetCache
+from chatterbox.models.t3.inference.cfg_schedule import CFGSchedule
+
 # Load environment variables from .env file
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(env_path)
@@ -153,6 +158,10 @@ CORS(app, resources={
 MODEL_POOL = None
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 MODEL_POOL_SIZE = int(os.getenv('MODEL_POOL_SIZE', 3))  # 3 concurrent requests
+MODEL_POOL_SHARED_WEIGHTS = os.getenv('MODEL_POOL_SHARED_WEIGHTS', 'false').lower() == 'true'  # opt-in: one copy of the weights for all workers (S3Gen and the watermarker are then shared across threads)
+T3_MAX_BATCH_SIZE = int(os.getenv('T3_MAX_BATCH_SIZE', 0))  # >0: decode concurrent requests in one batch (needs shared weights)
+T3_CFG_SCHEDULE = CFGSchedule.parse(os.getenv('T3_CFG_SCHEDULE', 'always'))  # eg. "first:50": CFG only for the first 50 tokens
+S3GEN_BACKEND = os.getenv('S3GEN_BACKEND', 'cfm')  # "meanflow": 2-step token-to-wav decoder of Chatterbox-Turbo
 MAX_QUEUE_DEPTH = int(os.getenv('MAX_QUEUE_DEPTH', 3))  # Max 3 waiting (can complete within timeout)
 REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', 30))  # 30s timeout allows queue + generation time
 
@@ -163,28 +172,56 @@ class TTSModelPool:
     Each model instance can only handle one request at a time (not thread-safe),
     but multiple instances allow concurrent processing up to pool_size.
     Implements queue depth limiting to prevent overload.
+    
+    With shared_weights=True the weights are loaded once and every pool entry is a
+    `fork()` of that model (own sampling state, shared T3/S3Gen/VE modules), so memory
+    and startup time no longer grow with the pool size. Requires `generate(conds=...)`.
+    With max_batch_size > 0 the workers also share a T3 batch scheduler, so concurrent
+    requests are decoded in one batch instead of side by side.
     """
     
-    def __init__(self, model_count=3, max_queue_depth=6):
+    def __init__(self, model_count=3, max_queue_depth=6, shared_weights=False, max_batch_size=0):
         self.models = Queue(maxsize=model_count)
         self.model_count = model_count
         self.device = DEVICE
         self.max_queue_depth = max_queue_depth
+        self.shared_weights = shared_weights
         self.waiting_count = 0
         self.waiting_lock = threading.Lock()
-        logger.info(f"Initializing TTS model pool with {model_count} instances (max queue: {max_queue_depth})...")
+        logger.info(f"Initializing TTS model pool with {model_count} instances (max queue: {max_queue_depth}, shared weights: {shared_weights})...")
         
-        # Load multiple model instances
-        for i in range(model_count):
+        if shared_weights:
             try:
-                logger.info(f"Loading model instance {i+1}/{model_count} on {self.device}...")
-                model = ChatterboxMultilingualTTS.from_pretrained(self.device)
-                self.models.put(model)
-                logger.info(f"✅ Model instance {i+1} loaded successfully")
+                logger.info(f"Loading shared model weights on {self.device}...")
+                base_model = ChatterboxMultilingualTTS.from_pretrained(
+                    self.device, s3gen_backend=S3GEN_BACKEND, asset_cache=REFERENCE_ASSET_CACHE,
+                )
             except Exception as e:
-                logger.error(f"❌ Failed to load model instance {i+1}: {e}")
+                logger.error(f"❌ Failed to load shared model: {e}")
                 traceback.print_exc()
                 raise
+            if max_batch_size > 0:
+                base_model.enable_batching(max_batch_size=max_batch_size)
+                logger.info(f"✅ T3 batch scheduler enabled (max batch: {max_batch_size})")
+            for i in range(model_count):
+                self.models.put(base_model.fork())
+            logger.info(f"✅ Created {model_count} workers over one set of weights")
+        else:
+            if max_batch_size > 0:
+                logger.warning("T3 batching requires shared weights, ignoring T3_MAX_BATCH_SIZE")
+            # Load multiple model instances
+            for i in range(model_count):
+                try:
+                    logger.info(f"Loading model instance {i+1}/{model_count} on {self.device}...")
+                    model = ChatterboxMultilingualTTS.from_pretrained(
+                        self.device, s3gen_backend=S3GEN_BACKEND, asset_cache=REFERENCE_ASSET_CACHE,
+                    )
+                    self.models.put(model)
+                    logger.info(f"✅ Model instance {i+1} loaded successfully")
+                except Exception as e:
+                    logger.error(f"❌ Failed to load model instance {i+1}: {e}")
+                    traceback.print_exc()
+                    raise
         
         logger.info(f"🎯 Model pool ready: {model_count} instances, {self.available_count()} available")
     
@@ -232,6 +269,7 @@ class TTSModelPool:
                 "busy": self.model_count - self.available_count(),
                 "waiting": self.waiting_count,
                 "pool_size": self.model_count,
+                "shared_weights": self.shared_weights,
                 "max_queue_depth": self.max_queue_depth
             }
     
@@ -267,6 +305,29 @@ if S3_ENABLED and S3_BUCKET:
         logger.warning(f"Failed to initialize S3: {e}")
         S3_ENABLED = False
 
+# Voice conditionals cache: reference clips are embedded once per voice and reused across requests
+VOICE_CONDS_DIR = os.getenv('VOICE_CONDS_DIR', str(Path(__file__).parent.parent / 'voice_conds'))
+VOICE_CONDS_CACHE_SIZE = int(os.getenv('VOICE_CONDS_CACHE_SIZE', 32))
+VOICE_CONDS_STORE = VoiceConditioningStore(
+    cache_dir=VOICE_CONDS_DIR,
+    max_entries=VOICE_CONDS_CACHE_SIZE,
+    device=DEVICE,
+)
+# Content hash each voice's conditionals were last keyed by (see `reload_voices_and_characters`)
+VOICE_CONTENT_HASHES = {}
+# Voice conditionals are computed at upload and shipped next to the audio (in S3 when enabled, else in this
+# directory), so that servers load them at startup instead of embedding the reference clips
+VOICE_ARTIFACTS_DIR = os.getenv('VOICE_ARTIFACTS_DIR', str(Path(__file__).parent.parent / 'audio_samples'))
+
+# Remote reference clips and artifacts are downloaded once, then only revalidated (ETag / Last-Modified)
+REFERENCE_ASSET_DIR = os.getenv('REFERENCE_ASSET_DIR', str(Path(__file__).parent.parent / 'reference_assets'))
+REFERENCE_ASSET_REVALIDATE_AFTER = float(os.getenv('REFERENCE_ASSET_REVALIDATE_AFTER', 300))  # seconds
+REFERENCE_ASSET_CACHE = ReferenceAssetCache(
+    cache_dir=REFERENCE_ASSET_DIR,
+    revalidate_after=REFERENCE_ASSET_REVALIDATE_AFTER,
+    max_pool_connections=max(MODEL_POOL_SIZE, 10),
+)
+
 # Audio cache for repeated requests (helps with OpenRouter retries)
 AUDIO_CACHE = {} if CACHE_ENABLED else None
 MAX_CACHE_SIZE = int(os.getenv('MAX_CACHE_SIZE', 200))  # Increased for longer TTL
@@ -366,7 +427,12 @@ def get_or_load_model_pool():
     if MODEL_POOL is None:
         logger.info(f"Initializing TTS model pool (size={MODEL_POOL_SIZE}, max_queue={MAX_QUEUE_DEPTH}) on device: {DEVICE}")
         try:
-            MODEL_POOL = TTSModelPool(model_count=MODEL_POOL_SIZE, max_queue_depth=MAX_QUEUE_DEPTH)
+            MODEL_POOL = TTSModelPool(
+                model_count=MODEL_POOL_SIZE,
+                max_queue_depth=MAX_QUEUE_DEPTH,
+                shared_weights=MODEL_POOL_SHARED_WEIGHTS,
+                max_batch_size=T3_MAX_BATCH_SIZE,
+            )
             # Get one model to check properties
             sample_model = MODEL_POOL.get_model()
             logger.info(f"Model pool ready. Device: {sample_model.device}, Sample rate: {sample_model.sr}Hz")
@@ -444,6 +510,143 @@ def cache_audio(text: str, character_id: str, audio_bytes: bytes, sample_rate: i
     logger.debug(f"Cached audio: {cache_key} (TTL: {CACHE_TTL}s)")
 
 
+def voice_content_hash(voice: Dict[str, Any]) -> str:
+    """
+    Content hash of a voice's audio. Remote clips are hashed by their bytes, as downloaded (then only revalidated)
+    by `REFERENCE_ASSET_CACHE`, so a clip replaced at the same URL gets new conditionals. If the clip cannot be
+    fetched, the hash recorded at upload, or else that of the URL, is used.
+    """
+    try:
+        return content_hash(voice["audio_url"], asset_cache=REFERENCE_ASSET_CACHE)
+    except Exception as e:
+        logger.warning(f"Could not hash the audio of {voice['audio_url']}: {e}")
+        return voice.get("content_hash") or content_hash(voice["audio_url"])
+
+
+def track_voice_content_hash(voice_id: str) -> str:
+    """Content hash of a voice's audio, recorded in `VOICE_CONTENT_HASHES` so a reload can tell if it changed."""
+    chash = voice_content_hash(VOICE_LIBRARY[voice_id])
+    VOICE_CONTENT_HASHES[voice_id] = chash
+    return chash
+
+
+def known_voice_content_hash(voice_id: str) -> str:
+    """
+    Content hash of a voice's audio on the request path: the one last computed by a reload or warm-up, else the one
+    recorded at upload. The clip itself is only hashed (fetching it if remote) when neither exists, once.
+    """
+    chash = VOICE_CONTENT_HASHES.get(voice_id)
+    if chash is None:
+        chash = VOICE_LIBRARY[voice_id].get("content_hash")
+        if chash is None:
+            return track_voice_content_hash(voice_id)
+        VOICE_CONTENT_HASHES[voice_id] = chash
+    return chash
+
+
+def ship_voice_conditionals(voice_id: str, chash: str, conds: Conditionals) -> str:
+    """
+    Publishes the conditionals of a voice next to its audio: to S3 when enabled, else to `VOICE_ARTIFACTS_DIR`.
+    Returns the URL (or local path) to record as its `conds_url`.
+    """
+    artifact_name = VoiceConditioningStore.artifact_name(voice_id, chash)
+
+    if S3_ENABLED and S3_CLIENT:
+        s3_key = f"{S3_VOICES_PREFIX}conds/{artifact_name}"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = Path(tmp_dir) / artifact_name
+            conds.save(tmp_path)
+            with open(tmp_path, 'rb') as f:
+                S3_CLIENT.put_object(
+                    Bucket=S3_BUCKET,
+                    Key=s3_key,
+                    Body=f.read(),
+                    ContentType="application/octet-stream"
+                )
+        conds_url = f"https://{S3_BUCKET}.s3.{S3_REGION}.amazonaws.com/{s3_key}"
+    else:
+        local_dir = Path(VOICE_ARTIFACTS_DIR)
+        local_dir.mkdir(parents=True, exist_ok=True)
+        conds_url = str(local_dir / artifact_name)
+        # write-then-rename so a server loading it never sees a partial file
+        fd, tmp_name = tempfile.mkstemp(dir=local_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            conds.save(tmp_name)
+            os.replace(tmp_name, conds_url)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+
+    logger.info(f"Shipped conditionals of voice '{voice_id}': {conds_url}")
+    return conds_url
+
+
+def fetch_voice_conditionals(voice_id: str, chash: str) -> Optional[Conditionals]:
+    """
+    Loads the shipped conditionals of a voice whose audio has content hash `chash`. Returns None if the voice has
+    no artifact, if it was built for another `CONDS_ARTIFACT_VERSION` or for other audio, or if it cannot be fetched.
+    """
+    voice = VOICE_LIBRARY[voice_id]
+    conds_url = voice.get("conds_url")
+    if not conds_url or voice.get("conds_version") != CONDS_ARTIFACT_VERSION or voice.get("content_hash") != chash:
+        return None
+
+    try:
+        path = REFERENCE_ASSET_CACHE.fetch(conds_url) if ReferenceAssetCache.is_remote(conds_url) else conds_url
+        conds = Conditionals.load(path, map_location="cpu")
+    except Exception as e:
+        logger.warning(f"Could not load conditionals of voice '{voice_id}' from {conds_url}: {e}")
+        return None
+
+    return conds.to(VOICE_CONDS_STORE.device)
+
+
+def warm_voice_conditionals(voice_ids=None):
+    """
+    Loads the shipped conditionals of `voice_ids` (default: every voice) that are not cached yet, so that no
+    reference clip is embedded on the request path. Voices without artifacts are built on first use.
+    NOTE: remote clips are still fetched (once, then revalidated) to key their conditionals by content.
+    """
+    voice_ids = list(VOICE_LIBRARY) if voice_ids is None else voice_ids
+    loaded = 0
+    for voice_id in voice_ids:
+        voice = VOICE_LIBRARY.get(voice_id)
+        if voice is None or not voice.get("conds_url"):
+            continue
+        chash = track_voice_content_hash(voice_id)
+        if VOICE_CONDS_STORE.get(voice_id, chash) is not None:
+            loaded += 1
+            continue
+        conds = fetch_voice_conditionals(voice_id, chash)
+        if conds is not None:
+            VOICE_CONDS_STORE.put(voice_id, chash, conds)
+            loaded += 1
+    logger.info(f"Voice conditionals ready for {loaded}/{len(voice_ids)} voices")
+
+
+def get_voice_conditionals(model, voice_id: str, exaggeration: float):
+    """
+    Get the cached conditionals for a voice. On a miss they are loaded from the voice's shipped artifact, or else
+    embedded from its reference clip with `model`.
+    """
+    voice = VOICE_LIBRARY[voice_id]
+    chash = known_voice_content_hash(voice_id)
+
+    def build():
+        conds = fetch_voice_conditionals(voice_id, chash)
+        if conds is None:
+            conds = model.get_conditionals(voice["audio_url"], exaggeration=exaggeration)
+        return conds
+
+    return VOICE_CONDS_STORE.get_or_create(
+        voice_id,
+        chash,
+        build_fn=build,
+        exaggeration=exaggeration,
+    )
+
+
 def generate_audio_bytes(text: str, character_id: str = "andrew_tate", voice_id: Optional[str] = None, max_tokens: int = 400, use_cache: bool = True) -> Tuple[bytes, int, float]:
     """
     Generate audio from text using a character voice profile.
@@ -479,7 +682,6 @@ def generate_audio_bytes(text: str, character_id: str = "andrew_tate", voice_id:
         if actual_voice_id not in VOICE_LIBRARY:
             raise ValueError(f"Unknown voice: {actual_voice_id}. Available: {list(VOICE_LIBRARY.keys())}")
         
-        voice = VOICE_LIBRARY[actual_voice_id]
         language = character["language"]
         
         logger.info(f"Generating audio for character '{character_id}' with voice '{actual_voice_id}': {text[:100]}...")
@@ -488,13 +690,17 @@ def generate_audio_bytes(text: str, character_id: str = "andrew_tate", voice_id:
         # Timeout ensures request doesn't hang indefinitely if pool is overloaded
         acquired_model = model_pool.get_model(timeout=REQUEST_TIMEOUT)
         try:
+            conds = get_voice_conditionals(
+                acquired_model, actual_voice_id, character["exaggeration"]
+            )
             wav = acquired_model.generate(
                 text=text[:MAX_TEXT_LENGTH],
                 language_id=language,
-                audio_prompt_path=voice["audio_url"],
+                conds=conds,
                 exaggeration=character["exaggeration"],
                 temperature=character["temperature"],
                 cfg_weight=character["cfg_weight"],
+                cfg_schedule=T3_CFG_SCHEDULE,
                 max_new_tokens=max_tokens,
             )
             # Store sample rate before returning model
@@ -581,12 +787,71 @@ def reload_voices_and_characters():
     
     config, _ = load_config_file()
     if 'voices' in config:
+        # the hashes the conditionals were last keyed by: the audio itself may already have changed on disk
+        old_hashes = dict(VOICE_CONTENT_HASHES)
         VOICE_LIBRARY.update(config['voices'])
+        # only the conditionals of voices whose audio changed are stale
+        changed = [
+            voice_id for voice_id in config['voices']
+            if old_hashes.get(voice_id) != track_voice_content_hash(voice_id)
+        ]
+        for voice_id in changed:
+            if voice_id in old_hashes:
+                VOICE_CONDS_STORE.invalidate(voice_id)
+        if changed:
+            logger.info(f"Voices added or changed: {changed}")
+            warm_voice_conditionals(changed)
     if 'characters' in config:
         CHARACTER_VOICES.update(config['characters'])
     
     logger.info(f"Reloaded {len(VOICE_LIBRARY)} voices and {len(CHARACTER_VOICES)} characters")
 
+def precompute_voice_conditionals(file_data, filename, voice_id, chash):
+    """
+    Embeds an uploaded clip in a background thread with a pooled model, then persists its conditionals in
+    `VOICE_CONDS_STORE`, ships them and records their `conds_url` in the voice config. Skipped if the model pool
+    is not loaded (an upload never loads it): the conditionals are then built on first use.
+    Returns the thread, or None if skipped.
+    """
+    pool = MODEL_POOL
+    if pool is None:
+        logger.info(f"Model pool not loaded, the conditionals of voice '{voice_id}' will be built on first use")
+        return None
+
+    def run():
+        try:
+            model = pool.get_model(timeout=REQUEST_TIMEOUT)
+            try:
+                with tempfile.NamedTemporaryFile(suffix=Path(secure_filename(filename)).suffix or ".wav") as tmp:
+                    tmp.write(file_data)
+                    tmp.flush()
+                    conds = model.get_conditionals(tmp.name)
+            finally:
+                pool.return_model(model)
+
+            VOICE_CONDS_STORE.put(voice_id, chash, conds)
+            conds_fields = {
+                "conds_url": ship_voice_conditionals(voice_id, chash, conds),
+                "conds_version": CONDS_ARTIFACT_VERSION,
+            }
+        except Exception as e:
+            logger.warning(f"Could not precompute conditionals of voice '{voice_id}', they will be built on first use: {e}")
+            return
+
+        voice = VOICE_LIBRARY.get(voice_id)
+        if voice is None or voice.get("content_hash") != chash:
+            logger.info(f"Voice '{voice_id}' was replaced or deleted, not recording its conditionals")
+            return
+        voice.update(conds_fields)
+        config, config_path = load_config_file()
+        if voice_id in config.get('voices', {}):
+            config['voices'][voice_id].update(conds_fields)
+            save_config_file(config, config_path)
+
+    thread = threading.Thread(target=run, name=f"precompute-{voice_id}", daemon=True)
+    thread.start()
+    return thread
+
 def upload_audio_to_s3(file_data, filename, voice_id):
     """Upload audio file to S3"""
     if not S3_ENABLED or not S3_CLIENT:
@@ -709,11 +974,13 @@ def admin_upload_voice():
             "audio_url": audio_url,
             "description": description or f"Custom voice: {voice_name}",
             "quality": "high",
-            "tags": [tag.strip() for tag in tags.split(',') if tag.strip()] if tags else ["custom"]
+            "tags": [tag.strip() for tag in tags.split(',') if tag.strip()] if tags else ["custom"],
+            "content_hash": content_hash(file_data)
         }
         
         # Add to in-memory config
         VOICE_LIBRARY[voice_id] = voice_config
+        VOICE_CONTENT_HASHES[voice_id] = voice_config["content_hash"]
         
         # Save to configuration file
         config, config_path = load_config_file()
@@ -722,6 +989,9 @@ def admin_upload_voice():
         config['voices'][voice_id] = voice_config
         save_config_file(config, config_path)
         
+        # Compute the conditionals once, in the background, rather than on every server on first use
+        precompute_voice_conditionals(file_data, file.filename, voice_id, voice_config["content_hash"])
+        
         logger.info(f"Added new voice: {voice_id} -> {audio_url}")
         
         return jsonify({
@@ -833,6 +1103,8 @@ def admin_delete_voice(voice_id):
         
         # Remove from memory
         del VOICE_LIBRARY[voice_id]
+        VOICE_CONDS_STORE.invalidate(voice_id)
+        VOICE_CONTENT_HASHES.pop(voice_id, None)
         
         # Remove from config file
         config, config_path = load_config_file()
@@ -1029,7 +1301,8 @@ def health():
         "available_models": MODEL_POOL.available_count() if MODEL_POOL else 0,
         "gpu": gpu_info,
         "cache_enabled": CACHE_ENABLED,
-        "cache_size": len(AUDIO_CACHE) if AUDIO_CACHE else 0
+        "cache_size": len(AUDIO_CACHE) if AUDIO_CACHE else 0,
+        "cached_voices": len(VOICE_CONDS_STORE)
     })
 
 
@@ -2635,6 +2908,7 @@ if __name__ == '__main__':
         logger.error(f"✗ Failed to load model on startup: {e}")
         logger.info("Server will attempt to load model on first request")
     
+    warm_voice_conditionals()
     logger.info(f"Loaded {len(VOICE_LIBRARY)} voices and {len(CHARACTER_VOICES)} characters")
     
     logger.info("=" * 60)
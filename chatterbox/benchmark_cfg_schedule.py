@@ -0,0 +1,95 @@
+"""
+Latency / quality comparison of CFG schedules for the multilingual model.
+
+For every schedule, each text is synthesized `--repeats` times with the same seeds, and the script reports
+the mean generation latency, real-time factor, output duration relative to always-on CFG, and how often the
+alignment analyzer saw the text through to the end without forcing an EOS. The wavs are written to `--out-dir`
+for listening tests.
+
+    python benchmark_cfg_schedule.py --voice voice.wav --schedules always first:25 first:50 until_started
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torchaudio as ta
+
+from chatterbox.mtl_tts import ChatterboxMultilingualTTS
+from chatterbox.models.t3.inference.cfg_schedule import CFGSchedule
+
+
+TEXTS = [
+    "Hey! Good to see you again, how was the trip?",
+    "I checked the logs this morning and the backup finished at three, so we should be fine.",
+    "Honestly, I did not expect the ending. I had to sit in the car for a minute before driving home.",
+    "Take the second left after the bakery, then keep going until you see the blue gate.",
+]
+
+
+def _sync(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def run_schedule(model, spec, texts, language_id, repeats, cfg_weight, out_dir):
+    schedule = CFGSchedule.parse(spec)
+    latencies, durations, clean = [], [], 0
+    for t_idx, text in enumerate(texts):
+        for r in range(repeats):
+            torch.manual_seed(1000 * t_idx + r)
+            _sync(model.device)
+            t0 = time.perf_counter()
+            wav = model.generate(text, language_id=language_id, cfg_weight=cfg_weight, cfg_schedule=schedule)
+            _sync(model.device)
+            latencies.append(time.perf_counter() - t0)
+            durations.append(wav.shape[-1] / model.sr)
+
+            analyzer = model.t3_state.analyzer
+            if analyzer is not None and bool(analyzer.complete) and not bool(analyzer.forced_eos.any()):
+                clean += 1
+            if out_dir is not None:
+                wav_t = torch.from_numpy(wav).unsqueeze(0)  # generate() returns a 1-D numpy array
+                ta.save(str(out_dir / f"{spec.replace(':', '-')}_{t_idx}_{r}.wav"), wav_t, model.sr)
+    return latencies, durations, clean
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default=None, help="reference clip (default: the built-in voice)")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--schedules", nargs="+", default=["always", "first:25", "first:50", "until_started"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--out-dir", default="cfg_schedule_samples")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxMultilingualTTS.from_pretrained(device=args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    out_dir = Path(args.out_dir) if args.out_dir else None
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    # warm-up (kernels, allocator, prefix cache)
+    model.generate(TEXTS[0], language_id=args.language, cfg_weight=args.cfg_weight)
+
+    results = {}
+    for spec in args.schedules:
+        results[spec] = run_schedule(
+            model, spec, TEXTS, args.language, args.repeats, args.cfg_weight, out_dir,
+        )
+
+    baseline = results.get("always")
+    n_runs = len(TEXTS) * args.repeats
+    print(f"\n{'schedule':<24}{'latency s':>10}{'RTF':>8}{'dur/always':>12}{'clean end':>11}")
+    for spec, (latencies, durations, clean) in results.items():
+        latency = sum(latencies) / len(latencies)
+        rtf = sum(latencies) / sum(durations)
+        rel = sum(durations) / sum(baseline[1]) if baseline is not None else float("nan")
+        print(f"{spec:<24}{latency:>10.2f}{rtf:>8.3f}{rel:>12.2f}{clean:>6}/{n_runs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Latency / quality comparison of the CFM ODE solvers of S3Gen (token-to-mel), for the non-meanflow decoder.
+
+Speech tokens are sampled once per text with T3; then, for every solver and step count, the same tokens are
+rendered to mels from the same noise, and the script reports the mean token-to-mel latency, the number of
+estimator calls, and the mean L1 distance (in log-mel) to the 10-step Euler reference. The wavs are written to
+`--out-dir` for listening tests.
+
+    python benchmark_ode_solvers.py --voice voice.wav --configs euler:10 euler:6 heun:3 midpoint:3 multistep:5
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torchaudio as ta
+
+from chatterbox.tts import ChatterboxTTS
+from chatterbox.models.s3tokenizer import drop_invalid_tokens
+from chatterbox.models.s3gen.utils.ode_solvers import ODE_SOLVERS
+
+
+REFERENCE = "euler:10"
+
+TEXTS = [
+    "Hey! Good to see you again, how was the trip?",
+    "I checked the logs this morning and the backup finished at three, so we should be fine.",
+    "Honestly, I did not expect the ending. I had to sit in the car for a minute before driving home.",
+    "Take the second left after the bakery, then keep going until you see the blue gate.",
+]
+
+
+def _sync(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def sample_tokens(model, text, seed):
+    torch.manual_seed(seed)
+    conds, t3_cond, text_tokens = model._prepare_inputs(text, None, 0.5, 0.5, None)
+    with torch.inference_mode():
+        speech_tokens = model.t3.inference(
+            t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=1000, cfg_weight=0.5, state=model.t3_state,
+        )
+    speech_tokens = drop_invalid_tokens(speech_tokens[0])
+    return speech_tokens[speech_tokens < 6561].to(model.device), conds.gen
+
+
+def run_config(model, config, tokens, repeats, out_dir):
+    solver, n_steps = config.split(":")
+    s3gen = model.s3gen
+    s3gen.set_ode_solver(solver)
+    mels, latencies = [], []
+    for t_idx, (speech_tokens, ref_dict) in enumerate(tokens):
+        for r in range(repeats):
+            # the CFM noise is the first random draw of the solve
+            torch.manual_seed(t_idx)
+            _sync(model.device)
+            t0 = time.perf_counter()
+            mel = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, n_cfm_timesteps=int(n_steps), finalize=True)
+            _sync(model.device)
+            latencies.append(time.perf_counter() - t0)
+        mels.append(mel)
+        if out_dir is not None:
+            wav, _ = s3gen.hift_inference(mel.to(dtype=s3gen.dtype))
+            ta.save(str(out_dir / f"{config.replace(':', '-')}_{t_idx}.wav"), wav.cpu(), model.sr)
+    return mels, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default=None, help="reference clip (default: the built-in voice)")
+    parser.add_argument(
+        "--configs", nargs="+", default=["euler:10", "euler:6", "midpoint:3", "heun:3", "multistep:5", "multistep:4"],
+        help=f"<solver>:<n_steps>, solver in {list(ODE_SOLVERS)}",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--out-dir", default="ode_solver_samples")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    out_dir = Path(args.out_dir) if args.out_dir else None
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    tokens = [sample_tokens(model, text, seed) for seed, text in enumerate(TEXTS)]
+
+    # warm-up (kernels, allocator)
+    model.s3gen.flow_inference(tokens[0][0], ref_dict=tokens[0][1], finalize=True)
+
+    results = {}
+    for config in dict.fromkeys([REFERENCE, *args.configs]):
+        results[config] = run_config(model, config, tokens, args.repeats, out_dir)
+    model.s3gen.set_ode_solver("euler")
+
+    ref_mels = results[REFERENCE][0]
+    print(f"\n{'solver:steps':<16}{'calls':>7}{'latency s':>11}{'L1 to ref':>11}")
+    for config, (mels, latencies) in results.items():
+        solver, n_steps = config.split(":")
+        calls = ODE_SOLVERS[solver].evals_per_step * int(n_steps)
+        latency = sum(latencies) / len(latencies)
+        dist = sum((m - ref).abs().mean().item() for m, ref in zip(mels, ref_mels)) / len(mels)
+        print(f"{config:<16}{calls:>7}{latency:>11.3f}{dist:>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Latency / quality comparison of the S3Gen backends ("cfm": the model's 10-step decoder, "meanflow": the 2-step
+decoder of Chatterbox-Turbo) for the English or multilingual model.
+
+Speech tokens are sampled once per text with T3, then rendered by each backend from the same ref dict. The script
+reports the mean token-to-wav latency, real-time factor, and speaker similarity (cosine of voice-encoder
+embeddings) between the output and the reference voice. The wavs are written to `--out-dir` for listening tests.
+
+    python benchmark_s3gen_backends.py --model mtl --language fr --voice voice.wav
+"""
+import argparse
+import time
+from pathlib import Path
+
+import librosa
+import torch
+import torchaudio as ta
+
+from chatterbox.tts import ChatterboxTTS
+from chatterbox.mtl_tts import ChatterboxMultilingualTTS
+from chatterbox.models.s3tokenizer import S3_SR, drop_invalid_tokens
+from chatterbox.models.s3gen import S3GEN_SR, load_meanflow_s3gen
+
+
+TEXTS = {
+    "en": [
+        "Hey! Good to see you again, how was the trip?",
+        "I checked the logs this morning and the backup finished at three, so we should be fine.",
+        "Take the second left after the bakery, then keep going until you see the blue gate.",
+    ],
+    "fr": [
+        "Salut ! Content de te revoir, le voyage s'est bien passé ?",
+        "J'ai vérifié les journaux ce matin, la sauvegarde s'est terminée à trois heures.",
+        "Prends la deuxième à gauche après la boulangerie, puis continue jusqu'au portail bleu.",
+    ],
+    "de": [
+        "Hallo! Schön, dich wiederzusehen, wie war die Reise?",
+        "Ich habe heute Morgen die Protokolle geprüft, die Sicherung war um drei fertig.",
+        "Nimm die zweite links nach der Bäckerei und fahr weiter bis zum blauen Tor.",
+    ],
+}
+
+
+def _sync(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def sample_tokens(model, text, language_id, seed):
+    torch.manual_seed(seed)
+    if isinstance(model, ChatterboxMultilingualTTS):
+        conds, t3_cond, text_tokens = model._prepare_inputs(text, language_id, None, 0.5, None)
+    else:
+        conds, t3_cond, text_tokens = model._prepare_inputs(text, None, 0.5, 0.5, None)
+    with torch.inference_mode():
+        speech_tokens = model.t3.inference(
+            t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=1000, cfg_weight=0.5, state=model.t3_state,
+        )
+    speech_tokens = drop_invalid_tokens(speech_tokens[0])
+    return speech_tokens[speech_tokens < 6561].to(model.device), conds
+
+
+def speaker_similarity(model, wav, conds):
+    wav_16k = librosa.resample(wav.squeeze(0).cpu().numpy(), orig_sr=S3GEN_SR, target_sr=S3_SR)
+    emb = torch.from_numpy(model.ve.embeds_from_wavs([wav_16k], sample_rate=S3_SR)).to(model.device)
+    ref = conds.t3.speaker_emb.to(model.device)
+    return torch.nn.functional.cosine_similarity(emb, ref).item()
+
+
+def run_backend(model, name, s3gen, tokens, repeats, out_dir):
+    latencies, durations, similarities = [], [], []
+    for t_idx, (speech_tokens, conds) in enumerate(tokens):
+        for r in range(repeats):
+            torch.manual_seed(1000 * t_idx + r)
+            _sync(model.device)
+            t0 = time.perf_counter()
+            wav, _ = s3gen.inference(speech_tokens=speech_tokens, ref_dict=conds.gen)
+            _sync(model.device)
+            latencies.append(time.perf_counter() - t0)
+            durations.append(wav.shape[-1] / S3GEN_SR)
+        similarities.append(speaker_similarity(model, wav, conds))
+        if out_dir is not None:
+            ta.save(str(out_dir / f"{name}_{t_idx}.wav"), wav.cpu(), S3GEN_SR)
+    return latencies, durations, similarities
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=["en", "mtl"], default="mtl")
+    parser.add_argument("--language", default="en", choices=list(TEXTS), help="texts to use (mtl only)")
+    parser.add_argument("--voice", default=None, help="reference clip (default: the built-in voice)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--out-dir", default="s3gen_backend_samples")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model_cls = ChatterboxMultilingualTTS if args.model == "mtl" else ChatterboxTTS
+    model = model_cls.from_pretrained(args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    out_dir = Path(args.out_dir) if args.out_dir else None
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    language = args.language if args.model == "mtl" else "en"
+    tokens = [sample_tokens(model, text, language, seed) for seed, text in enumerate(TEXTS[language])]
+
+    backends = {"cfm": model.s3gen, "meanflow": load_meanflow_s3gen().to(args.device).eval()}
+    results = {}
+    for name, s3gen in backends.items():
+        # warm-up (kernels, allocator)
+        s3gen.inference(speech_tokens=tokens[0][0], ref_dict=tokens[0][1].gen)
+        results[name] = run_backend(model, name, s3gen, tokens, args.repeats, out_dir)
+
+    print(f"\n{'backend':<12}{'latency s':>10}{'RTF':>8}{'speaker sim':>13}")
+    for name, (latencies, durations, similarities) in results.items():
+        latency = sum(latencies) / len(latencies)
+        rtf = sum(latencies) / sum(durations)
+        sim = sum(similarities) / len(similarities)
+        print(f"{name:<12}{latency:>10.3f}{rtf:>8.3f}{sim:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
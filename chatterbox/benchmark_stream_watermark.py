@@ -0,0 +1,62 @@
+"""
+Watermark detection on streamed audio: the Perth watermarker applied to a whole utterance (as `generate` does),
+to each chunk on its own, and through `StreamWatermarker` (as `generate_stream` does).
+
+For each, the script reports the watermark detected in the output (`get_watermark`, mean over the clip), the
+time spent watermarking, and the largest sample-to-sample step at chunk boundaries relative to elsewhere (seams).
+
+    python benchmark_stream_watermark.py --wav speech.wav --chunk-seconds 1.0
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+import perth
+
+from chatterbox.streaming import StreamWatermarker
+
+
+def seam_ratio(wav, boundaries):
+    steps = np.abs(np.diff(wav))
+    at_seams = steps[[b - 1 for b in boundaries if 0 < b < len(wav)]]
+    return at_seams.max() / max(np.percentile(steps, 99.9), 1e-8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wav", required=True, help="speech clip (eg. an unwatermarked S3Gen output)")
+    parser.add_argument("--chunk-seconds", type=float, default=1.0, help="1 s = 25 speech tokens")
+    parser.add_argument("--sr", type=int, default=24000)
+    args = parser.parse_args()
+
+    watermarker = perth.PerthImplicitWatermarker()
+    wav, sr = librosa.load(args.wav, sr=args.sr)
+    chunk = int(args.chunk_seconds * sr)
+    chunks = [wav[i:i + chunk] for i in range(0, len(wav), chunk)]
+    boundaries = list(range(chunk, len(wav), chunk))
+
+    results = {}
+    t0 = time.perf_counter()
+    results["single pass"] = watermarker.apply_watermark(wav, sample_rate=sr)
+    t_single = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    results["per chunk"] = np.concatenate([watermarker.apply_watermark(c, sample_rate=sr) for c in chunks])
+    t_chunks = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    stream_watermarker = StreamWatermarker(watermarker, sr)
+    streamed = [stream_watermarker.push(c) for c in chunks] + [stream_watermarker.flush()]
+    results["streamed"] = np.concatenate(streamed)
+    t_streamed = time.perf_counter() - t0
+
+    print(f"\n{'watermarking':<14}{'detected':>10}{'time s':>9}{'seam ratio':>12}")
+    for (name, out), t in zip(results.items(), [t_single, t_chunks, t_streamed]):
+        detected = float(np.mean(watermarker.get_watermark(out, sample_rate=sr)))
+        print(f"{name:<14}{detected:>10.3f}{t:>9.3f}{seam_ratio(out, boundaries):>12.2f}")
+    print(f"\nunwatermarked: detected {float(np.mean(watermarker.get_watermark(wav, sample_rate=sr))):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Speed of the voice-encoder mel frontend: the torch version (`melspectrogram_torch`, batched, on `--device`)
+against the numpy reference (`melspectrogram`, one clip at a time on the host). Parity is covered by
+tests/test_ve_melspec.py.
+
+    python benchmark_ve_melspec.py --voices voices/*.wav
+    python benchmark_ve_melspec.py --n-clips 64      # synthetic clips
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+import torch
+
+from chatterbox.models.voice_encoder.config import VoiceEncConfig
+from chatterbox.models.voice_encoder.melspec import melspectrogram, melspectrogram_torch
+
+
+def _sync(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voices", nargs="+", default=None, help="reference clips (default: synthetic clips)")
+    parser.add_argument("--n-clips", type=int, default=32, help="number of synthetic clips")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    hp = VoiceEncConfig()
+    if args.voices:
+        wavs = [librosa.load(path, sr=hp.sample_rate)[0] for path in args.voices]
+    else:
+        rng = np.random.default_rng(0)
+        wavs = [0.1 * rng.standard_normal(int(rng.uniform(3, 10) * hp.sample_rate)).astype(np.float32)
+                for _ in range(args.n_clips)]
+    wavs_t = [torch.from_numpy(wav).to(args.device) for wav in wavs]
+    # warm-up (kernels, allocator)
+    melspectrogram_torch(wavs_t, hp)
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeats):
+        [melspectrogram(wav, hp) for wav in wavs]
+    t_numpy = (time.perf_counter() - t0) / args.repeats
+
+    _sync(args.device)
+    t0 = time.perf_counter()
+    for _ in range(args.repeats):
+        melspectrogram_torch(wavs_t, hp)
+    _sync(args.device)
+    t_torch = (time.perf_counter() - t0) / args.repeats
+
+    audio_s = sum(len(wav) for wav in wavs) / hp.sample_rate
+    print(f"\n{len(wavs)} clips, {audio_s:.1f} s of audio")
+    print(f"{'frontend':<10}{'mels s':>9}{'speed-up':>10}")
+    print(f"{'numpy':<10}{t_numpy:>9.4f}{1.0:>10.1f}")
+    print(f"{'torch':<10}{t_torch:>9.4f}{t_numpy / t_torch:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,4 +14,7 @@ from .tts import ChatterboxTTS
 from .vc import ChatterboxVC
 from .mtl_tts import ChatterboxMultilingualTTS, SUPPORTED_LANGUAGES
 from .tts_turbo import ChatterboxTurboTTS
-from .mtl_tts import ChatterboxMultilingualTTS, SUPPORTED_LANGUAGES
\ No newline at end of file
+from .mtl_tts import ChatterboxMultilingualTTS, SUPPORTED_LANGUAGES
+from .voice_store import VoiceConditioningStore
+from .asset_cache import ReferenceAssetCache
+from .streaming import StreamChunkInfo
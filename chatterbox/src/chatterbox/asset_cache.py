@@ -0,0 +1,205 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+S3_URL_RE = re.compile(r"https?://([^.]+)\.s3(?:\.([^.]+))?\.amazonaws\.com/(.+)")
+
+
+class ReferenceAssetCache:
+    """
+    On-disk cache of remote reference clips (http(s) and S3 URLs), so that a clip is downloaded once rather than
+    on every `get_conditionals`.
+
+    Downloads are stored under the sha256 of their content (`blobs/`), next to a record per URL (`urls/`) holding
+    its blob, ETag and Last-Modified, so the cache survives restarts. A URL validated less than `revalidate_after`
+    seconds ago is served from disk without any request; after that, a conditional request (If-None-Match /
+    If-Modified-Since) revalidates it, and it is only downloaded again if it changed. If revalidation fails, the
+    cached copy is served.
+
+    Concurrent fetches of the same URL wait for a single download, and S3 requests share one pooled client per
+    region. NOTE: blobs are never evicted, they are as many as the versions of the clips.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir=None, revalidate_after=300.0, max_pool_connections=16, timeout=30.0):
+        if cache_dir is None:
+            cache_dir = Path(tempfile.gettempdir()) / "chatterbox_assets"
+        self.cache_dir = Path(cache_dir)
+        (self.cache_dir / "blobs").mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / "urls").mkdir(parents=True, exist_ok=True)
+        self.revalidate_after = revalidate_after
+        self.max_pool_connections = max_pool_connections
+        self.timeout = timeout
+        self._records = {}  # url -> record
+        self._lock = threading.Lock()
+        self._fetch_locks = {}  # url -> Lock, so concurrent fetches download only once
+        self._s3_clients = {}  # region -> client
+
+    @classmethod
+    def shared(cls) -> "ReferenceAssetCache":
+        "A process-wide cache in the temp directory, for models that were not given one."
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @staticmethod
+    def is_remote(src) -> bool:
+        return isinstance(src, str) and src.startswith(("http://", "https://"))
+
+    def fetch(self, url: str) -> Path:
+        "Local path of the current content of `url`, downloading or revalidating it if needed."
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(url, threading.Lock())
+        with fetch_lock:
+            record = self._record(url)
+            blob = self._blob(record)
+            if blob is not None and time.time() - record["validated_at"] < self.revalidate_after:
+                return blob
+
+            try:
+                fetched = self._download(url, record if blob is not None else None)
+            except Exception as e:
+                if blob is None:
+                    raise
+                logger.warning(f"Could not revalidate {url}, using the cached copy: {e}")
+                return blob
+
+            if fetched is None:
+                logger.debug(f"Not modified: {url}")
+                record = dict(record, validated_at=time.time())
+            else:
+                logger.info(f"Downloaded {url} ({fetched['blob']})")
+                record = fetched
+            self._save_record(url, record)
+            return self._blob(record)
+
+    def content_hash(self, url: str) -> str:
+        "sha256 of the current content of `url` (the name of its blob)."
+        return self.fetch(url).name.split(".", 1)[0]
+
+    def _record_path(self, url: str) -> Path:
+        return self.cache_dir / "urls" / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+
+    def _record(self, url: str) -> Optional[dict]:
+        with self._lock:
+            record = self._records.get(url)
+        if record is None:
+            path = self._record_path(url)
+            if path.exists():
+                try:
+                    with open(path) as f:
+                        record = json.load(f)
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable asset record {path}: {e}")
+                    return None
+                with self._lock:
+                    self._records[url] = record
+        return record
+
+    def _save_record(self, url: str, record: dict):
+        path = self._record_path(url)
+        # write-then-rename so a concurrent reader never sees a partial file; the temp file is unique because
+        # several processes may share the cache directory
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(record, f)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self._records[url] = record
+
+    def _blob(self, record: Optional[dict]) -> Optional[Path]:
+        if record is None:
+            return None
+        path = self.cache_dir / "blobs" / record["blob"]
+        return path if path.exists() else None
+
+    def _download(self, url: str, record: Optional[dict]) -> Optional[dict]:
+        "The record of a fresh download of `url`, or None if it has not changed since `record`."
+        s3_match = S3_URL_RE.match(url)
+        if s3_match:
+            return self._download_s3(url, s3_match, record)
+        return self._download_http(url, record)
+
+    def _download_http(self, url: str, record: Optional[dict]) -> Optional[dict]:
+        req = urllib.request.Request(url)
+        if record is not None and record.get("etag"):
+            req.add_header("If-None-Match", record["etag"])
+        if record is not None and record.get("last_modified"):
+            req.add_header("If-Modified-Since", record["last_modified"])
+        try:
+            resp = urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        with resp:
+            return self._store(url, resp, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+
+    def _download_s3(self, url: str, s3_match, record: Optional[dict]) -> Optional[dict]:
+        bucket, region, key = s3_match.group(1), s3_match.group(2) or "us-east-1", s3_match.group(3)
+        kwargs = {"IfNoneMatch": record["etag"]} if record is not None and record.get("etag") else {}
+        try:
+            obj = self._s3_client(region).get_object(Bucket=bucket, Key=key, **kwargs)
+        except ClientError as e:
+            status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if status == 304 or e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                return None
+            raise
+        body = obj["Body"]
+        try:
+            return self._store(url, body, obj.get("ETag"), None)
+        finally:
+            body.close()
+
+    def _s3_client(self, region: str):
+        with self._lock:
+            client = self._s3_clients.get(region)
+            if client is None:
+                # boto3 clients are thread-safe: one per region, with a connection pool sized for the workers
+                client = boto3.client(
+                    "s3", region_name=region, config=Config(max_pool_connections=self.max_pool_connections),
+                )
+                self._s3_clients[region] = client
+            return client
+
+    def _store(self, url: str, stream, etag: Optional[str], last_modified: Optional[str]) -> dict:
+        "Writes `stream` to its content-addressed blob and returns the new record of `url`."
+        ext = Path(urllib.parse.urlparse(url).path).suffix or ".flac"
+        blobs_dir = self.cache_dir / "blobs"
+        h = hashlib.sha256()
+        fd, tmp_name = tempfile.mkstemp(dir=blobs_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for block in iter(lambda: stream.read(1 << 20), b""):
+                    h.update(block)
+                    f.write(block)
+            blob = f"{h.hexdigest()}{ext}"
+            os.replace(tmp_name, blobs_dir / blob)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        return dict(url=url, blob=blob, etag=etag, last_modified=last_modified, validated_at=time.time())
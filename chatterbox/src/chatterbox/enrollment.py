@@ -0,0 +1,52 @@
+from typing import Callable, List, Optional
+
+import torch
+
+from .models.reference_audio import ReferenceAudio
+from .models.s3tokenizer import S3_SR
+from .models.s3gen import S3GEN_SR
+from .models.t3.modules.cond_enc import T3Cond
+
+
+def enroll_references(
+    wav_fpaths,
+    t3,
+    s3gen,
+    ve,
+    conds_cls,
+    device,
+    enc_cond_len: int,
+    dec_cond_len: int,
+    exaggeration=0.5,
+    max_workers=8,
+    load: Optional[Callable[..., ReferenceAudio]] = None,
+) -> List:
+    """
+    Batched `get_conditionals` of several reference clips, shared by the TTS models: the clips are decoded in a
+    thread pool with `load` (path -> ReferenceAudio, default `ReferenceAudio.load`), then each conditioning model
+    embeds them in batches rather than one by one. Returns one `conds_cls(t3_cond, ref_dict)` per clip.
+
+    `enc_cond_len` (at 16 kHz) and `dec_cond_len` (at 24 kHz) are the lengths of the T3 prompt and S3Gen reference.
+    """
+    refs = ReferenceAudio.load_all(wav_fpaths, sample_rates=(S3GEN_SR, S3_SR), max_workers=max_workers, load=load)
+    s3gen_ref_dicts = s3gen.embed_refs([ref.crop(dec_cond_len / S3GEN_SR) for ref in refs], device=device)
+
+    # Speech cond prompt tokens
+    t3_cond_prompt_tokens = [None] * len(refs)
+    if plen := t3.hp.speech_cond_prompt_len:
+        wavs = [ref.crop(enc_cond_len / S3_SR).wav(S3_SR) for ref in refs]
+        tokens, token_lens = s3gen.tokenizer.forward(wavs, max_len=plen)
+        t3_cond_prompt_tokens = [tok[None, :n].to(device) for tok, n in zip(tokens, token_lens.tolist())]
+
+    # Voice-encoder speaker embeddings (the partials of all clips in one batch)
+    ve_embeds = torch.from_numpy(ve.embeds_from_refs(refs)).to(device)
+
+    conds = []
+    for ref_dict, prompt_tokens, ve_embed in zip(s3gen_ref_dicts, t3_cond_prompt_tokens, ve_embeds):
+        t3_cond = T3Cond(
+            speaker_emb=ve_embed[None],
+            cond_prompt_speech_tokens=prompt_tokens,
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device=device)
+        conds.append(conds_cls(t3_cond, ref_dict))
+    return conds
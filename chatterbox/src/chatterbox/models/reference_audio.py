@@ -0,0 +1,73 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import librosa
+import numpy as np
+
+
+class ReferenceAudio:
+    """
+    A reference clip, decoded once at its own sample rate, from which the signals at the rates of the conditioning
+    models (24 kHz for S3Gen, 16 kHz for the S3 tokenizer, CAMPPlus and the voice encoder) are derived.
+
+    Each rate is resampled once, from the decoded samples, on first use; `crop` shares these signals, so the
+    differently-sized crops that the models take (eg. 10s for S3Gen and 6s for the T3 prompt) cost no resampling.
+
+    NOTE: not thread-safe, build one per clip and request.
+    """
+
+    def __init__(self, wav: np.ndarray, sr: int, max_duration: Optional[float] = None):
+        self.samples = np.asarray(wav, dtype=np.float32)
+        self.sr = sr
+        self.max_duration = max_duration
+        self._resampled: Dict[int, np.ndarray] = {sr: self.samples}
+
+    @classmethod
+    def load(cls, path, max_duration: Optional[float] = None) -> "ReferenceAudio":
+        wav, sr = librosa.load(path, sr=None)
+        return cls(wav, sr, max_duration=max_duration)
+
+    @classmethod
+    def load_all(
+        cls,
+        paths,
+        sample_rates=(),
+        max_workers=8,
+        load: Optional[Callable[..., "ReferenceAudio"]] = None,
+    ) -> List["ReferenceAudio"]:
+        """
+        Decodes clips in a thread pool (decoding and resampling mostly release the GIL), resampling each to
+        `sample_rates` on the way. `load` (path -> ReferenceAudio) defaults to `ReferenceAudio.load`.
+        """
+        load = load or cls.load
+
+        def _load(path):
+            ref = load(path)
+            for sr in sample_rates:
+                ref.wav(sr)
+            return ref
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(_load, paths))
+
+    @property
+    def duration(self) -> float:
+        "In seconds, taking the crop into account."
+        duration = len(self.samples) / self.sr
+        return duration if self.max_duration is None else min(duration, self.max_duration)
+
+    def crop(self, max_duration: float) -> "ReferenceAudio":
+        "The first `max_duration` seconds of the clip, sharing the signals resampled so far, and to come."
+        ref = copy.copy(self)
+        ref.max_duration = max_duration if self.max_duration is None else min(max_duration, self.max_duration)
+        return ref
+
+    def wav(self, sr: int) -> np.ndarray:
+        "The (cropped) clip at `sr`."
+        if sr not in self._resampled:
+            self._resampled[sr] = librosa.resample(self.samples, orig_sr=self.sr, target_sr=sr)
+        wav = self._resampled[sr]
+        if self.max_duration is not None:
+            wav = wav[:int(self.max_duration * sr)]
+        return wav
@@ -1,2 +1,4 @@
-from .s3gen import S3Token2Wav as S3Gen
+from .s3gen import S3Token2Wav as S3Gen, S3GenStreamer, DERIVED_REF_KEYS
 from .const import S3GEN_SR
+from .hifigan import HiFTStreamer
+from .backends import S3GEN_BACKENDS, load_meanflow_s3gen
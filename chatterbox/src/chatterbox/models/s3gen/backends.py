@@ -0,0 +1,31 @@
+from pathlib import Path
+from typing import Optional
+
+from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
+
+from .s3gen import S3Token2Wav
+
+
+# The token-to-wav decoders that consume the 6561-token S3 vocabulary:
+# - "cfm": the 10-step CFM decoder (with CFG) shipped with each model
+# - "meanflow": the distilled 2-step decoder of Chatterbox-Turbo (no CFG), about 10x cheaper per utterance
+S3GEN_BACKENDS = ("cfm", "meanflow")
+
+MEANFLOW_REPO_ID = "ResembleAI/chatterbox-turbo"
+MEANFLOW_CKPT = "s3gen_meanflow.safetensors"
+
+
+def load_meanflow_s3gen(ckpt_dir: Optional[Path] = None) -> S3Token2Wav:
+    """
+    Loads the meanflow S3Gen from `ckpt_dir` if it holds the checkpoint, or else from the Chatterbox-Turbo repo.
+    NOTE: the speech tokenizer and speaker encoder are the same as in the CFM decoder, so ref dicts embedded by
+    either (eg. the `Conditionals` of a model) can be used with both.
+    """
+    ckpt_path = Path(ckpt_dir) / MEANFLOW_CKPT if ckpt_dir is not None else None
+    if ckpt_path is None or not ckpt_path.exists():
+        ckpt_path = hf_hub_download(repo_id=MEANFLOW_REPO_ID, filename=MEANFLOW_CKPT)
+
+    s3gen = S3Token2Wav(meanflow=True)
+    s3gen.load_state_dict(load_file(ckpt_path), strict=True)
+    return s3gen
@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass
+from typing import List, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -34,6 +37,18 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return mask
 
 
+@dataclass
+class EstimatorPlan:
+    """
+    What `ConditionalDecoder.forward` derives from the mask and the time steps rather than from its input, built
+    once per ODE solve (see `ConditionalDecoder.make_plan`) and shared by all the steps of the solve.
+    """
+    # padding mask and attention bias at each resolution of the U-Net, from the input's down
+    masks: List[torch.Tensor]
+    attn_biases: List[torch.Tensor]
+    # time embedding at each time point the solver evaluates, (n_nodes, time_embed_dim), or None
+    time_embs: Optional[torch.Tensor] = None
+
 
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
@@ -240,7 +255,37 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None):
+    def embed_time(self, t, r=None):
+        "time embedding of `t` (and of the end time `r` in meanflow mode), (N,) -> (N, time_embed_dim)"
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
+
+        if self.meanflow:
+            r = self.time_embeddings(r).to(t.dtype)
+            r = self.time_mlp(r)
+            concat_embed = torch.cat([t, r], dim=1)
+            t = self.time_embed_mixer(concat_embed)
+        return t
+
+    def make_plan(self, mask, dtype, t=None, r=None) -> EstimatorPlan:
+        """
+        Builds the masks and attention biases for `mask` (B, 1, T), and, given the (n_nodes,) time points `t` a
+        solver evaluates the estimator at (and their end times `r` in meanflow mode), their time embeddings.
+        """
+        masks, attn_biases = [mask], []
+        for _ in self.down_blocks:
+            mask_down = masks[-1]
+            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
+            attn_mask = add_optional_chunk_mask(mask_down.transpose(1, 2), mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
+            attn_biases.append(mask_to_bias(attn_mask == 1, dtype))
+            masks.append(mask_down[:, :, ::2])
+
+        time_embs = None
+        if t is not None:
+            time_embs = self.embed_time(t, r)
+        return EstimatorPlan(masks=masks[:-1], attn_biases=attn_biases, time_embs=time_embs)
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None, plan: Optional[EstimatorPlan] = None, step=0):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -250,6 +295,8 @@ class ConditionalDecoder(nn.Module):
             spks (_type_, optional) Defaults to None.
             cond (_type_, optional)
             r: end time for meanflow mode (shape (1,) tensor)
+            plan: precomputed masks, biases and time embeddings of the solve (`make_plan`); `t` and `r` are
+                then ignored in favor of the time embedding of the `step`-th time point of the plan
 
         Raises:
             ValueError: _description_
@@ -258,14 +305,11 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        if self.meanflow:
-            r = self.time_embeddings(r).to(t.dtype)
-            r = self.time_mlp(r)
-            concat_embed = torch.cat([t, r], dim=1)
-            t = self.time_embed_mixer(concat_embed)
+        if plan is None:
+            plan = self.make_plan(mask, x.dtype)
+            t = self.embed_time(t, r)
+        else:
+            t = plan.time_embs[step].expand(x.size(0), -1)
 
         x = pack([x, mu], "b * t")[0]
 
@@ -276,14 +320,10 @@ class ConditionalDecoder(nn.Module):
             x = pack([x, cond], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down, attn_mask = plan.masks[i], plan.attn_biases[i]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -293,16 +333,11 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+        mask_mid, attn_mask = plan.masks[-1], plan.attn_biases[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -311,15 +346,12 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for i, (resnet, transformer_blocks, upsample) in zip(reversed(range(len(plan.masks))), self.up_blocks):
+            mask_up, attn_mask = plan.masks[i], plan.attn_biases[i]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -49,6 +49,10 @@ class ConvRNNF0Predictor(nn.Module):
         )
         self.classifier = nn.Linear(in_features=cond_channels, out_features=self.num_class)
 
+    def receptive_field(self) -> int:
+        "Context, in frames, that the f0 of a frame depends on, on each side."
+        return sum((m.kernel_size[0] - 1) // 2 for m in self.condnet if isinstance(m, nn.Conv1d))
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.condnet(x)
         x = x.transpose(1, 2)
@@ -20,7 +20,6 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from .utils.mask import make_pad_mask
-from .configs import CFM_PARAMS
 from omegaconf import DictConfig
 
 
@@ -40,6 +39,17 @@ def _repeat_batch_dim(tnsr, B, ndim):
     return tnsr
 
 
+def _pack_after_prompt(prompt, prompt_len, x, x_len, dim=1):
+    "concat `x` to `prompt` along `dim`, each row of `x` right after the valid part of its (padded) prompt"
+    if bool((prompt_len == prompt.size(dim)).all()):
+        return torch.concat([prompt, x], dim=dim)
+    out = prompt.new_zeros(*prompt.shape[:dim], int((prompt_len + x_len).max()), *prompt.shape[dim + 1:])
+    for i, (p, n) in enumerate(zip(prompt_len.tolist(), x_len.tolist())):
+        out[i].narrow(dim - 1, 0, p).copy_(prompt[i].narrow(dim - 1, 0, p))
+        out[i].narrow(dim - 1, p, n).copy_(x[i].narrow(dim - 1, 0, n))
+    return out
+
+
 class CausalMaskedDiffWithXvec(torch.nn.Module):
     def __init__(self,
                  input_size: int = 512,
@@ -128,6 +138,20 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    def embed_speaker(self, embedding):
+        "Normalized and projected x-vector, (1 or B, emb_dim)."
+        embedding = torch.atleast_2d(embedding)
+        embedding = F.normalize(embedding, dim=1)
+        return self.spk_embed_affine_layer(embedding)
+
+    @staticmethod
+    def embed_prompt_conds(prompt_feat, prompt_feat_len=None):
+        "Decoder conditions (B, 80, n_feat) of the (B, n_feat, 80) prompt mels: zero past each row's `prompt_feat_len`."
+        if prompt_feat_len is None:
+            return prompt_feat.transpose(1, 2)
+        feat_mask = (~make_pad_mask(prompt_feat_len.long(), prompt_feat.size(1))).unsqueeze(-1)
+        return (prompt_feat * feat_mask).transpose(1, 2)
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -140,15 +164,19 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   finalize,
                   n_timesteps=10,
                   noised_mels=None,
-                  meanflow=False):
+                  meanflow=False,
+                  spk_embedding=None,
+                  prompt_conds=None):
         # token: (B, n_toks)
         # token_len: (B,)
+        # NOTE: each row may come with its own prompt; `prompt_token_len` and `prompt_feat_len` give the
+        #   valid part of the padded prompts (`prompt_feat_len=None` means no padding).
+        # NOTE: `spk_embedding` and `prompt_conds` are the reference-only inputs precomputed by `embed_speaker`
+        #   and `embed_prompt_conds` (see `S3Token2Mel.prepare_ref_dict`); computed here when not given.
         B = token.size(0)
 
         # xvec projection
-        embedding = torch.atleast_2d(embedding)
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)  # (1 or B, emb_dim)
+        embedding = spk_embedding if spk_embedding is not None else self.embed_speaker(embedding)  # (1 or B, emb_dim)
 
         # adjust shapes (batching logic)
         prompt_token = _repeat_batch_dim(prompt_token, B, ndim=2)  # (B, n_prompt)
@@ -156,9 +184,14 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         prompt_feat = _repeat_batch_dim(prompt_feat, B, ndim=3)  # (B, n_feat, feat_dim=80)
         prompt_feat_len = _repeat_batch_dim(prompt_feat_len, B, ndim=1)  # (B,) or None
         embedding = _repeat_batch_dim(embedding, B, ndim=2)  # (B, emb_dim)
+        prompt_conds = _repeat_batch_dim(prompt_conds, B, ndim=3)  # (B, feat_dim=80, n_feat) or None
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full((B,), prompt_feat.size(1), dtype=torch.long, device=token.device)
+        prompt_token_len, prompt_feat_len = prompt_token_len.long(), prompt_feat_len.long()
+        ragged = bool((prompt_token_len != prompt_token.size(1)).any() or (prompt_feat_len != prompt_feat.size(1)).any())
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        token, token_len = _pack_after_prompt(prompt_token, prompt_token_len, token, token_len), prompt_token_len + token_len
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
 
         if (token >= self.vocab_size).any():
@@ -167,23 +200,30 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
 
         # text encode
         h, h_masks = self.encoder(token, token_len)
+        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
         if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
+            h_lengths = h_lengths - self.pre_lookahead_len * self.token_mel_ratio
+        h = h[:, :int(h_lengths.max())]
 
-        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+        mel_len1, mel_len2 = prompt_feat_len, h_lengths - prompt_feat_len  # (B,) each
         h = self.encoder_proj(h)
 
-        # # get conditions
-        conds = torch.zeros([B, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        # # get conditions: the prompt mels, zero over the generated frames
+        if prompt_conds is None:
+            prompt_conds = self.embed_prompt_conds(prompt_feat, prompt_feat_len)
+        n_feat = min(prompt_conds.size(2), h.size(1))
+        conds = F.pad(prompt_conds[:, :, :n_feat], (0, h.size(1) - n_feat)).to(h.dtype)
 
-        mask = (~make_pad_mask(h_lengths)).unsqueeze(1).to(h)
+        mask = (~make_pad_mask(h_lengths, h.size(1))).unsqueeze(1).to(h)
 
         if mask.shape[0] != B:
             mask = mask.repeat(B, 1, 1)
 
+        if noised_mels is not None and ragged:
+            # the decoder expects the noise of the generated frames right-aligned; place it after each prompt
+            noise = torch.randn_like(conds)
+            noised_mels = _pack_after_prompt(noise, mel_len1, noised_mels, mel_len2, dim=2)[:, :, :h.size(1)]
+
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask,
@@ -193,6 +233,13 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             noised_mels=noised_mels,
             meanflow=meanflow,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat, None  # NOTE jrm: why are they returning None here?
+        if not ragged:
+            feat = feat[:, :, prompt_feat.size(1):]
+            assert feat.shape[2] == int(mel_len2.max())
+            return feat, mel_len2
+
+        # crop the generated frames of each row, right-padded with zeros
+        out = feat.new_zeros(B, feat.size(1), int(mel_len2.max()))
+        for i in range(B):
+            out[i, :, :mel_len2[i]] = feat[i, :, mel_len1[i]:mel_len1[i] + mel_len2[i]]
+        return out, mel_len2
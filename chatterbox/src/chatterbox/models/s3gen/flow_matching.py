@@ -16,6 +16,7 @@ import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from .utils.ode_solvers import ODE_SOLVERS
 from tqdm import tqdm
 
 
@@ -91,6 +92,13 @@ class ConditionalCFM(BASECFM):
             cond: Not used but kept for future purposes
             meanflow: meanflow mode
         """
+        return self.solve_ode(x, t_span, mu, mask, spks, cond, solver="euler")
+
+    def solve_ode(self, x, t_span, mu, mask, spks, cond, solver="euler"):
+        """
+        Solves the CFG-guided ODE with one of `ODE_SOLVERS` (or any `ODESolver`); same arguments as `solve_euler`.
+        """
+        solver = ODE_SOLVERS[solver] if isinstance(solver, str) else solver
         in_dtype = x.dtype
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
 
@@ -100,48 +108,37 @@ class ConditionalCFM(BASECFM):
         x_in    = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
         mask_in = torch.zeros([2 * B,  1, T], device=x.device, dtype=x.dtype)
         mu_in   = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        t_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype)
         spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=x.dtype)
         cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        r_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype) # (only used for meanflow)
-
-        for t, r in zip(t_span[:-1], t_span[1:]):
-            t = t.unsqueeze(dim=0)
-            r = r.unsqueeze(dim=0)
-            # Shapes:
-            #      x_in  ( 2B, 80, T )
-            #   mask_in  ( 2B,  1, T )
-            #     mu_in  ( 2B, 80, T )
-            #      t_in  ( 2B,       )
-            #   spks_in  ( 2B, 80,   )
-            #   cond_in  ( 2B, 80, T )
-            #      r_in  ( 2B,       )
-            #         x  (  B, 80, T )
-            #      mask  (  B,  1, T )
-            #        mu  (  B, 80, T )
-            #         t  (  B,       )
-            #      spks  (  B, 80,   )
-            #      cond  (  B, 80, T )
-            #         r  (  B,       )
 
+        # Shapes:
+        #      x_in  ( 2B, 80, T )
+        #   mask_in  ( 2B,  1, T )
+        #     mu_in  ( 2B, 80, T )
+        #   spks_in  ( 2B, 80,   )
+        #   cond_in  ( 2B, 80, T )
+        #         x  (  B, 80, T )
+        #      mask  (  B,  1, T )
+        #        mu  (  B, 80, T )
+        #      spks  (  B, 80,   )
+        #      cond  (  B, 80, T )
+        # the conditioning is the same at every step, and so are the masks, attention biases and time embeddings
+        #   that the estimator derives from it (its plan)
+        mask_in[:B] = mask_in[B:] = mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+        plan = self.estimator.make_plan(mask_in, x.dtype, t=solver.nodes(t_span))
+
+        def velocity(x, k):
             x_in[:B] = x_in[B:] = x
-            mask_in[:B] = mask_in[B:] = mask
-            mu_in[:B] = mu
-            t_in[:B] = t_in[B:] = t
-            spks_in[:B] = spks
-            cond_in[:B] = cond
-            r_in[:B] = r_in[B:] = r # (only used for meanflow)
             dxdt = self.estimator.forward(
-                x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
-                r=r_in if meanflow else None,
+                x=x_in, mask=mask_in, mu=mu_in, t=None, spks=spks_in, cond=cond_in, plan=plan, step=k,
             )
             dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
-            dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
-            dt = r - t
-            x = x + dt * dxdt
-
-
+            return (1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt
 
+        x = solver.solve(velocity, x, t_span)
         return x.to(in_dtype)
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
@@ -191,9 +188,11 @@ class CausalConditionalCFM(ConditionalCFM):
         super().__init__(in_channels, cfm_params, n_spks, spk_emb_dim, estimator)
         # TODO: BAD BAD IDEA - IT'LL MESS UP DISTILLATION - SETTING TO NONE
         self.rand_noise = None
+        # ODE solver of the CFG (non-meanflow) path, a key of `ODE_SOLVERS`
+        self.ode_solver = "euler"
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False, solver=None):
         """Forward diffusion
 
         Args:
@@ -207,6 +206,7 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             noised_mels: gt mels noised a time t
+            solver: ODE solver for the CFG path (defaults to `self.ode_solver`); `n_timesteps` counts its steps
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
@@ -230,16 +230,18 @@ class CausalConditionalCFM(ConditionalCFM):
         if meanflow:
             return self.basic_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
 
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, meanflow=meanflow), None
+        solver = solver or self.ode_solver
+        return self.solve_ode(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), None
 
     def basic_euler(self, x, t_span, mu, mask, spks, cond):
         in_dtype = x.dtype
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
 
+        plan = self.estimator.make_plan(mask, x.dtype, t=t_span[:-1], r=t_span[1:])
+
         print("S3 Token -> Mel Inference...")
-        for t, r in tqdm(zip(t_span[..., :-1], t_span[..., 1:]), total=t_span.shape[-1] - 1):
-            t, r = t[None], r[None]
-            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r)
+        for step, (t, r) in tqdm(enumerate(zip(t_span[..., :-1], t_span[..., 1:])), total=t_span.shape[-1] - 1):
+            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=None, spks=spks, cond=cond, plan=plan, step=step)
             dt = r - t
             x = x + dt * dxdt
 
@@ -26,7 +26,6 @@ from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
 from torch.nn.utils import remove_weight_norm
 from torch.nn.utils.parametrizations import weight_norm
-from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
 
@@ -171,26 +170,33 @@ class SineGen(torch.nn.Module):
     SineGen(samp_rate, harmonic_num = 0,
             sine_amp = 0.1, noise_std = 0.003,
             voiced_threshold = 0,
-            flag_for_pulse=False)
+            upsample_scale = 1)
     samp_rate: sampling rate in Hz
     harmonic_num: number of harmonic overtones (default 0)
     sine_amp: amplitude of sine-wavefrom (default 0.1)
     noise_std: std of Gaussian noise (default 0.003)
     voiced_thoreshold: F0 threshold for U/V classification (default 0)
-    flag_for_pulse: this SinGen is used inside PulseGen (default False)
-    Note: when flag_for_pulse is True, the first time step of a voiced
-        segment is always sin(np.pi) or cos(0)
+    upsample_scale: samples per F0 frame (default 1)
+
+    F0 is constant over the samples of a frame, so the phase is integrated at frame rate, and the harmonics
+    are expanded by broadcasting: the sample-rate signals are only materialized once, for the sine waves.
+    The phase at the start of each frame is integrated in fixed point (`PHASE_ONE` per cycle), which is exact, so
+    that a signal generated in chunks is the same as one generated whole. Without noise, the sine waves are those
+    of the original sample-rate formula, `sine_amp * sin(2 pi (cumsum(h * f0 / sr) % 1) + phase) * uv`.
     """
 
+    PHASE_ONE = 1 << 32
+
     def __init__(self, samp_rate, harmonic_num=0,
                  sine_amp=0.1, noise_std=0.003,
-                 voiced_threshold=0):
+                 voiced_threshold=0, upsample_scale=1):
         super(SineGen, self).__init__()
         self.sine_amp = sine_amp
         self.noise_std = noise_std
         self.harmonic_num = harmonic_num
         self.sampling_rate = samp_rate
         self.voiced_threshold = voiced_threshold
+        self.upsample_scale = int(upsample_scale)
 
     def _f02uv(self, f0):
         # generate uv signal
@@ -198,37 +204,83 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, state: Optional[dict] = None, add_noise=True):
         """
-        :param f0: [B, 1, sample_len], Hz
-        :return: [B, 1, sample_len]
+        :param f0: [B, 1, frame_len], Hz
+        :param state: to generate a signal in consecutive chunks, a dict (empty for the first one) carrying the
+            random initial phases, and the phase reached at the end of a chunk, over to the next one
+        :param add_noise: if False, the sine waves are returned without noise, and the noise std in place of it
+        :return: [B, harmonic_num + 1, sample_len] sine waves, [B, 1, sample_len] uv and noise,
+            with sample_len = frame_len * upsample_scale
         """
-
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
-
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        B, U = f0.size(0), self.upsample_scale
+        f0 = f0.float()
+
+        # phase, in cycles of the fundamental: it advances by f0 / sr per sample, ie. by U times that per frame
+        step = f0 / self.sampling_rate
+        # f0 * 2**40 is an exact integer (float32 has a 24-bit mantissa), so the per-frame advance is exact up to
+        # the final division: U * f0 / sr cycles = f0 * 2**40 * U / (sr * 2**8) phase units
+        frame_step = (f0 * (1 << 40)).long() * U // (int(self.sampling_rate) << 8)
+        start = torch.cumsum(frame_step, dim=-1) - frame_step
+        if state is not None and "cycles" in state:
+            start = start + state["cycles"]
+        start = start % self.PHASE_ONE
+        if state is not None:
+            state["cycles"] = (start[..., -1:] + frame_step[..., -1:]) % self.PHASE_ONE
+        start = start.float() / self.PHASE_ONE
+        offsets = torch.arange(1, U + 1, device=f0.device, dtype=torch.float32)
+        cycles = start.unsqueeze(-1) + step.unsqueeze(-1) * offsets  # [B, 1, T, U]
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=torch.float32)
+        theta_mat = 2 * np.pi * ((harmonics.view(1, -1, 1, 1) * cycles) % 1)  # [B, H, T, U]
+
+        if state is not None and "phase_vec" in state:
+            phase_vec = state["phase_vec"]
+        else:
+            phase_vec = (2 * torch.rand(B, self.harmonic_num + 1, 1, 1, device=f0.device) - 1) * np.pi
+            phase_vec[:, 0] = 0
+        if state is not None:
+            state["phase_vec"] = phase_vec
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
 
         # generate uv signal
-        uv = self._f02uv(f0)
+        uv = self._f02uv(f0).unsqueeze(-1)  # [B, 1, T, 1]
 
         # noise: for unvoiced should be similar to sine_amp
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
-        sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+        sine_waves = sine_waves * uv
+        if add_noise:
+            noise = noise_amp * torch.randn_like(sine_waves)
+            sine_waves = sine_waves + noise
+        else:
+            noise = noise_amp.expand(-1, -1, -1, U)
+        return sine_waves.flatten(2), uv.expand(-1, -1, -1, U).flatten(2), noise.flatten(2)
+
+
+def _hash32(x: torch.Tensor) -> torch.Tensor:
+    "Integer hash of int64 tensors holding values below 2**32."
+    x = (((x >> 16) ^ x) * 0x45D9F3B) & 0xFFFFFFFF
+    x = (((x >> 16) ^ x) * 0x45D9F3B) & 0xFFFFFFFF
+    return (x >> 16) ^ x
+
+
+def position_noise(seed: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+    """
+    Standard gaussian noise (B, L) that is a function of a per-row `seed` (B, 1) and of the sample `positions` (L,)
+    rather than of an RNG state, so that the noise of a sample is the same whether a signal is generated whole or
+    in chunks (Box-Muller over hashed counters).
+    """
+    def uniform(salt):
+        h = _hash32(_hash32((2 * positions + salt) & 0xFFFFFFFF) ^ seed)
+        return ((h >> 8).float() + 0.5) / (1 << 24)  # in (0, 1), exact in float32
+
+    return torch.sqrt(-2 * torch.log(uniform(0))) * torch.cos(2 * np.pi * uniform(1))
 
 
 class SourceModuleHnNSF(torch.nn.Module):
@@ -247,6 +299,12 @@ class SourceModuleHnNSF(torch.nn.Module):
     Sine_source (batchsize, length, 1)
     noise_source (batchsize, length 1)
     uv (batchsize, length, 1)
+
+    NOTE: at inference, the additive noise of the harmonics is not drawn per harmonic (as in training, and as this
+    module used to) but once, after they are merged: a single gaussian whose std is scaled by the norm of the merge
+    weights. The distribution of the source is the same, but not its samples, so a given seed gives different
+    audio than before. The noise is a function of a seed and the sample position (`position_noise`), rather than
+    of the RNG state, so that the source can be generated in chunks.
     """
 
     def __init__(self, sampling_rate, upsample_scale, harmonic_num=0, sine_amp=0.1,
@@ -258,25 +316,43 @@ class SourceModuleHnNSF(torch.nn.Module):
 
         # to produce sine waveforms
         self.l_sin_gen = SineGen(sampling_rate, harmonic_num,
-                                 sine_amp, add_noise_std, voiced_threshod)
+                                 sine_amp, add_noise_std, voiced_threshod, upsample_scale)
 
         # to merge source harmonics into a single excitation
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, sine_state: Optional[dict] = None):
         """
-        Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
-        F0_sampled (batchsize, length, 1)
+        Sine_source, noise_source = SourceModuleHnNSF(F0)
+        F0 (batchsize, frames, 1), each frame lasting upsample_scale samples
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
+        sine_state: to generate the source of consecutive chunks of F0, a dict (empty for the first one) carrying
+            the state of `SineGen.forward` and, at inference, the noise seed and position over to the next chunk
         """
+        if sine_state is None:
+            sine_state = {}
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, noise = self.l_sin_gen(x.transpose(1, 2), state=sine_state, add_noise=self.training)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
-        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        sine_merge = self.l_linear(sine_wavs)
+        if not self.training:
+            # the noise of the harmonics is independent, so once merged it is a single gaussian (rather than one
+            # per harmonic), with its std scaled by the norm of the merge weights. It is drawn from the sample
+            # positions, so a source generated in chunks is exactly the one generated in one pass.
+            if "noise_seed" not in sine_state:
+                sine_state["noise_seed"] = torch.randint(1 << 31, (x.size(0), 1), device=x.device)
+                sine_state["position"] = 0
+            position = sine_state["position"]
+            positions = torch.arange(position, position + sine_merge.size(1), device=x.device)
+            sine_state["position"] = position + sine_merge.size(1)
+            noise_std = noise.transpose(1, 2) * self.l_linear.weight.norm()
+            gaussian = position_noise(sine_state["noise_seed"], positions).unsqueeze(-1)
+            sine_merge = sine_merge + (noise_std * gaussian).to(sine_merge.dtype)
+        sine_merge = self.l_tanh(sine_merge)
 
         # source for noise branch, in the same shape as uv
         noise = torch.randn_like(uv) * self.sine_amp / 3
@@ -393,6 +469,56 @@ class HiFTGenerator(nn.Module):
         for l in self.source_resblocks:
             l.remove_weight_norm()
 
+    def receptive_field(self) -> int:
+        """
+        Context, in mel frames, that `decode` needs on each side of an output frame, in both the mel and the source,
+        for its samples to come out as in a pass over the whole input. Computed by following back, through every
+        layer of `decode`, the span of positions that the samples of a frame depend on.
+        """
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        hop = int(self.f0_upsamp.scale_factor)  # samples per mel frame
+
+        # spans are inclusive (first, last) positions in the sequence at that point of `decode`
+        def conv(layer, span):
+            k, = layer.kernel_size
+            s, = layer.stride
+            p, = layer.padding
+            d, = layer.dilation
+            return span[0] * s - p, span[1] * s - p + d * (k - 1)
+
+        def conv_transpose(layer, span):
+            k, = layer.kernel_size
+            s, = layer.stride
+            p, = layer.padding
+            return -((k - 1 - p - span[0]) // s), (span[1] + p) // s
+
+        def resblock(block, span):
+            for c1, c2 in zip(reversed(block.convs1), reversed(block.convs2)):
+                span = conv(c1, conv(c2, span))
+            return span
+
+        def union(*spans):
+            return min(s[0] for s in spans), max(s[1] for s in spans)
+
+        # the samples of frame 0, the ISTFT frames (centered) that overlap them, and the input of `conv_post`
+        span = (0, hop - 1)
+        span = -((n_fft - 1 - n_fft // 2 - span[0]) // hop_len), (span[1] + n_fft // 2) // hop_len
+        span = conv(self.conv_post, span)
+        source_spans = []
+        for i in reversed(range(self.num_upsamples)):
+            resblocks = self.resblocks[i * self.num_kernels:(i + 1) * self.num_kernels]
+            span = union(*[resblock(block, span) for block in resblocks])
+            # fusion: the source joins through its STFT (centered), `source_downs` and `source_resblocks`
+            s_span = conv(self.source_downs[i], resblock(self.source_resblocks[i], span))
+            source_spans.append((s_span[0] * hop_len - n_fft // 2, s_span[1] * hop_len - n_fft // 2 + n_fft - 1))
+            if i == self.num_upsamples - 1:
+                span = span[0] - 1, span[1] - 1  # reflection pad on the left
+            span = conv_transpose(self.ups[i], span)
+        mel_span = conv(self.conv_pre, span)
+        source_span = union(*source_spans)
+        first, last = union(mel_span, (source_span[0] // hop, source_span[1] // hop))
+        return max(-first, last)
+
     def _stft(self, x):
         spec = torch.stft(
             x,
@@ -452,8 +578,7 @@ class HiFTGenerator(nn.Module):
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        s, _, _ = self.m_source(f0.unsqueeze(-1))
         s = s.transpose(1, 2)
         # mel+source->speech
         generated_speech = self.decode(x=speech_feat, s=s)
@@ -464,11 +589,101 @@ class HiFTGenerator(nn.Module):
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        s, _, _ = self.m_source(f0.unsqueeze(-1))
         s = s.transpose(1, 2)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+
+class HiFTStreamer:
+    """
+    Chunked `HiFTGenerator.inference`: `push` takes the next (B, 80, n) mel frames of an utterance and returns the
+    audio that is final so far, so that long outputs are vocoded with bounded memory, and playback can start
+    before the mel is complete. Concatenated, the returned chunks make up the utterance.
+
+    - The f0 of a frame is predicted once the `f0_predictor` context around it is known.
+    - The source is generated once per sample, carrying the sine phases (and their random offsets) and the noise
+      seed and position across chunks: given the f0, it is exactly the source of one pass.
+    - Each chunk is decoded with `context_frames` of mel and source on both sides (by default, the receptive field
+      of `decode`), which covers the conv context and the ISTFT overlap, and only the samples that the window
+      edges cannot reach are emitted.
+
+    So, from the same RNG state, the audio is that of a single `inference` pass over the whole mel, up to the
+    rounding of convolutions run over a window rather than the whole input; the cost is `context_frames` of
+    lookahead, and the recomputation of the context of each chunk.
+
+    NOTE: one streamer per utterance, and not thread-safe.
+    """
+
+    def __init__(self, hift: HiFTGenerator, context_frames: Optional[int] = None):
+        self.hift = hift
+        self.context = hift.receptive_field() if context_frames is None else context_frames
+        self.f0_context = hift.f0_predictor.receptive_field()
+        self.hop = int(hift.f0_upsamp.scale_factor)  # samples per mel frame
+
+        # positions are frame indices in the utterance
+        self.mels = None  # mels from `mel_start` on
+        self.mel_start = 0
+        self.n_mel = 0  # frames pushed
+        self.source = None  # source samples of the frames from `source_start` to `n_source`
+        self.source_start = 0
+        self.n_source = 0
+        self.n_out = 0  # frames vocoded
+        self.sine_state = {}
+        self.finished = False
+
+    @torch.inference_mode()
+    def push(self, mels: torch.Tensor, finalize=False) -> torch.Tensor:
+        """
+        Adds (B, 80, n) mels to the stream and returns the (B, n_samples) audio ready so far, possibly empty.
+        With `finalize`, the stream is flushed and no more mels can be pushed.
+        """
+        assert not self.finished, "the stream is already finalized"
+        self.finished = finalize
+        self.mels = mels if self.mels is None else torch.cat([self.mels, mels], dim=2)
+        self.n_mel += mels.size(2)
+
+        self._extend_source(finalize)
+        end = self.n_source if finalize else self.n_source - self.context
+        if end <= self.n_out:
+            return torch.zeros(self.mels.size(0), 0, dtype=self.mels.dtype, device=self.mels.device)
+        wav = self._decode(end)
+        self._trim()
+        return wav
+
+    def _extend_source(self, finalize: bool):
+        "Predicts the f0 of the frames whose context is complete, and generates their source."
+        f0_end = self.n_mel if finalize else self.n_mel - self.f0_context
+        if f0_end <= self.n_source:
+            return
+        start = max(self.n_source - self.f0_context, 0)
+        f0 = self.hift.f0_predictor(self.mels[:, :, start - self.mel_start:])
+        f0 = f0[:, self.n_source - start:f0_end - start]
+
+        s, _, _ = self.hift.m_source(f0.unsqueeze(-1), sine_state=self.sine_state)
+        s = s.transpose(1, 2)
+        self.source = s if self.source is None else torch.cat([self.source, s], dim=2)
+        self.n_source = f0_end
+
+    def _decode(self, end: int) -> torch.Tensor:
+        "Vocodes the frames from `n_out` to `end`, with up to `context` frames on each side."
+        lo = max(self.n_out - self.context, 0)
+        hi = min(end + self.context, self.n_source)
+        mels = self.mels[:, :, lo - self.mel_start:hi - self.mel_start]
+        source = self.source[:, :, (lo - self.source_start) * self.hop:(hi - self.source_start) * self.hop]
+        wav = self.hift.decode(x=mels, s=source)
+        wav = wav[:, (self.n_out - lo) * self.hop:(end - lo) * self.hop]
+        self.n_out = end
+        return wav
+
+    def _trim(self):
+        "Drops the mels and source no longer needed as context."
+        mel_start = max(min(self.n_out - self.context, self.n_source - self.f0_context), 0)
+        self.mels = self.mels[:, :, mel_start - self.mel_start:]
+        self.mel_start = mel_start
+        source_start = max(self.n_out - self.context, 0)
+        self.source = self.source[:, :, (source_start - self.source_start) * self.hop:]
+        self.source_start = source_start
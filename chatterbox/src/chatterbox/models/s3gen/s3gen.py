@@ -18,19 +18,22 @@ import numpy as np
 import torch
 import torchaudio as ta
 from functools import lru_cache
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional, Union
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
+from ..reference_audio import ReferenceAudio
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
 from .utils.mel import mel_spectrogram
+from .utils.mask import make_pad_mask
 from .f0_predictor import ConvRNNF0Predictor
-from .hifigan import HiFTGenerator
+from .hifigan import HiFTGenerator, HiFTStreamer
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
 from .configs import CFM_PARAMS
+from .utils.ode_solvers import ODE_SOLVERS
 
 
 def drop_invalid_tokens(x):
@@ -38,6 +41,28 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
+def drop_invalid_tokens_batch(x, x_lens=None):
+    """
+    Batched `drop_invalid_tokens`: drops the invalid tokens of each row of the right-padded (B, T) `x`,
+    and returns the right-padded valid tokens with their (B,) lengths.
+    """
+    x = torch.atleast_2d(x)
+    valid = x < SPEECH_VOCAB_SIZE
+    if x_lens is not None:
+        valid &= ~make_pad_mask(torch.as_tensor(x_lens, device=x.device), x.size(1))
+    lens = valid.sum(dim=1)
+    # a stable sort moves the valid tokens of each row to the front, in order
+    order = torch.sort((~valid).to(torch.uint8), dim=1, stable=True).indices
+    x = x.gather(1, order)[:, :int(lens.max())]
+    x = x.masked_fill(make_pad_mask(lens, x.size(1)), 0)
+    return x, lens
+
+
+# ref dict entries derived from the reference with the flow's weights (see `S3Token2Mel.prepare_ref_dict`): kept in
+# memory only, since saved conditionals may be loaded into a model with another flow (eg. the meanflow decoder)
+DERIVED_REF_KEYS = ("spk_embedding", "prompt_conds")
+
+
 # TODO: global resampler cache
 @lru_cache(100)
 def get_resampler(src_sr, dst_sr, device):
@@ -104,12 +129,27 @@ class S3Token2Mel(torch.nn.Module):
         )
 
         self.resamplers = {}
+        # number of CFM steps when none is passed (non-meanflow decoder only), see `set_ode_solver`
+        self.default_cfm_timesteps = 10
 
     @property
     def device(self):
         params = self.tokenizer.parameters()
         return next(params).device
 
+    def set_ode_solver(self, solver: str, n_timesteps: Optional[int] = None):
+        """
+        Selects the ODE solver of the CFM decoder (a key of `ODE_SOLVERS`) and, optionally, its default number of
+        steps. Not used by the meanflow decoder, which always takes plain Euler steps.
+        """
+        assert solver in ODE_SOLVERS, f"unknown ODE solver {solver!r}, expected one of {list(ODE_SOLVERS)}"
+        self.flow.decoder.ode_solver = solver
+        if n_timesteps is not None:
+            self.default_cfm_timesteps = n_timesteps
+
+    def resolve_cfm_timesteps(self, n_cfm_timesteps=None) -> int:
+        return n_cfm_timesteps or (2 if self.meanflow else self.default_cfm_timesteps)
+
     @property
     def dtype(self):
         params = self.flow.parameters()
@@ -117,12 +157,21 @@ class S3Token2Mel(torch.nn.Module):
 
     def embed_ref(
         self,
-        ref_wav: torch.Tensor,
-        ref_sr: int,
+        ref_wav: Union[torch.Tensor, ReferenceAudio],
+        ref_sr: Optional[int] = None,
         device="auto",
         ref_fade_out=True,
     ):
+        """
+        Embeds a reference clip: either a waveform at `ref_sr`, resampled here to 24 and 16 kHz, or a
+        `ReferenceAudio`, whose 24 and 16 kHz signals are used as they are (and shared with the other models).
+        """
         device = self.device if device == "auto" else device
+        if isinstance(ref_wav, ReferenceAudio):
+            ref_wav_24 = torch.from_numpy(ref_wav.wav(S3GEN_SR)).to(device=device, dtype=self.dtype)[None]
+            ref_wav_16 = torch.from_numpy(ref_wav.wav(S3_SR)).to(device)[None]
+            return self._embed_ref(ref_wav_24, ref_wav_16)
+
         if isinstance(ref_wav, np.ndarray):
             ref_wav = torch.from_numpy(ref_wav).float()
 
@@ -140,13 +189,39 @@ class S3Token2Mel(torch.nn.Module):
             ref_wav_24 = get_resampler(ref_sr, S3GEN_SR, device)(ref_wav)
         ref_wav_24 = ref_wav_24.to(device=device, dtype=self.dtype)
 
-        ref_mels_24 = self.mel_extractor(ref_wav_24).transpose(1, 2).to(dtype=self.dtype)
-        ref_mels_24_len = None
-
         # Resample to 16kHz
         ref_wav_16 = ref_wav
         if ref_sr != S3_SR:
             ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav)
+        return self._embed_ref(ref_wav_24, ref_wav_16)
+
+    def embed_refs(self, refs: List[ReferenceAudio], device="auto", batch_size=16) -> List[dict]:
+        """
+        `embed_ref` of several clips, batched: clips of the same length (eg. all those longer than their crop)
+        go through the mel extractor, CAMPPlus and the tokenizer together, up to `batch_size` at a time.
+        Clips of different lengths are not padded together, as CAMPPlus pools over the whole input.
+        """
+        device = self.device if device == "auto" else device
+        groups = {}
+        for i, ref in enumerate(refs):
+            groups.setdefault((len(ref.wav(S3GEN_SR)), len(ref.wav(S3_SR))), []).append(i)
+
+        ref_dicts = [None] * len(refs)
+        for group in groups.values():
+            for start in range(0, len(group), batch_size):
+                idxs = group[start:start + batch_size]
+                ref_wav_24 = torch.from_numpy(np.stack([refs[i].wav(S3GEN_SR) for i in idxs]))
+                ref_wav_16 = torch.from_numpy(np.stack([refs[i].wav(S3_SR) for i in idxs]))
+                batch = self._embed_ref(ref_wav_24.to(device=device, dtype=self.dtype), ref_wav_16.to(device))
+                for j, i in enumerate(idxs):
+                    ref_dicts[i] = {k: v[j:j + 1] if torch.is_tensor(v) else v for k, v in batch.items()}
+        return ref_dicts
+
+    def _embed_ref(self, ref_wav_24: torch.Tensor, ref_wav_16: torch.Tensor) -> dict:
+        "Embeds the (B, L) 24 and 16 kHz signals of B reference clips of the same length."
+        device = ref_wav_24.device
+        ref_mels_24 = self.mel_extractor(ref_wav_24).transpose(1, 2).to(dtype=self.dtype)
+        ref_mels_24_len = None
 
         # Speaker embedding
         ref_x_vector = self.speaker_encoder.inference(ref_wav_16.to(dtype=self.dtype))
@@ -160,15 +235,69 @@ class S3Token2Mel(torch.nn.Module):
                 "Reference mel length is not equal to 2 * reference token length.\n"
             )
             ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
-            ref_speech_token_lens[0] = ref_speech_tokens.shape[1]
+            ref_speech_token_lens[:] = ref_speech_tokens.shape[1]
 
-        return dict(
+        return self.prepare_ref_dict(dict(
             prompt_token=ref_speech_tokens.to(device),
             prompt_token_len=ref_speech_token_lens,
             prompt_feat=ref_mels_24,
             prompt_feat_len=ref_mels_24_len,
             embedding=ref_x_vector,
-        )
+        ))
+
+    @torch.no_grad()
+    def prepare_ref_dict(self, ref_dict: dict) -> dict:
+        """
+        Copy of `ref_dict` with the reference-only inputs of the flow precomputed (`DERIVED_REF_KEYS`): the projected
+        x-vector and the masked prompt mels, which `flow.inference` would otherwise rebuild on every call.
+        """
+        ref_dict = {k: v for k, v in ref_dict.items() if k not in DERIVED_REF_KEYS}
+        prompt_feat = ref_dict["prompt_feat"]
+        if prompt_feat.ndim == 2:
+            prompt_feat = prompt_feat[None]  # (1, n_feat, 80)
+        prompt_feat_len = ref_dict.get("prompt_feat_len")
+        if prompt_feat_len is not None:
+            prompt_feat_len = torch.as_tensor(prompt_feat_len, device=prompt_feat.device).reshape(-1)
+        ref_dict["spk_embedding"] = self.flow.embed_speaker(ref_dict["embedding"])
+        ref_dict["prompt_conds"] = self.flow.embed_prompt_conds(prompt_feat, prompt_feat_len)
+        return ref_dict
+
+    def cast_ref_dict(self, ref_dict: dict) -> dict:
+        """
+        Type/device casting of a pre-computed ref embedding (all values will be numpy if it's from a prod API call).
+        NOTE: cast into a copy, the caller's dict may be shared with other threads
+        """
+        ref_dict = dict(ref_dict)
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+        return ref_dict
+
+    def collate_ref_dicts(self, ref_dicts: List[dict]) -> dict:
+        """
+        Casts per-item ref embeddings (as returned by `embed_ref`) and pads them into a single batched ref
+        dict, one row per item, with the prompt lengths of each row.
+        """
+        ref_dicts = [self.cast_ref_dict(rd) for rd in ref_dicts]
+        prompt_token = [torch.atleast_2d(rd["prompt_token"])[0] for rd in ref_dicts]
+        prompt_feat = [rd["prompt_feat"].reshape(-1, rd["prompt_feat"].size(-1)) for rd in ref_dicts]
+        prompt_token_len = [
+            int(rd["prompt_token_len"].reshape(-1)[0]) if rd.get("prompt_token_len") is not None else len(tok)
+            for rd, tok in zip(ref_dicts, prompt_token)
+        ]
+        prompt_feat_len = [
+            int(rd["prompt_feat_len"].reshape(-1)[0]) if rd.get("prompt_feat_len") is not None else len(feat)
+            for rd, feat in zip(ref_dicts, prompt_feat)
+        ]
+        return self.prepare_ref_dict(dict(
+            prompt_token=torch.nn.utils.rnn.pad_sequence(prompt_token, batch_first=True),
+            prompt_token_len=torch.tensor(prompt_token_len, device=self.device),
+            prompt_feat=torch.nn.utils.rnn.pad_sequence(prompt_feat, batch_first=True),
+            prompt_feat_len=torch.tensor(prompt_feat_len, device=self.device),
+            embedding=torch.cat([torch.atleast_2d(rd["embedding"]) for rd in ref_dicts]),
+        ))
 
     def forward(
         self,
@@ -176,12 +305,13 @@ class S3Token2Mel(torch.nn.Module):
         # locally-computed ref embedding (mutex with ref_dict)
         ref_wav: Optional[torch.Tensor],
         ref_sr: Optional[int],
-        # pre-computed ref embedding (prod API)
-        ref_dict: Optional[dict] = None,
+        # pre-computed ref embedding (prod API), or one per item of the batch
+        ref_dict: Optional[Union[dict, List[dict]]] = None,
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
         noised_mels=None,
+        return_lens=False,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -190,34 +320,35 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - A batch of utterances takes right-padded tokens with `speech_token_lens`, and either one `ref_dict`
+          shared by all the rows or a list with one `ref_dict` per row.
 
         Args
         ----
-        - `speech_tokens`: S3 speech tokens [B=1, T]
+        - `speech_tokens`: S3 speech tokens [B, T]
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `speech_token_lens`: number of valid tokens of each row [B] (defaults to T)
+        - `return_lens`: also return the number of valid mel frames of each row [B]
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
+        elif isinstance(ref_dict, (list, tuple)):
+            ref_dict = self.collate_ref_dicts(ref_dict)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+            ref_dict = self.cast_ref_dict(ref_dict)
 
         speech_tokens = torch.atleast_2d(speech_tokens)
 
         # backcompat
         if speech_token_lens is None:
             speech_token_lens = torch.LongTensor([st.size(-1) for st in speech_tokens]).to(self.device)
+        speech_token_lens = torch.as_tensor(speech_token_lens, device=self.device)
 
-        output_mels, _ = self.flow.inference(
+        output_mels, output_mel_lens = self.flow.inference(
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
@@ -226,6 +357,8 @@ class S3Token2Mel(torch.nn.Module):
             meanflow=self.meanflow,
             **ref_dict,
         )
+        if return_lens:
+            return output_mels, output_mel_lens
         return output_mels
 
 
@@ -286,7 +419,7 @@ class S3Token2Wav(S3Token2Mel):
         if skip_vocoder:
             return output_mels
 
-        # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
+        # TODO jrm: ignoring the speed control (mel interpolation) for now. (`HiFTStreamer` vocodes in chunks.)
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
 
         output_wavs, *_ = self.mel2wav.inference(speech_feat=output_mels, cache_source=hift_cache_source)
@@ -309,16 +442,17 @@ class S3Token2Wav(S3Token2Mel):
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
+        return_lens=False,
     ):
-        n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
+        n_cfm_timesteps = self.resolve_cfm_timesteps(n_cfm_timesteps)
         noise = None
         if self.meanflow:
-            noise = torch.randn(1, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
-        output_mels = super().forward(
+            B = torch.atleast_2d(speech_tokens).size(0)
+            noise = torch.randn(B, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
+        return super().forward(
             speech_tokens, speech_token_lens=speech_token_lens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict,
-            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise,
+            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise, return_lens=return_lens,
         )
-        return output_mels
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -326,6 +460,21 @@ class S3Token2Wav(S3Token2Mel):
             cache_source = torch.zeros(1, 1, 0).to(device=self.device, dtype=self.dtype)
         return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
 
+    def hift_inference_stream(self, mel_blocks: Iterable[torch.Tensor], **streamer_kwargs) -> Iterator[torch.Tensor]:
+        """
+        Chunked version of `hift_inference`: consumes (B, 80, n) blocks of mels and yields (B, n_samples) waveform
+        chunks as soon as they are final, which join up as if vocoded in one pass. See `HiFTStreamer`.
+        """
+        streamer = HiFTStreamer(self.mel2wav, **streamer_kwargs)
+        blocks = iter(mel_blocks)
+        block = next(blocks, None)
+        while block is not None:
+            next_block = next(blocks, None)
+            wav = streamer.push(block.to(dtype=self.dtype), finalize=next_block is None)
+            if wav.size(1) > 0:
+                yield wav
+            block = next_block
+
     @torch.inference_mode()
     def inference(
         self,
@@ -360,3 +509,173 @@ class S3Token2Wav(S3Token2Mel):
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: torch.Tensor,
+        speech_token_lens: torch.Tensor,
+        ref_dict: Union[dict, List[dict]],
+        n_cfm_timesteps=None,
+    ) -> List[torch.Tensor]:
+        """
+        Batched version of `inference`: renders B utterances, eg. the sentences of a long text or concurrent
+        requests, with a single CFM solve and a single HiFT pass.
+
+        Args
+        ----
+        - `speech_tokens`: right-padded S3 speech tokens [B, T] (see `drop_invalid_tokens_batch`)
+        - `speech_token_lens`: number of valid tokens of each row [B]
+        - `ref_dict`: pre-computed ref embedding shared by all the rows, or a list with one per row
+
+        Returns the B waveforms, each (1, n_i) and cropped to its own length.
+        """
+        output_mels, output_mel_lens = self.flow_inference(
+            speech_tokens,
+            speech_token_lens=speech_token_lens,
+            ref_dict=ref_dict,
+            n_cfm_timesteps=n_cfm_timesteps,
+            finalize=True,
+            return_lens=True,
+        )
+        output_mels = output_mels.to(dtype=self.dtype)
+        output_wavs, _ = self.hift_inference(output_mels, None)
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip (as in `inference`)
+        output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+
+        hop = int(self.mel2wav.f0_upsamp.scale_factor)  # samples per mel frame
+        return [output_wavs[i:i + 1, :n * hop] for i, n in enumerate(output_mel_lens.tolist())]
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        token_blocks: Iterable[torch.Tensor],
+        ref_dict: dict,
+        n_cfm_timesteps=None,
+        **streamer_kwargs,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Streaming version of `inference`: consumes blocks of speech tokens, eg. as T3 samples them, and yields
+        (1, n) waveform chunks as soon as they can be rendered. See `S3GenStreamer` (and its arguments).
+        """
+        streamer = S3GenStreamer(self, ref_dict, n_cfm_timesteps=n_cfm_timesteps, **streamer_kwargs)
+        blocks = iter(token_blocks)
+        block = next(blocks, None)
+        while block is not None:
+            # the last block finalizes the stream
+            next_block = next(blocks, None)
+            wav = streamer.push(block, finalize=next_block is None)
+            if wav.size(1) > 0:
+                yield wav
+            block = next_block
+
+
+class S3GenStreamer:
+    """
+    Incremental token-to-waveform synthesis: `push` takes the next speech tokens of an utterance and returns
+    the audio that can be rendered so far, so that playback can start before the last token is known.
+    Concatenated, the returned chunks make up the utterance.
+
+    Every token is rendered once. The flow encoder and decoder attend over their whole input, so there is no
+    KV cache to carry over; instead, the tokens already rendered are passed back as part of the flow prompt,
+    with their mel frames as conditioning (just like the reference clip), and the flow only generates the
+    frames of the new tokens. That left context is capped at `context_tokens`, so each chunk costs the same
+    however long the utterance gets. Until the stream is finalized, the last `pre_lookahead_len` tokens are
+    held back as lookahead. Each frame gets its noise drawn once, from `generator` if given.
+
+    The mels are vocoded by a `HiFTStreamer`, which holds back the last `vocoder_context` frames (by default,
+    the receptive field of HiFT) as lookahead, so that the chunks join up as if vocoded in one pass.
+
+    NOTE: one streamer per utterance, and not thread-safe.
+    """
+
+    def __init__(
+        self,
+        s3gen: S3Token2Wav,
+        ref_dict: dict,
+        n_cfm_timesteps=None,
+        context_tokens=50,
+        vocoder_context: Optional[int] = None,
+        generator: Optional[torch.Generator] = None,
+    ):
+        self.s3gen = s3gen
+        self.n_cfm_timesteps = s3gen.resolve_cfm_timesteps(n_cfm_timesteps)
+        self.context_tokens = context_tokens
+        self.generator = generator
+        self.device, self.dtype = s3gen.device, s3gen.dtype
+
+        # the ref mels must line up with the ref tokens (2 frames each) for the context to be appended
+        ref_dict = s3gen.cast_ref_dict(ref_dict)
+        n_prompt = min(ref_dict["prompt_token"].size(1), ref_dict["prompt_feat"].size(1) // s3gen.flow.token_mel_ratio)
+        self.prompt_token = ref_dict["prompt_token"][:, :n_prompt].long()
+        self.prompt_feat = ref_dict["prompt_feat"][:, :n_prompt * s3gen.flow.token_mel_ratio]
+        self.embedding = ref_dict["embedding"]
+        self.spk_embedding = ref_dict.get("spk_embedding")  # the prompt mels grow with the context, not this
+
+        self.context_token = torch.zeros(1, 0, dtype=torch.long, device=self.device)  # rendered tokens
+        self.context_feat = torch.zeros(1, 0, 80, dtype=self.dtype, device=self.device)  # and their mels
+        self.pending_tokens = torch.zeros(1, 0, dtype=torch.long, device=self.device)  # not rendered yet
+        self.vocoder = HiFTStreamer(s3gen.mel2wav, context_frames=vocoder_context)
+        self.n_samples = 0  # audio returned so far
+        self.finished = False
+
+    @torch.inference_mode()
+    def push(self, speech_tokens: torch.Tensor, finalize=False) -> torch.Tensor:
+        """
+        Adds (1, n) or (n,) speech tokens to the stream and returns the (1, n_samples) audio ready so far,
+        possibly empty. With `finalize`, the stream is flushed and no more tokens can be pushed.
+        """
+        assert not self.finished, "the stream is already finalized"
+        speech_tokens = torch.atleast_2d(speech_tokens).to(device=self.device, dtype=torch.long)
+        self.pending_tokens = torch.cat([self.pending_tokens, speech_tokens], dim=1)
+        self.finished = finalize
+
+        mels = self._flow(finalize)
+        if mels is None:
+            mels = torch.zeros(1, 80, 0, dtype=self.dtype, device=self.device)
+        wav = self.vocoder.push(mels, finalize=finalize)
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip (as in `inference`)
+        trim_fade = self.s3gen.trim_fade[self.n_samples:self.n_samples + wav.size(1)]
+        if len(trim_fade) > 0:
+            wav[:, :len(trim_fade)] *= trim_fade
+        self.n_samples += wav.size(1)
+        return wav
+
+    def _flow(self, finalize: bool) -> Optional[torch.Tensor]:
+        "Renders the pending tokens (but the lookahead) to mels, with the rendered tokens as left context."
+        flow = self.s3gen.flow
+        tokens = self.pending_tokens
+        n_ready = tokens.size(1) - (0 if finalize else flow.pre_lookahead_len)
+        if n_ready <= 0:
+            return None
+
+        prompt_token = torch.cat([self.prompt_token, self.context_token], dim=1)
+        prompt_feat = torch.cat([self.prompt_feat, self.context_feat], dim=1)
+        noise = torch.randn(
+            1, 80, n_ready * flow.token_mel_ratio, generator=self.generator, device=self.device,
+        ).to(self.dtype)
+        mels, _ = flow.inference(
+            token=tokens,
+            token_len=torch.tensor([tokens.size(1)], device=self.device),
+            prompt_token=prompt_token,
+            prompt_token_len=torch.tensor([prompt_token.size(1)], device=self.device),
+            prompt_feat=prompt_feat,
+            prompt_feat_len=None,
+            embedding=self.embedding,
+            spk_embedding=self.spk_embedding,
+            finalize=finalize,
+            n_timesteps=self.n_cfm_timesteps,
+            noised_mels=noise,
+            meanflow=self.s3gen.meanflow,
+        )
+        mels = mels.to(dtype=self.dtype)
+
+        context_token = torch.cat([self.context_token, tokens[:, :n_ready]], dim=1)
+        context_feat = torch.cat([self.context_feat, mels.transpose(1, 2)], dim=1)
+        n_context = min(self.context_tokens, context_token.size(1))
+        self.context_token = context_token[:, context_token.size(1) - n_context:]
+        self.context_feat = context_feat[:, context_feat.size(1) - n_context * flow.token_mel_ratio:]
+        self.pending_tokens = tokens[:, n_ready:]
+        return mels
@@ -277,7 +277,8 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
-        xs = self.pre_lookahead_layer(xs)
+        # NOTE: zero the padding so that, in a batch, each row looks ahead into zeros past its end (as with B=1)
+        xs = self.pre_lookahead_layer(xs * mask_pad.transpose(1, 2))
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         # upsample + conformer encoder
@@ -0,0 +1,91 @@
+"""
+Fixed-step ODE solvers for the CFM decoder, which integrates dx/dt = v(x, t) from noise (t=0) to mels (t=1).
+
+A solver only evaluates the velocity at time points (`nodes`) known before the solve starts, so that the estimator
+can build all their time embeddings up front (see `EstimatorPlan`): `velocity(x, k)` is v(x, nodes[k]).
+Higher-order solvers reach the accuracy of Euler with fewer (or cheaper) steps; the cost of a solve is the number
+of velocity evaluations, ie. estimator calls.
+"""
+import torch
+
+
+class ODESolver:
+    "Integrates over `t_span` (n_steps + 1,), calling `velocity(x, k)` at the k-th of `nodes(t_span)`."
+
+    # estimator calls per step
+    evals_per_step = 1
+
+    def nodes(self, t_span: torch.Tensor) -> torch.Tensor:
+        return t_span[:-1]
+
+    def solve(self, velocity, x: torch.Tensor, t_span: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class EulerSolver(ODESolver):
+    "First order."
+
+    def solve(self, velocity, x, t_span):
+        for k, dt in enumerate(t_span[1:] - t_span[:-1]):
+            x = x + dt * velocity(x, k)
+        return x
+
+
+class MidpointSolver(ODESolver):
+    "Second order, explicit midpoint (RK2): the velocity halfway through the step."
+
+    evals_per_step = 2
+
+    def nodes(self, t_span):
+        t, r = t_span[:-1], t_span[1:]
+        return torch.stack([t, (t + r) / 2], dim=1).flatten()
+
+    def solve(self, velocity, x, t_span):
+        for i, dt in enumerate(t_span[1:] - t_span[:-1]):
+            x_mid = x + dt / 2 * velocity(x, 2 * i)
+            x = x + dt * velocity(x_mid, 2 * i + 1)
+        return x
+
+
+class HeunSolver(ODESolver):
+    "Second order, Heun's method: the mean of the velocities at both ends of an Euler step."
+
+    evals_per_step = 2
+
+    def nodes(self, t_span):
+        return torch.stack([t_span[:-1], t_span[1:]], dim=1).flatten()
+
+    def solve(self, velocity, x, t_span):
+        for i, dt in enumerate(t_span[1:] - t_span[:-1]):
+            v = velocity(x, 2 * i)
+            v_end = velocity(x + dt * v, 2 * i + 1)
+            x = x + dt / 2 * (v + v_end)
+        return x
+
+
+class MultistepSolver(ODESolver):
+    """
+    Second order at the cost of Euler, in the spirit of DPM-Solver++(2M): the velocity of the previous step is
+    reused to extrapolate over the current one (2-step Adams-Bashforth, for non-uniform steps). The first step
+    is an Euler step.
+    """
+
+    def solve(self, velocity, x, t_span):
+        v_prev = dt_prev = None
+        for k, dt in enumerate(t_span[1:] - t_span[:-1]):
+            v = velocity(x, k)
+            if v_prev is None:
+                x = x + dt * v
+            else:
+                x = x + dt * (v + dt / (2 * dt_prev) * (v - v_prev))
+            v_prev, dt_prev = v, dt
+        return x
+
+
+# solvers by name, for `CausalConditionalCFM.ode_solver` (or `S3Token2Mel.set_ode_solver`)
+ODE_SOLVERS = {
+    "euler": EulerSolver(),
+    "midpoint": MidpointSolver(),
+    "heun": HeunSolver(),
+    "multistep": MultistepSolver(),
+}
@@ -105,13 +105,19 @@ class S3Tokenizer(S3TokenizerV2):
         NOTE: please pad the waveform if longer sequence is needed.
         """
         processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
+
+        # wavs of the same length (eg. reference clips cropped to the same duration) get their mels in one batch
+        groups = {}
+        for i, wav in enumerate(processed_wavs):
+            groups.setdefault(wav.shape[-1], []).append(i)
+        mels = [None] * len(processed_wavs)
+        for idxs in groups.values():
+            batch = torch.cat([processed_wavs[i] for i in idxs]).to(self.device)
+            mel = self.log_mel_spectrogram(batch)  # [B, F, T]
             if max_len is not None:
                 mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
+            for i, m in zip(idxs, mel):
+                mels[i] = m
 
         mels, mel_lens = padding(mels)
         if accelerator is None:
@@ -135,16 +141,16 @@ class S3Tokenizer(S3TokenizerV2):
 
         Parameters
         ----------
-        audio: torch.Tensor, shape = (*)
+        audio: torch.Tensor, shape = (*, n_samples)
             The path to audio or either a NumPy array or Tensor containing the
-            audio waveform in 16 kHz
+            audio waveform(s) in 16 kHz
 
         padding: int
             Number of zero samples to pad to the right
 
         Returns
         -------
-        torch.Tensor, shape = (128, n_frames)
+        torch.Tensor, shape = (*, 128, n_frames)
             A Tensor that contains the Mel spectrogram
         """
         if not torch.is_tensor(audio):
@@ -163,6 +169,7 @@ class S3Tokenizer(S3TokenizerV2):
         mel_spec = self._mel_filters.to(self.device) @ magnitudes
 
         log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        # (per wav, if batched)
+        log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
         log_spec = (log_spec + 4.0) / 4.0
         return log_spec
@@ -2,9 +2,10 @@
 # Author: John Meade, Jeremy Hsu
 # MIT License
 import logging
+import threading
 import torch
 from dataclasses import dataclass
-from types import MethodType
+from typing import Callable, Optional
 
 
 logger = logging.getLogger(__name__)
@@ -29,150 +30,273 @@ class AlignmentAnalysisResult:
     position: int
 
 
+class AttentionRecording:
+    """
+    Scope of the forward passes an attention spy records: those run inside a `with recording:` block, on the
+    thread that entered it. Forward passes of other threads decoding on the same model are left untouched,
+    while a generator may still resume on a different thread between two blocks.
+    """
+
+    def __init__(self):
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._thread = None
+
+    def __call__(self) -> bool:
+        return self._thread == threading.get_ident()
+
+
+def add_attention_spy(tfmr, layer_idx, on_attention, is_active: Optional[Callable[[], bool]]=None):
+    """
+    Makes `tfmr.layers[layer_idx]` compute its attention weights and passes them, shaped (B, n_heads, T0, Ti),
+    to `on_attention` after every forward. Only that layer falls back to the eager attention implementation;
+    the model is still called with `output_attentions=False`, so every other layer keeps the SDPA kernel and
+    the weights are never collected into the model outputs.
+
+    With `is_active` set (eg. an `AttentionRecording`), forward passes for which it returns False are left untouched.
+    Returns the hook handles; call `.remove()` on each to detach the spy.
+    """
+    def attention_forward_pre_hook(module, args, kwargs):
+        if is_active is not None and not is_active():
+            return None
+        kwargs["output_attentions"] = True
+        # SDPA layers get no mask when `is_causal` can stand in for it, but the eager fallback needs one
+        hidden_states = kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
+        T0 = hidden_states.size(1)
+        if kwargs.get("attention_mask") is None and T0 > 1:
+            cache_position = kwargs.get("cache_position")
+            n_past = int(cache_position[0]) if cache_position is not None else 0
+            kwargs["attention_mask"] = _causal_mask(T0, n_past, hidden_states.dtype, hidden_states.device)
+        return args, kwargs
+
+    def attention_forward_hook(module, input, output):
+        """
+        See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
+        NOTE:
+        - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
+        - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+        """
+        if is_active is not None and not is_active():
+            return
+        if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
+            on_attention(output[1])
+
+    target_layer = tfmr.layers[layer_idx].self_attn
+    return [
+        target_layer.register_forward_pre_hook(attention_forward_pre_hook, with_kwargs=True),
+        target_layer.register_forward_hook(attention_forward_hook),
+    ]
+
+
+def _causal_mask(T0, n_past, dtype, device):
+    "Additive (1, 1, T0, n_past + T0) causal mask for `T0` new positions after `n_past` cached ones."
+    mask = torch.full((T0, n_past + T0), torch.finfo(dtype).min, dtype=dtype, device=device)
+    return mask.triu(diagonal=n_past + 1)[None, None]
+
+
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, tfmr, queue, text_tokens_slice=None, alignment_layer_idx=9, eos_idx=0):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
         A hook is injected into the specified attention layer, and heuristics are used to determine alignment
         position, repetition, etc.
 
+        The analyzer is meant to be long-lived (eg. one per `T3InferenceState`): call `reset` before each
+        generation and `remove` after it. The alignment matrix is kept in a preallocated buffer on the attention
+        device, and the heuristics are evaluated there too, so `step` never waits for the GPU.
+
         NOTE: currently requires no queues.
+        NOTE: the hooks only record the forward passes run inside `with analyzer.recording:` (see
+        `T3HuggingfaceBackend.forward`), so that concurrent `T3.inference` calls sharing one `tfmr` don't write into
+        each other's buffers, whichever thread resumes a streaming generation.
+        NOTE: with `tfmr=None` no hooks are added, and the caller fills `last_aligned_attns` itself before each
+        `step` (eg. from a batched forward pass, see `T3BatchScheduler`).
         """
         # self.queue = queue
-        self.text_tokens_slice = (i, j) = text_tokens_slice
+        self.tfmr = tfmr
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
-        # self.alignment_bin = torch.zeros(0, j-i)
+
+        # (max_frames, max_text_len) buffer; only `alignment[:T, :S]` is valid for the current generation
+        self._alignment_buffer = None
+        self._max_frames = 0
+
+        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
+        # using it for all layers slows things down too much. We apply it to just the aligned layers
+        # by intercepting their kwargs and adding a forward hook (credit: jrm), see `add_attention_spy`
+        self.recording = AttentionRecording()
+        self.hook_handles = []
+        self.last_aligned_attns = [None] * len(LLAMA_ALIGNED_HEADS)
+
+        if text_tokens_slice is not None:
+            self.reset(text_tokens_slice)
+
+    def reset(self, text_tokens_slice, max_frames=0, prefill_offset=0):
+        """
+        Prepares the analyzer for a new generation, and attaches the attention hooks if they are not attached yet.
+
+        Args:
+            text_tokens_slice: (start, end) positions of the text tokens in the prefill sequence.
+            max_frames: expected number of alignment rows (prefill speech positions + new tokens); the buffer
+                grows on demand if this is exceeded.
+            prefill_offset: position of the first query of the first forward pass, when the positions before
+                it come from a cache (eg. a prefilled conditioning prefix).
+        """
+        self.text_tokens_slice = text_tokens_slice
+        self.prefill_offset = prefill_offset
+        self.T = 0  # number of valid rows in the alignment buffer
+        self._max_frames = max(max_frames, 1)
         self.curr_frame_pos = 0
-        self.text_position = 0
 
-        self.started = False
+        # heuristic state, kept as device tensors (created on the first `step`, where the device is known)
+        self.text_position = None
+        self.started = None
         self.started_at = None
-
-        self.complete = False
+        self.complete = None
         self.completed_at = None
-        
-        # Track generated tokens for repetition detection
-        self.generated_tokens = []
+        self.forced_eos = None  # (3,) was EOS forced because of: long tail, alignment repetition, token repetition
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
-        self.last_aligned_attns = []
-        for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
-            self.last_aligned_attns += [None]
-            self._add_attention_spy(tfmr, i, layer_idx, head_idx)
+        # Track the last two generated tokens for repetition detection
+        self.n_tokens = 0
+        self.last_tokens = None
+
+        self.last_aligned_attns = [None] * len(LLAMA_ALIGNED_HEADS)
+        if self.tfmr is not None and not self.hook_handles:
+            for buffer_idx, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
+                self._add_attention_spy(self.tfmr, buffer_idx, layer_idx, head_idx)
 
     def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
         """
         Adds a forward hook to a specific attention layer to collect outputs.
         """
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
-
-        target_layer = tfmr.layers[layer_idx].self_attn
-        # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        def on_attention(attn_weights):
+            # (B, n_heads, T0, Ti) -> (T0, Ti): only the aligned head of the first (conditional) row is kept
+            self.last_aligned_attns[buffer_idx] = attn_weights[0, head_idx]
+
+        self.hook_handles += add_attention_spy(tfmr, layer_idx, on_attention, is_active=self.recording)
+
+    def remove(self):
+        """Detaches the attention hooks from the transformer."""
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+
+    def log_forced_eos(self):
+        "Logs why EOS was forced during the last generation, if it was (synchronizes with the device)."
+        if self.forced_eos is None or not self.forced_eos.any():
+            return
+        long_tail, alignment_repetition, token_repetition = self.forced_eos.tolist()
+        logger.warning(f"forced EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
+
+    def _init_device_state(self, device):
+        i, j = self.text_tokens_slice
+        rows, cols = self._max_frames, j - i
+        buf = self._alignment_buffer
+        if buf is None or buf.device != device or buf.size(0) < rows or buf.size(1) < cols:
+            rows, cols = max(rows, 0 if buf is None else buf.size(0)), max(cols, 0 if buf is None else buf.size(1))
+            self._alignment_buffer = torch.zeros(rows, cols, device=device)
+        zero = torch.zeros((), dtype=torch.long, device=device)
+        self.text_position = zero
+        self.started = torch.zeros((), dtype=torch.bool, device=device)
+        self.started_at = zero - 1  # -1: not yet
+        self.complete = torch.zeros((), dtype=torch.bool, device=device)
+        self.completed_at = zero - 1
+        self.forced_eos = torch.zeros(3, dtype=torch.bool, device=device)
+        self.last_tokens = torch.full((2,), -1, dtype=torch.long, device=device)
+
+    def _append(self, A_chunk):
+        "Writes the rows of `A_chunk` (n, S) after the current `T` rows of the alignment buffer, growing it if needed."
+        n, S = A_chunk.shape
+        buf = self._alignment_buffer
+        if self.T + n > buf.size(0):
+            grown = torch.zeros(max(2 * buf.size(0), self.T + n), buf.size(1), device=buf.device)
+            grown[:self.T] = buf[:self.T]
+            self._alignment_buffer = buf = grown
+        buf[self.T:self.T + n, :S] = A_chunk
+        self.T += n
 
     def step(self, logits, next_token=None):
         """
         Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+        `next_token` (the last generated token) may be an int or a device tensor.
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
         aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
+        if self.text_position is None:
+            self._init_device_state(aligned_attn.device)
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            A_chunk = aligned_attn[j - self.prefill_offset:, i:j] # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
-
-        # TODO: monotonic masking; could have issue b/c spaces are often skipped.
-        A_chunk[:, self.curr_frame_pos + 1:] = 0
+            A_chunk = aligned_attn[:, i:j] # (1, S)
 
+        self._append(A_chunk)
 
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
-
-        A = self.alignment
-        T, S = A.shape
+        # TODO: monotonic masking; could have issue b/c spaces are often skipped.
+        S = j - i
+        T = self.T
+        A = self._alignment_buffer[:T, :S]
+        A[T - A_chunk.size(0):, self.curr_frame_pos + 1:] = 0
 
         # update position
-        cur_text_posn = A_chunk[-1].argmax()
-        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
-        if not discontinuity:
-            self.text_position = cur_text_posn
+        cur_text_posn = A[-1].argmax()
+        step_size = cur_text_posn - self.text_position
+        discontinuity = (step_size <= -4) | (step_size >= 7) # NOTE: very lenient!
+        self.text_position = torch.where(discontinuity, self.text_position, cur_text_posn)
 
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
+        false_start = ~self.started & ((A[-2:, -2:].max() > 0.1) | (A[:, :4].max() < 0.5))
+        self.started = ~false_start
+        self.started_at = torch.where(self.started & (self.started_at < 0), T, self.started_at)
 
         # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
+        self.complete = self.complete | (self.text_position >= S - 3)
+        self.completed_at = torch.where(self.complete & (self.completed_at < 0), T, self.completed_at)
 
-        # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
+        # rows since completion, ie. `A[completed_at:]` (none before completion)
+        after_completion = (torch.arange(T, device=A.device) >= self.completed_at) & self.complete
+        A_after = A * after_completion[:, None]
 
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        long_tail = A_after[:, -3:].sum(dim=0).max() >= 5 # 200ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
-        
+        alignment_repetition = A_after[:, :-5].max(dim=1).values.sum() > 5 if S > 5 else torch.zeros_like(long_tail)
+
         # Track generated tokens for repetition detection
         if next_token is not None:
-            # Convert tensor to scalar if needed
             if isinstance(next_token, torch.Tensor):
-                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
+                token_id = next_token.reshape(-1)[:1].to(self.last_tokens.device)
             else:
-                token_id = next_token
-            self.generated_tokens.append(token_id)
-            
-            # Keep only last 8 tokens to prevent memory issues
-            if len(self.generated_tokens) > 8:
-                self.generated_tokens = self.generated_tokens[-8:]
-            
-        # Check for excessive token repetition (3x same token in a row)
-        token_repetition = (
-            # self.complete and 
-            len(self.generated_tokens) >= 3 and
-            len(set(self.generated_tokens[-2:])) == 1
-        )
-        
-        if token_repetition:
-            repeated_token = self.generated_tokens[-1]
-            logger.warning(f"🚨 Detected 2x repetition of token {repeated_token}")
-            
+                token_id = torch.full((1,), next_token, dtype=torch.long, device=self.last_tokens.device)
+            self.last_tokens = torch.cat([self.last_tokens[1:], token_id])
+            self.n_tokens += 1
+
+        # Check for excessive token repetition (the last 2 tokens are the same)
+        token_repetition = (self.last_tokens[0] == self.last_tokens[1]) & (self.n_tokens >= 3)
+
         # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3 and S > 5:  # Only suppress if text is longer than 5 tokens
-            logits[..., self.eos_idx] = -2**15
+        if S > 5:  # Only suppress if text is longer than 5 tokens
+            suppress = cur_text_posn < S - 3
+            logits[..., self.eos_idx] = torch.where(suppress, -2**15, logits[..., self.eos_idx])
 
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or alignment_repetition or token_repetition:
-            logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
-            logits[..., self.eos_idx] = 2**15
+        reasons = torch.stack([long_tail, alignment_repetition, token_repetition])
+        self.forced_eos = self.forced_eos | reasons
+        # (±2**15 is safe for all dtypes >= 16bit)
+        eos_logits = -(2**15) * torch.ones_like(logits)
+        eos_logits[..., self.eos_idx] = 2**15
+        logits = torch.where(reasons.any(), eos_logits, logits)
 
         self.curr_frame_pos += 1
         return logits
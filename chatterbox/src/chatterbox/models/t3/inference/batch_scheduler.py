@@ -0,0 +1,368 @@
+import logging
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from queue import Queue, Empty
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+from .cfg_schedule import CFGSchedule
+from .alignment_stream_analyzer import (
+    AlignmentStreamAnalyzer, AttentionRecording, LLAMA_ALIGNED_HEADS, add_attention_spy,
+)
+from .sampler import sample_next_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Sequence:
+    """A request admitted to (or waiting for) the running batch."""
+    future: Future
+    t3_cond: Optional[T3Cond]  # dropped once prefilled
+    text_tokens: Optional[Tensor]  # (2, n_text) as for `T3.inference`; dropped once prefilled
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+    min_p: float
+    repetition_penalty: float
+    cfg_weight: float
+    cfg_schedule: Optional[CFGSchedule]
+    generator: Optional[torch.Generator]
+    analyzer: Optional[AlignmentStreamAnalyzer] = None
+    token_counts: Optional[Tensor] = None  # (1, V) tokens generated so far (incl. BOS), for the repetition penalty
+    predicted: List[Tensor] = field(default_factory=list)
+    length: int = 0  # number of real (non-padding) positions of this sequence in the KV cache
+    cfg_dropped: bool = False  # the schedule turned CFG off and the uncond row was evicted
+
+    @property
+    def n_rows(self):
+        # cond + uncond rows with CFG
+        return 2 if self.cfg_weight > 0.0 and not self.cfg_dropped else 1
+
+    def drops_cfg(self) -> bool:
+        "Whether the uncond row should be evicted before the next step."
+        return self.n_rows == 2 and self.cfg_schedule is not None and not self.cfg_schedule.keep_cfg(
+            len(self.predicted), self.analyzer,
+        )
+
+
+class T3BatchScheduler:
+    """
+    Continuous batching for `T3.inference`: requests submitted from any thread are decoded together by a
+    single background thread, so every step is one wide forward pass instead of one narrow pass per request.
+
+    `submit` only queues a request: its conditioning prefix (see `T3.conditioning_prefix`), embeddings and prefill
+    all run on the decode thread, so no request puts work on the model from its own thread. New requests are
+    prefilled on their own and then merged into the running batch; finished ones (EOS or `max_new_tokens`) are
+    retired at the end of each step. The batch KV cache is left-padded to a common length,
+    with an attention mask hiding the padding, and each row carries its own position ids, so a sequence
+    decodes exactly as it would alone. Sampling parameters, CFG weight, RNG and the alignment analyzer
+    (multilingual models) are per request.
+
+    NOTE: only the Llama backbone is supported; `submit` mirrors the arguments of `T3.inference`.
+    """
+
+    def __init__(self, t3, max_batch_size=8):
+        assert not t3.is_gpt, "T3BatchScheduler only supports the Llama backbone"
+        self.t3 = t3
+        self.max_batch_size = max_batch_size
+        self._queue = Queue()
+        self._active: List[_Sequence] = []
+        self._cache: Optional[DynamicCache] = None
+        self._mask: Optional[Tensor] = None  # (n_rows, T) 1 for real positions, 0 for left padding
+        self._aligned_attns: List[Optional[Tensor]] = [None] * len(LLAMA_ALIGNED_HEADS)  # (B, T0, Ti) per head
+        self._recording = AttentionRecording()  # scope of the forward passes whose aligned heads are captured
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="t3-batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        max_new_tokens=None,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        cfg_schedule: Optional[CFGSchedule]=None,
+        generator: Optional[torch.Generator]=None,
+    ) -> Future:
+        """
+        Queues a request and returns a `Future` resolving to the predicted speech tokens, shape (1, num_tokens),
+        like the output of `T3.inference`. `text_tokens` are prepared as for `T3.inference` (two rows for CFG).
+        """
+        assert not self._closed, "scheduler is closed"
+        hp = self.t3.hp
+        if cfg_schedule is not None:
+            cfg_schedule.validate(has_alignment_analyzer=hp.is_multilingual)
+        seq = _Sequence(
+            future=Future(),
+            t3_cond=t3_cond,
+            text_tokens=torch.atleast_2d(text_tokens),
+            max_new_tokens=max_new_tokens or hp.max_speech_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            generator=generator,
+        )
+        self._queue.put(seq)
+        return seq.future
+
+    def close(self):
+        """Stops the decode thread once the queued requests are done."""
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        # the aligned heads are captured for the batch forward passes only, and only for models that use the analyzer
+        hook_handles = []
+        if self.t3.hp.is_multilingual:
+            for i, (layer_idx, _) in enumerate(LLAMA_ALIGNED_HEADS):
+                hook_handles += add_attention_spy(
+                    self.t3.tfmr, layer_idx, self._attention_recorder(i), is_active=self._recording,
+                )
+        try:
+            with torch.inference_mode():
+                while True:
+                    # block only when there is nothing to decode
+                    if not self._admit(block=len(self._active) == 0):
+                        break
+                    if not self._active:
+                        continue
+                    try:
+                        self._step()
+                    except Exception as e:
+                        logger.exception("T3 batch step failed")
+                        self._fail_all(e)
+        finally:
+            for handle in hook_handles:
+                handle.remove()
+
+    def _attention_recorder(self, i: int):
+        head_idx = LLAMA_ALIGNED_HEADS[i][1]
+
+        def record(attn_weights):
+            self._aligned_attns[i] = attn_weights[:, head_idx]  # (B, T0, Ti)
+        return record
+
+    def _admit(self, block: bool) -> bool:
+        "Prefills queued requests and merges them into the batch. Returns False once closed."
+        while len(self._active) < self.max_batch_size:
+            try:
+                seq = self._queue.get(block=block)
+            except Empty:
+                return True
+            if seq is None:
+                return False
+            block = False
+            if not seq.future.set_running_or_notify_cancel():
+                continue
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                logger.exception("T3 prefill failed")
+                seq.future.set_exception(e)
+        return True
+
+    def _prefill(self, seq: _Sequence):
+        t3, hp = self.t3, self.t3.hp
+        text_tokens = seq.text_tokens.to(dtype=torch.long, device=t3.device)
+        initial_speech_tokens = hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+
+        # the conditioning prefix is prefilled once per voice (see `T3.conditioning_prefix`)
+        prefix = t3.conditioning_prefix(seq.t3_cond)
+        len_cond = prefix.length
+        embeds = t3.prepare_text_speech_embeds(
+            text_tokens=text_tokens,
+            speech_tokens=initial_speech_tokens,
+            cfg_weight=seq.cfg_weight,
+        )
+        bos_token = torch.tensor([[hp.start_speech_token]], dtype=torch.long, device=embeds.device)
+        bos_embed = t3.speech_emb(bos_token) + t3.speech_pos_emb.get_fixed_embedding(0)
+        # the uncond row is only needed with CFG, otherwise both rows are identical
+        inputs_embeds = torch.cat([embeds, bos_embed.expand(embeds.size(0), -1, -1)], dim=1)[:seq.n_rows]
+        seq.t3_cond, seq.text_tokens = None, None
+
+        if hp.is_multilingual:
+            seq.analyzer = AlignmentStreamAnalyzer(None, None, eos_idx=hp.stop_speech_token)
+            len_text_end = len_cond + text_tokens.size(-1)
+            seq.analyzer.reset(
+                text_tokens_slice=(len_cond, len_text_end),
+                max_frames=len_cond + inputs_embeds.size(1) - len_text_end + seq.max_new_tokens,
+                prefill_offset=len_cond,
+            )
+        seq.token_counts = torch.zeros(1, hp.speech_tokens_dict_size, dtype=torch.int32, device=embeds.device)
+        seq.token_counts[0, hp.start_speech_token] = 1
+
+        with self._recording:
+            out = t3.tfmr(
+                inputs_embeds=inputs_embeds,
+                past_key_values=prefix.to_dynamic_cache(seq.n_rows),
+                use_cache=True,
+                return_dict=True,
+            )
+        seq.length = len_cond + inputs_embeds.size(1)
+        if seq.analyzer is not None:
+            self._feed_analyzer(seq, row=0, start=0)
+        logits = t3.speech_head(out.last_hidden_state[:, -1])  # (n_rows, V)
+
+        if self._sample([seq], [logits])[0]:
+            self._finish(seq)
+            return
+
+        # merge the new KV cache into the batch, left-padding whichever is shorter
+        new_cache = out.past_key_values.to_legacy_cache()
+        if seq.drops_cfg():
+            seq.cfg_dropped = True
+            new_cache = tuple((k[:1], v[:1]) for k, v in new_cache)
+        new_mask = torch.ones(seq.n_rows, seq.length, dtype=torch.long, device=logits.device)
+        if self._cache is None:
+            self._cache = DynamicCache.from_legacy_cache(new_cache)
+            self._mask = new_mask
+        else:
+            T = max(self._mask.size(1), seq.length)
+            pad_old, pad_new = T - self._mask.size(1), T - seq.length
+            self._cache = DynamicCache.from_legacy_cache(tuple(
+                tuple(torch.cat([_left_pad(a, pad_old), _left_pad(b, pad_new)]) for a, b in zip(old, new))
+                for old, new in zip(self._cache.to_legacy_cache(), new_cache)
+            ))
+            self._mask = torch.cat([F.pad(self._mask, (pad_old, 0)), F.pad(new_mask, (pad_new, 0))])
+        self._active.append(seq)
+
+    def _step(self):
+        t3 = self.t3
+        device = self._mask.device
+
+        # embed the last sampled token of every sequence (duplicated for CFG rows)
+        tokens, pos_idx, position_ids = [], [], []
+        for seq in self._active:
+            tokens += [seq.predicted[-1]] * seq.n_rows
+            pos_idx += [len(seq.predicted)] * seq.n_rows
+            position_ids += [seq.length] * seq.n_rows
+            seq.length += 1
+        tokens = torch.cat(tokens)  # (B, 1)
+        pos_idx = torch.tensor(pos_idx, device=device)[:, None]
+        position_ids = torch.tensor(position_ids, device=device)[:, None]
+        inputs_embeds = t3.speech_emb(tokens) + t3.speech_pos_emb.get_fixed_embedding(pos_idx)
+
+        self._mask = F.pad(self._mask, (0, 1), value=1)
+        with self._recording:
+            out = t3.tfmr(
+                inputs_embeds=inputs_embeds,
+                past_key_values=self._cache,
+                attention_mask=self._mask,
+                position_ids=position_ids,
+                use_cache=True,
+                return_dict=True,
+            )
+        self._cache = out.past_key_values
+        logits = t3.speech_head(out.last_hidden_state[:, -1])  # (B, V)
+
+        row, seq_logits = 0, []
+        T = self._mask.size(1)
+        for seq in self._active:
+            if seq.analyzer is not None:
+                self._feed_analyzer(seq, row=row, start=T - seq.length)
+            seq_logits.append(logits[row:row + seq.n_rows])
+            row += seq.n_rows
+
+        row, keep, finished, dropped = 0, [], [], False
+        for seq, done in zip(self._active, self._sample(self._active, seq_logits)):
+            n_rows = seq.n_rows
+            if done:
+                finished.append(seq)
+            elif seq.drops_cfg():
+                seq.cfg_dropped = dropped = True
+                keep.append(row)
+            else:
+                keep += range(row, row + n_rows)
+            row += n_rows
+
+        if finished or dropped:
+            for seq in finished:
+                self._finish(seq)
+            self._active = [seq for seq in self._active if seq not in finished]
+            self._retire(torch.tensor(keep, dtype=torch.long, device=device))
+
+    def _retire(self, keep: Tensor):
+        "Drops the rows of finished sequences and evicted CFG rows, and the padding columns no remaining row needs."
+        if len(keep) == 0:
+            self._cache, self._mask = None, None
+            return
+        mask = self._mask[keep]
+        start = int(mask.any(dim=0).int().argmax())
+        self._cache = DynamicCache.from_legacy_cache(tuple(
+            (k[keep, :, start:], v[keep, :, start:]) for k, v in self._cache.to_legacy_cache()
+        ))
+        self._mask = mask[:, start:]
+
+    @staticmethod
+    def _finish(seq: _Sequence):
+        if seq.analyzer is not None:
+            seq.analyzer.log_forced_eos()
+        seq.future.set_result(torch.cat(seq.predicted, dim=1))
+
+    def _fail_all(self, e: Exception):
+        for seq in self._active:
+            seq.future.set_exception(e)
+        self._active = []
+        self._cache, self._mask = None, None
+
+    def _feed_analyzer(self, seq: _Sequence, row: int, start: int):
+        "Hands the aligned heads of `row` (without its left padding) from the last forward to the sequence's analyzer."
+        for i, attn in enumerate(self._aligned_attns):
+            seq.analyzer.last_aligned_attns[i] = attn[row, :, start:]
+
+    def _sample(self, seqs: List[_Sequence], logits: List[Tensor]) -> List[bool]:
+        """
+        Samples the next token of each sequence from its (n_rows, V) logits, in one batched sampler call.
+        Returns, per sequence, whether it is done.
+        """
+        combined = []
+        for seq, seq_logits in zip(seqs, logits):
+            # CFG combine  → (1, V)
+            cond = seq_logits[0:1]
+            if seq.n_rows == 2:
+                uncond = seq_logits[1:2]
+                cond = cond + seq.cfg_weight * (cond - uncond)
+            if seq.analyzer is not None:
+                last_token = seq.predicted[-1] if seq.predicted else self.t3.hp.start_speech_token
+                cond = seq.analyzer.step(cond, next_token=last_token)
+            combined.append(cond)
+
+        next_tokens = sample_next_tokens(
+            torch.cat(combined),
+            torch.cat([seq.token_counts for seq in seqs]),
+            temperature=[seq.temperature for seq in seqs],
+            top_p=[seq.top_p for seq in seqs],
+            min_p=[seq.min_p for seq in seqs],
+            repetition_penalty=[float(seq.repetition_penalty) for seq in seqs],
+            generators=[seq.generator for seq in seqs],
+        )  # (n_seqs, 1)
+
+        done = []
+        is_eos = (next_tokens.view(-1) == self.t3.hp.stop_speech_token).tolist()  # the only host sync
+        for seq, next_token, eos in zip(seqs, next_tokens.split(1), is_eos):
+            seq.predicted.append(next_token)
+            seq.token_counts[0, next_token[0, 0]] += 1
+            done.append(eos or len(seq.predicted) >= seq.max_new_tokens)
+        return done
+
+
+def _left_pad(x: Tensor, n: int) -> Tensor:
+    "Left-pads the sequence dim of a (B, H, T, D) KV tensor with `n` zero positions."
+    return F.pad(x, (0, 0, n, 0)) if n > 0 else x
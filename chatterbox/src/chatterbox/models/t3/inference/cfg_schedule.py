@@ -0,0 +1,81 @@
+import copy
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+from transformers import Cache, StaticCache
+
+
+@dataclass(frozen=True)
+class CFGSchedule:
+    """
+    When classifier-free guidance is applied during T3 decoding. CFG doubles the decode batch (a conditional and
+    an unconditional row), but mostly matters early on, while the model settles on the voice and the alignment.
+    Once the schedule turns CFG off, the unconditional row is dropped and decoding continues at batch 1.
+
+    CFG stays on while any enabled criterion asks for it; with no criterion it is never turned off (the default
+    behavior, same as passing no schedule).
+
+    `max_tokens` works with every model. `until_started` needs the alignment analyzer, which only the multilingual
+    model runs: on English models a schedule using it is rejected (see `validate`) rather than silently ignored.
+    """
+
+    # apply CFG to the first `max_tokens` generated tokens
+    max_tokens: Optional[int] = None
+
+    # apply CFG while the alignment analyzer reports a false start (multilingual models only)
+    until_started: bool = False
+
+    @classmethod
+    def parse(cls, spec: str) -> "CFGSchedule":
+        """
+        Builds a schedule from a short spec, eg. for CLIs and env vars:
+        "always", "first:<N>", "until_started", or both criteria joined with "+" ("first:30+until_started").
+        """
+        max_tokens, until_started = None, False
+        for part in spec.strip().lower().split("+"):
+            if part == "always":
+                continue
+            elif part.startswith("first:"):
+                max_tokens = int(part.split(":", 1)[1])
+            elif part == "until_started":
+                until_started = True
+            else:
+                raise ValueError(f"Invalid CFG schedule {spec!r}")
+        return cls(max_tokens=max_tokens, until_started=until_started)
+
+    def validate(self, has_alignment_analyzer: bool):
+        "Raises a `ValueError` if this schedule cannot run on a model with(out) an alignment analyzer."
+        if self.until_started and not has_alignment_analyzer:
+            raise ValueError(
+                "CFGSchedule(until_started=True) needs the alignment analyzer of the multilingual model, "
+                "use max_tokens (\"first:<N>\") instead"
+            )
+
+    def keep_cfg(self, n_generated: int, alignment_stream_analyzer=None) -> bool:
+        """
+        Whether the next decode step still needs the unconditional row, after `n_generated` tokens.
+        NOTE: with `until_started`, this reads the analyzer state on the host once per step until CFG is off.
+        """
+        wants_cfg = []
+        if self.max_tokens is not None:
+            wants_cfg.append(n_generated < self.max_tokens)
+        if self.until_started and alignment_stream_analyzer is not None and alignment_stream_analyzer.started is not None:
+            wants_cfg.append(not bool(alignment_stream_analyzer.started))
+        return any(wants_cfg) if wants_cfg else True
+
+
+def drop_uncond_row(cache: Cache) -> Cache:
+    """
+    Keeps only the first (conditional) row of a CFG batch KV cache.
+    A `StaticCache` is narrowed through views, so its buffers stay allocated for the next request of the worker;
+    a `DynamicCache` belongs to the call and is sliced in place.
+    """
+    if isinstance(cache, StaticCache):
+        cond_cache = copy.copy(cache)
+        cond_cache.key_cache = [k[:1] for k in cache.key_cache]
+        cond_cache.value_cache = [v[:1] for v in cache.value_cache]
+        cond_cache.batch_size = 1
+        return cond_cache
+    cache.batch_select_indices(torch.tensor([0], device=cache.key_cache[0].device))
+    return cache
@@ -0,0 +1,98 @@
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from transformers import StaticCache
+
+from .alignment_stream_analyzer import AlignmentStreamAnalyzer
+
+
+# static KV caches are allocated in multiples of this many positions, so that consecutive requests of similar
+# length can reuse the same buffers
+STATIC_CACHE_BUCKET = 256
+
+
+@dataclass
+class T3InferenceState:
+    """
+    Mutable decoding state owned by one worker thread.
+
+    `T3` itself only holds read-only weights, so several workers can decode on the same module concurrently
+    as long as each passes its own state. Everything that is written during a generation lives here or is
+    local to the `T3.inference` call.
+    """
+
+    # RNG used for sampling, so that workers neither share nor reseed the global torch RNG (None: use the global one)
+    generator: Optional[torch.Generator] = None
+
+    # preallocated KV cache, kept between the `T3.inference` calls of this worker
+    kv_cache: Optional[StaticCache] = None
+    kv_cache_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    # alignment analyzer of multilingual models, reset for every generation instead of rebuilt
+    analyzer: Optional[AlignmentStreamAnalyzer] = None
+    analyzer_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def create(cls, device="cpu", seed: Optional[int] = None) -> "T3InferenceState":
+        generator = torch.Generator(device=device)
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        return cls(generator=generator)
+
+    @contextmanager
+    def static_cache(self, config, batch_size: int, max_cache_len: int, device, dtype):
+        """
+        Yields a `StaticCache` with room for at least `max_cache_len` positions. The buffers are kept for the next
+        call when the bucketed size matches. Stale entries need no reset: positions past the current one are masked.
+        If the cache is already in use (the same state shared by two threads), a temporary one is allocated.
+        Held by a generator (`T3.inference_stream`), the cache is released when the generator is closed.
+        """
+        max_cache_len = -(-max_cache_len // STATIC_CACHE_BUCKET) * STATIC_CACHE_BUCKET
+        if not self.kv_cache_lock.acquire(blocking=False):
+            yield new_static_cache(config, batch_size, max_cache_len, device, dtype)
+            return
+        try:
+            cache = self.kv_cache
+            if (
+                cache is None
+                or cache.batch_size != batch_size
+                or cache.max_cache_len != max_cache_len
+                or cache.dtype != dtype
+                or cache.key_cache[0].device != torch.device(device)
+            ):
+                self.kv_cache = None  # release the old buffers before allocating new ones
+                cache = self.kv_cache = new_static_cache(config, batch_size, max_cache_len, device, dtype)
+            yield cache
+        finally:
+            self.kv_cache_lock.release()
+
+
+    @contextmanager
+    def alignment_analyzer(self, tfmr, eos_idx: int):
+        """
+        Yields this worker's `AlignmentStreamAnalyzer` for `tfmr`; the caller `reset`s it, which attaches its hooks,
+        and they are detached again on exit. As with `static_cache`, a concurrent user gets a temporary analyzer.
+        """
+        if not self.analyzer_lock.acquire(blocking=False):
+            analyzer = AlignmentStreamAnalyzer(tfmr, None, eos_idx=eos_idx)
+            try:
+                yield analyzer
+            finally:
+                analyzer.remove()
+            return
+        try:
+            if self.analyzer is None or self.analyzer.tfmr is not tfmr or self.analyzer.eos_idx != eos_idx:
+                self.analyzer = AlignmentStreamAnalyzer(tfmr, None, eos_idx=eos_idx)
+            yield self.analyzer
+        finally:
+            self.analyzer.remove()
+            self.analyzer_lock.release()
+
+
+def new_static_cache(config, batch_size: int, max_cache_len: int, device, dtype) -> StaticCache:
+    return StaticCache(config=config, batch_size=batch_size, max_cache_len=max_cache_len, device=device, dtype=dtype)
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+from transformers import DynamicCache, StaticCache
+
+from ..modules.cond_enc import T3Cond
+
+
+@dataclass(frozen=True)
+class PrefixKV:
+    """
+    Prefilled KV cache of a conditioning prefix, for a single row: one (1, n_heads, length, head_dim)
+    key and value tensor per layer. Shared between requests, so it must never be written to.
+    """
+    keys: Tuple[Tensor, ...]
+    values: Tuple[Tensor, ...]
+
+    @property
+    def length(self) -> int:
+        return self.keys[0].size(2)
+
+    @classmethod
+    def from_cache(cls, cache: DynamicCache) -> "PrefixKV":
+        return cls(keys=tuple(cache.key_cache), values=tuple(cache.value_cache))
+
+    def to_dynamic_cache(self, batch_size: int) -> DynamicCache:
+        "A `DynamicCache` starting with this prefix on every row (the new positions are concatenated, not written)."
+        return DynamicCache.from_legacy_cache(tuple(
+            (k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+            for k, v in zip(self.keys, self.values)
+        ))
+
+    def copy_to(self, cache: StaticCache):
+        "Writes this prefix into the first `length` positions of every row of `cache`."
+        for layer_idx, (k, v) in enumerate(zip(self.keys, self.values)):
+            cache.key_cache[layer_idx][:, :, :self.length] = k
+            cache.value_cache[layer_idx][:, :, :self.length] = v
+
+
+def prefix_cache_key(t3_cond: T3Cond, dtype: torch.dtype, device) -> str:
+    """
+    Key of the conditioning prefix of `t3_cond` on a model with this dtype and device. It is built from
+    `T3Cond.content_key`, so that equal voices (and exaggerations) hit the same entry even when their `T3Cond`
+    objects are rebuilt per request, without reading their tensors back on every request.
+    """
+    return f"{t3_cond.content_key()}|{dtype}|{device}"
+
+
+class T3PrefixCache:
+    """
+    LRU cache of `PrefixKV`s, keyed by `prefix_cache_key`. Shared by all the threads decoding on one `T3`,
+    so the prefix of a voice is only prefilled once, whichever worker sees it first.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> PrefixKV
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[PrefixKV]:
+        with self._lock:
+            prefix = self._entries.get(key)
+            if prefix is not None:
+                self._entries.move_to_end(key)
+            return prefix
+
+    def put(self, key: str, prefix: PrefixKV):
+        with self._lock:
+            self._entries[key] = prefix
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,218 @@
+import math
+from typing import List, Optional, Sequence, Union
+
+import torch
+from torch import Tensor
+
+
+# top-k / top-p are evaluated on this many most likely tokens (unless `top_k` is given) instead of sorting the whole
+# vocab. Rows whose candidates hold less than `top_p` of the mass (eg. top_p = 1) keep every other token too, so the
+# result matches the unfiltered nucleus as long as it fits in the prefilter, which holds for any sensible `top_p`.
+TOP_K_PREFILTER = 512
+
+Param = Union[float, Sequence[float], Tensor]
+
+
+def _per_row(value: Param, batch_size: int, device) -> Tensor:
+    "Broadcasts a scalar or per-row sampling parameter to a (B, 1) float tensor."
+    value = torch.as_tensor(value, dtype=torch.float32, device=device)
+    return value.reshape(-1, 1).expand(batch_size, 1)
+
+
+@torch.inference_mode()
+def process_logits(
+    logits: Tensor,
+    token_counts: Optional[Tensor]=None,
+    *,
+    temperature: Param=1.0,
+    top_k: int=0,
+    top_p: Param=1.0,
+    min_p: Param=0.0,
+    repetition_penalty: Param=1.0,
+    penalty_last: bool=False,
+) -> Tensor:
+    """
+    Fused, batched equivalent of HF's `RepetitionPenaltyLogitsProcessor`, `TemperatureLogitsWarper`,
+    `MinPLogitsWarper`, `TopKLogitsWarper` and `TopPLogitsWarper`, in that order, or with the repetition penalty
+    applied last if `penalty_last` (the order of the turbo model). Nothing here synchronizes with the host.
+
+    Args:
+        logits: (B, V) next-token logits.
+        token_counts: (B, V) number of times each token was generated so far (repetition penalty), or None.
+        temperature, top_p, min_p, repetition_penalty: scalars, or one value per row.
+        top_k: keep only the `top_k` most likely tokens (0: no limit).
+    Returns:
+        (B, V) float logits, -inf for the tokens that were filtered out.
+    """
+    B, V = logits.shape
+    device = logits.device
+    logits = logits.float()
+    penalize = token_counts is not None and not _is_const(repetition_penalty, 1.0)
+
+    if penalize and not penalty_last:
+        logits = _repetition_penalty(logits, token_counts, repetition_penalty)
+
+    if not _is_const(temperature, 1.0):
+        logits = logits / _per_row(temperature, B, device)
+
+    # min-p on the full vocab: p < min_p * p_max  <=>  logit < logit_max + log(min_p)
+    if not _is_const(min_p, 0.0):
+        max_logit = logits.max(dim=-1, keepdim=True).values
+        log_min_p = torch.log(_per_row(min_p, B, device))
+        logits = logits.masked_fill(logits < max_logit + log_min_p, -math.inf)
+
+    if top_k > 0 or not _is_const(top_p, 1.0):
+        logits = _top_k_top_p(logits, top_k, top_p)
+
+    if penalize and penalty_last:
+        logits = _repetition_penalty(logits, token_counts, repetition_penalty)
+    return logits
+
+
+@torch.inference_mode()
+def sample_next_tokens(
+    logits: Tensor,
+    token_counts: Optional[Tensor]=None,
+    *,
+    temperature: Param=1.0,
+    top_k: int=0,
+    top_p: Param=1.0,
+    min_p: Param=0.0,
+    repetition_penalty: Param=1.0,
+    penalty_last: bool=False,
+    generators: Union[None, torch.Generator, List[Optional[torch.Generator]]]=None,
+) -> Tensor:
+    """
+    Samples from the logits processed by `process_logits` (see there for the arguments), like HF's sampling loop.
+
+    Args:
+        generators: a generator shared by all rows, or one per row (None: global RNG).
+    Returns:
+        (B, 1) sampled token ids.
+    """
+    logits = process_logits(
+        logits,
+        token_counts,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        min_p=min_p,
+        repetition_penalty=repetition_penalty,
+        penalty_last=penalty_last,
+    )
+    return _multinomial(torch.softmax(logits, dim=-1), generators)
+
+
+def _repetition_penalty(logits: Tensor, token_counts: Tensor, repetition_penalty: Param) -> Tensor:
+    "Shrinks the logits of the tokens that were generated before."
+    penalty = _per_row(repetition_penalty, logits.size(0), logits.device)
+    penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+    return torch.where(token_counts > 0, penalized, logits)
+
+
+def _top_k_top_p(logits: Tensor, top_k: int, top_p: Param) -> Tensor:
+    "Top-k then top-p filtering of (B, V) logits, evaluated on a top-k prefilter (see `TOP_K_PREFILTER`)."
+    B, V = logits.shape
+    k = min(top_k if top_k > 0 else TOP_K_PREFILTER, V)
+    top_logits, top_idx = logits.topk(k, dim=-1)  # sorted descending
+    keep_outside = None
+
+    # top-p: keep a token while the mass of the more likely tokens is below top_p (always, for rows with top_p >= 1)
+    if not _is_const(top_p, 1.0):
+        p = _per_row(top_p, B, logits.device)
+        # (normalized over the full vocab, or over the top-k when that filter was requested)
+        log_norm = torch.logsumexp(top_logits if top_k > 0 else logits, dim=-1, keepdim=True)
+        probs = torch.exp(top_logits - log_norm)
+        mass = probs.cumsum(dim=-1)
+        keep = (mass - probs < p) | (p >= 1)
+        keep[:, 0] = True  # always keep the most likely token
+        top_logits = top_logits.masked_fill(~keep, -math.inf)
+        if top_k <= 0:
+            # the prefilter is not a filter of its own: where its candidates hold less than top_p of the mass,
+            # the nucleus extends past them and the tokens outside are kept
+            keep_outside = (mass[:, -1:] < p) | (p >= 1)
+
+    filtered = torch.full_like(logits, -math.inf).scatter(1, top_idx, top_logits)
+    if keep_outside is not None:
+        filtered = torch.where(keep_outside, logits, filtered)
+    return filtered
+
+
+def _multinomial(probs: Tensor, generators) -> Tensor:
+    "One (B, 1) sample per row of `probs`, with a shared generator or one per row."
+    if isinstance(generators, (list, tuple)):
+        return torch.cat([
+            torch.multinomial(probs[i:i + 1], num_samples=1, generator=g) for i, g in enumerate(generators)
+        ])
+    return torch.multinomial(probs, num_samples=1, generator=generators)
+
+
+def _is_const(value: Param, const: float) -> bool:
+    if torch.is_tensor(value):
+        return False
+    if isinstance(value, (list, tuple)):
+        return all(v == const for v in value)
+    return value == const
+
+
+class T3Sampler:
+    """
+    Stateful wrapper of `sample_next_tokens` for one decode loop: keeps the running token counts for the
+    repetition penalty on device, so no token history has to be re-scanned or concatenated per step.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        vocab_size: int,
+        device,
+        *,
+        temperature: Param=1.0,
+        top_k: int=0,
+        top_p: Param=1.0,
+        min_p: Param=0.0,
+        repetition_penalty: Param=1.0,
+        penalty_last: bool=False,
+        generator: Optional[torch.Generator]=None,
+        initial_tokens: Optional[Tensor]=None,
+    ):
+        self.token_counts = torch.zeros(batch_size, vocab_size, dtype=torch.int32, device=device)
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.penalty_last = penalty_last
+        self.generator = generator
+        if initial_tokens is not None:
+            self.update(initial_tokens)
+
+    def update(self, tokens: Tensor):
+        "Counts `tokens` (B, T) as generated."
+        tokens = tokens.to(self.token_counts.device)
+        self.token_counts.scatter_add_(1, tokens, torch.ones_like(tokens, dtype=self.token_counts.dtype))
+
+    def __call__(self, logits: Tensor, prompt_tokens: Optional[Tensor]=None) -> Tensor:
+        """
+        Samples (B, 1) tokens from (B, V) logits and counts them. `prompt_tokens` (B, T) are penalized on this step
+        only, without being counted (the turbo model penalizes its start token on the first step).
+        """
+        token_counts = self.token_counts
+        if prompt_tokens is not None:
+            prompt_tokens = prompt_tokens.to(token_counts.device)
+            token_counts = token_counts.clone().scatter_add_(
+                1, prompt_tokens, torch.ones_like(prompt_tokens, dtype=token_counts.dtype)
+            )
+        tokens = sample_next_tokens(
+            logits,
+            token_counts,
+            temperature=self.temperature,
+            top_k=self.top_k,
+            top_p=self.top_p,
+            min_p=self.min_p,
+            repetition_penalty=self.repetition_penalty,
+            penalty_last=self.penalty_last,
+            generators=self.generator,
+        )
+        self.update(tokens)
+        return tokens
@@ -1,7 +1,7 @@
+from contextlib import nullcontext
 from typing import Optional
 
 import torch
-from torch import nn as nn
 from transformers import LlamaConfig, LlamaModel, LlamaPreTrainedModel, GenerationMixin
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
@@ -76,8 +76,10 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         past_key_values: Optional[torch.Tensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
+        cache_position: Optional[torch.Tensor]=None,
+        num_logits_to_keep: int=1,
     ):
         """
         This is a method used by huggingface's generate() method.
@@ -85,24 +87,32 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
         S should be 1.
+        :param cache_position: (S,) positions written in the KV cache, required with a `StaticCache`.
+        :param num_logits_to_keep: only project the last `num_logits_to_keep` positions to logits (0: all of them).
+            Decoding only ever reads the last one, so the prefill skips the head on the rest of the sequence.
+        Hidden states and attentions are only returned when asked for.
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
+        if cache_position is None:
+            is_large_input = inputs_embeds.size(1) != 1
+            has_cache = past_key_values is not None and len(past_key_values) > 0
+            assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
-
-        tfmr_out = self.model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=past_key_values,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=True,
-        )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
 
-        logits = self.speech_head(hidden_states)
+        # the analyzer's hooks record the aligned heads of this forward pass, on this thread only
+        analyzer = self.alignment_stream_analyzer
+        with analyzer.recording if analyzer is not None else nullcontext():
+            tfmr_out = self.model(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+                cache_position=cache_position,
+            )
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim)
+
+        logits = self.speech_head(hidden_states[:, -num_logits_to_keep:])  # (B, num_logits_to_keep or seq, V)
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+import hashlib
+from dataclasses import dataclass, field, replace
 from typing import Optional
 
 import torch
@@ -20,6 +21,9 @@ class T3Cond:
     cond_prompt_speech_tokens: Optional[Tensor] = None
     cond_prompt_speech_emb: Optional[Tensor] = None
     emotion_adv: Optional[Tensor] = 0.5
+    # digests of the voice fields and of `emotion_adv`, see `content_key`
+    voice_digest: Optional[str] = field(default=None, repr=False)
+    emotion_digest: Optional[str] = field(default=None, repr=False)
 
     def to(self, *, device=None, dtype=None):
         "Cast to a device and dtype. Dtype casting is ignored for long/int tensors."
@@ -27,8 +31,41 @@ class T3Cond:
             if torch.is_tensor(v):
                 is_fp = type(v.view(-1)[0].item()) is not int
                 setattr(self, k, v.to(device=device, dtype=dtype if is_fp else None))
+        if dtype is not None:
+            self.voice_digest = self.emotion_digest = None
         return self
 
+    def _digest(self, names) -> str:
+        return _hash_fields((name, getattr(self, name)) for name in names)
+
+    def content_key(self) -> str:
+        """
+        Digest of the content of this conditioning (eg. to key the prefix cache of `T3`). The tensors are only read
+        back from the device the first time: the digests are kept on the instance, and copies made with
+        `with_exaggeration` inherit the one of the voice.
+        """
+        if self.voice_digest is None:
+            self.voice_digest = self._digest(
+                ("speaker_emb", "clap_emb", "cond_prompt_speech_tokens", "cond_prompt_speech_emb")
+            )
+        if self.emotion_digest is None:
+            self.emotion_digest = self._digest(("emotion_adv",))
+        return f"{self.voice_digest}|{self.emotion_digest}"
+
+    def with_exaggeration(self, exaggeration: float) -> "T3Cond":
+        """
+        Copy with `emotion_adv` set to `exaggeration`, sharing every other tensor (and their digest). The new
+        `emotion_adv` is hashed before it is moved to the device, so it keys like a conditioning built from scratch.
+        """
+        if self.voice_digest is None:
+            self.content_key()
+        emotion_adv = exaggeration * torch.ones(1, 1, 1)
+        return replace(
+            self,
+            emotion_adv=emotion_adv.to(self.speaker_emb.device),
+            emotion_digest=_hash_fields([("emotion_adv", emotion_adv)]),
+        )
+
     def save(self, fpath):
         torch.save(self.__dict__, fpath)
 
@@ -38,6 +75,20 @@ class T3Cond:
         return T3Cond(**kwargs)
 
 
+def _hash_fields(fields) -> str:
+    "sha256 of (name, value) pairs, tensors by dtype, shape and bytes."
+    h = hashlib.sha256()
+    for name, value in fields:
+        h.update(name.encode())
+        if torch.is_tensor(value):
+            value = value.detach().contiguous().cpu()
+            h.update(f"{value.dtype}{tuple(value.shape)}".encode())
+            h.update(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
 class T3CondEnc(nn.Module):
     """
     Handle all non-text conditioning, like speaker embeddings / prompts, CLAP, emotion, etc.
@@ -1,30 +1,25 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
-from typing import Union, Optional, List
-
-logger = logging.getLogger(__name__)
+from contextlib import nullcontext
+from dataclasses import replace
+from typing import Optional
 
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig, GPT2Config, GPT2Model
-from transformers.generation.logits_process import (
-    LogitsProcessorList,
-    RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopKLogitsWarper,
-    TopPLogitsWarper,
-    MinPLogitsWarper,
-)
+from transformers import LlamaModel, LlamaConfig, GPT2Config, GPT2Model, DynamicCache
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
 from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
-from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.inference_state import T3InferenceState, new_static_cache
+from .inference.sampler import T3Sampler
+from .inference.prefix_cache import PrefixKV, T3PrefixCache, prefix_cache_key
+from .inference.cfg_schedule import CFGSchedule, drop_uncond_row
 from ..utils import AttrDict
 
 
@@ -84,7 +79,9 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=self.is_gpt)
-        self.compiled = False
+
+        # prefilled KV of the conditioning prefix per voice (shared read-only by all decoding threads)
+        self.prefix_cache = T3PrefixCache()
 
     @property
     def device(self):
@@ -93,11 +90,13 @@ class T3(nn.Module):
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
+        NOTE: `t3_cond` is not modified, so the same conditionals can be shared between threads.
         """
         if t3_cond.cond_prompt_speech_tokens is not None and t3_cond.cond_prompt_speech_emb is None:
-            t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens)
+            cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens)
             if not self.is_gpt:
-                t3_cond.cond_prompt_speech_emb += self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+                cond_prompt_speech_emb = cond_prompt_speech_emb + self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+            t3_cond = replace(t3_cond, cond_prompt_speech_emb=cond_prompt_speech_emb)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
     def prepare_input_embeds(
@@ -110,6 +109,28 @@ class T3(nn.Module):
     ):
         # prepare input embeddings (skip backbone tranformer embeddings)
         cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        text_speech_emb = self.prepare_text_speech_embeds(
+            text_tokens=text_tokens,
+            speech_tokens=speech_tokens,
+            cfg_weight=cfg_weight,
+        )  # (B, len_text + len_speech, dim)
+        len_cond = cond_emb.size(1)
+
+        if cond_emb.size(0) != text_speech_emb.size(0):
+             cond_emb = cond_emb.expand(text_speech_emb.size(0), -1, -1)
+
+        # concat
+        embeds = torch.cat([cond_emb, text_speech_emb], dim=1)  # (B, length, dim)
+        return embeds, len_cond
+
+    def prepare_text_speech_embeds(
+        self,
+        *,
+        text_tokens: torch.LongTensor,
+        speech_tokens: torch.LongTensor,
+        cfg_weight: float = 0.0,
+    ):
+        "The part of `prepare_input_embeds` that follows the conditioning prefix."
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
         if cfg_weight > 0.0 and not self.is_gpt:
             text_emb[1].zero_()  # CFG uncond
@@ -118,17 +139,28 @@ class T3(nn.Module):
         if self.hp.input_pos_emb == "learned":
             text_emb = text_emb + self.text_pos_emb(text_tokens)
             speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
-        len_cond = cond_emb.size(1)
+        return torch.cat([text_emb, speech_emb], dim=1)
 
-        if cond_emb.size(0) != text_emb.size(0):
-             cond_emb = cond_emb.expand(text_emb.size(0), -1, -1)
-
-        # concat
-        embeds = torch.stack([
-            torch.cat((ce, te, se))
-            for ce, te, se in zip(cond_emb, text_emb, speech_emb)
-        ])  # (B, length, dim)
-        return embeds, len_cond
+    @torch.inference_mode()
+    def conditioning_prefix(self, t3_cond: T3Cond) -> PrefixKV:
+        """
+        Prefilled KV cache of the conditioning prefix (`T3CondEnc` output) of one row. The prefix only depends
+        on the voice and exaggeration, so it is computed once and then served from `self.prefix_cache`.
+        """
+        assert not self.is_gpt, "prefix caching is only implemented for the Llama backbone"
+        key = prefix_cache_key(t3_cond, self.speech_head.weight.dtype, self.device)
+        prefix = self.prefix_cache.get(key)
+        if prefix is None:
+            cond_emb = self.prepare_conditioning(t3_cond)[:1]  # (1, len_cond, dim), identical for the CFG rows
+            out = self.tfmr(
+                inputs_embeds=cond_emb,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                return_dict=True,
+            )
+            prefix = PrefixKV.from_cache(out.past_key_values)
+            self.prefix_cache.put(key, prefix)
+        return prefix
 
     def forward(
         self,
@@ -223,8 +255,22 @@ class T3(nn.Module):
 
         return loss_text, loss_speech
 
+    def _static_cache(self, state: Optional[T3InferenceState], batch_size: int, max_cache_len: int, device):
+        dtype = self.speech_head.weight.dtype
+        if state is not None:
+            return state.static_cache(self.cfg, batch_size, max_cache_len, device, dtype)
+        return nullcontext(new_static_cache(self.cfg, batch_size, max_cache_len, device, dtype))
+
     @torch.inference_mode()
-    def inference(
+    def inference(self, **kwargs) -> Tensor:
+        """
+        Decodes the whole utterance and returns the predicted speech tokens (B=1, num_tokens), ending with the
+        stop token unless `max_new_tokens` was reached. Takes the arguments of `inference_stream`.
+        """
+        return torch.cat(list(self.inference_stream(**kwargs)), dim=1)
+
+    @torch.inference_mode()
+    def inference_stream(
         self,
         *,
         t3_cond: T3Cond,
@@ -245,60 +291,73 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0.5,
+        cfg_schedule: Optional[CFGSchedule]=None,
+
+        # per-worker decoding state
+        state: Optional[T3InferenceState]=None,
+        use_static_cache=True,
+        use_prefix_cache=True,
+
+        # streaming
+        chunk_size: Optional[int]=None,
     ):
         """
+        Generator version of `inference`: yields the predicted speech tokens in (1, n) blocks while decoding.
+
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            cfg_schedule: when to stop applying CFG and drop the unconditional row (None: CFG on every step).
+            state: the caller's `T3InferenceState` (eg. its sampling RNG). Uses the global RNG if None.
+            use_static_cache: decode into a KV cache preallocated for `max_new_tokens` (kept in `state` between
+                calls) instead of growing HF's dynamic cache one token at a time.
+            use_prefix_cache: start from the prefilled KV of the conditioning prefix (see `conditioning_prefix`),
+                so that only the text tokens are prefilled.
+            chunk_size: yield a block every `chunk_size` tokens (None: a single block once decoding is done).
+                The last block holds the remainder, including the stop token.
+
+        The KV cache and alignment analyzer of `state` are held from the first block until the generator is
+        exhausted or closed: a caller that stops reading early must `close()` it, or they are only released at GC
+        (other calls meanwhile fall back to temporary ones).
+
+        NOTE: no module state is written here (the HF backend is per call, the alignment analyzer lives in
+        `state`), so several threads may run `inference` concurrently on the same weights.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        if cfg_schedule is not None:
+            cfg_schedule.validate(has_alignment_analyzer=self.hp.is_multilingual)
 
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
             initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
         # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
-            cfg_weight=cfg_weight,
-        )
+        if use_prefix_cache:
+            # the conditioning prefix is already prefilled, only embed what follows it
+            prefix = self.conditioning_prefix(t3_cond)
+            len_cond = prefix.length
+            embeds = self.prepare_text_speech_embeds(
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+        else:
+            prefix = None
+            embeds, len_cond = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
 
         # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
         # Note the llama-specific logic. Other tfmr types can be added later.
 
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
-                )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
-
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
-
         # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
+        # return patched_model.generate(
         #     inputs=initial_speech_tokens,
         #     decoder_cond=embeds,
         #     bos_token_id=self.hp.start_speech_token,
@@ -326,106 +385,156 @@ class T3(nn.Module):
         # Combine condition and BOS token for the initial input
         inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
 
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
-
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
+        # Track generated token ids in a preallocated buffer; start with the BOS token.
+        generated_ids = torch.empty(1, max_new_tokens + 1, dtype=torch.long, device=device)
+        generated_ids[:, :1] = bos_token
+        n_generated = 0
+        n_yielded = 0
+
+        # Fused repetition penalty / temperature / min_p / top_p sampler (the BOS token counts as generated).
+        sampler = T3Sampler(
+            1,
+            self.hp.speech_tokens_dict_size,
+            device,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=float(repetition_penalty),
+            generator=state.generator if state is not None else None,
+            initial_tokens=bos_token,
         )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
-
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]
-            # CFG combine  → (1, V)
-            cond   = logits_step[0:1, :]
-            uncond = logits_step[1:2, :]
-            cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
-            logits = cond + cfg * (cond - uncond)
-            
-            # Apply alignment stream analyzer integrity checks
-            if self.patched_model.alignment_stream_analyzer is not None:
-                if logits.dim() == 1:            # guard in case something upstream squeezed
-                    logits = logits.unsqueeze(0) # (1, V)
-                # Pass the last generated token for repetition tracking
-                last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
-
-            # Apply repetition penalty
-            ids_for_proc = generated_ids[:1, ...]   # batch = 1
-            logits = repetition_penalty_processor(ids_for_proc, logits)  # expects (B,V)
-            
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-                
-            # Apply min_p and top_p filtering
-            logits = min_p_warper(ids_for_proc, logits)
-            logits = top_p_warper(ids_for_proc, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
-                break
 
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+        # KV cache sized for the whole generation up front, so the decode loop only writes into it in place.
+        len_prefix = len_cond if prefix is not None else 0  # positions already in the cache before the prefill
+        len_prefill = len_prefix + inputs_embeds.size(1)
+        cache_positions = torch.arange(len_prefill + max_new_tokens, device=device)
+        if use_static_cache:
+            cache_ctx = self._static_cache(state, inputs_embeds.size(0), len_prefill + max_new_tokens, device)
+        else:
+            cache_ctx = nullcontext(None)
+
+        # Default to None for English models, only used for multilingual
+        if self.hp.is_multilingual:
+            analyzer_ctx = (state or T3InferenceState()).alignment_analyzer(self.tfmr, eos_idx=self.hp.stop_speech_token)
+        else:
+            analyzer_ctx = nullcontext(None)
+
+        with analyzer_ctx as alignment_stream_analyzer, cache_ctx as past:
+            if prefix is not None:
+                if past is None:
+                    past = prefix.to_dynamic_cache(inputs_embeds.size(0))
+                else:
+                    prefix.copy_to(past)
+
+            if alignment_stream_analyzer is not None:
+                len_text_end = len_cond + text_tokens.size(-1)
+                alignment_stream_analyzer.reset(
+                    text_tokens_slice=(len_cond, len_text_end),
+                    max_frames=len_prefill - len_text_end + max_new_tokens,
+                    prefill_offset=len_prefix,
+                )
 
-            #  For CFG
-            next_token_embed = torch.cat([next_token_embed, next_token_embed])
+            # NOTE: built per call (it is only a thin wrapper around the shared modules) to keep `inference` re-entrant
+            patched_model = T3HuggingfaceBackend(
+                config=self.cfg,
+                llama=self.tfmr,
+                speech_enc=self.speech_emb,
+                speech_head=self.speech_head,
+                alignment_stream_analyzer=alignment_stream_analyzer,
+            )
 
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
+            # ---- Initial Forward Pass (kv_cache holds at most the conditioning prefix) ----
+            output = patched_model(
+                inputs_embeds=inputs_embeds,
                 past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
+                use_cache=True,
                 return_dict=True,
+                cache_position=cache_positions[len_prefix:len_prefill],
             )
-            # Update the kv_cache.
+            # Initialize kv_cache with the full context.
             past = output.past_key_values
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+            # ---- Generation Loop using kv_cache ----
+            n_rows = inputs_embeds.size(0)  # 2 while CFG is applied, then 1
+            for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                logits_step = output.logits[:, -1, :]
+                if n_rows == 2:
+                    # CFG combine  → (1, V)
+                    cond   = logits_step[0:1, :]
+                    uncond = logits_step[1:2, :]
+                    cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
+                    logits = cond + cfg * (cond - uncond)
+                else:
+                    logits = logits_step[0:1, :]
+
+                # Apply alignment stream analyzer integrity checks
+                if patched_model.alignment_stream_analyzer is not None:
+                    if logits.dim() == 1:            # guard in case something upstream squeezed
+                        logits = logits.unsqueeze(0) # (1, V)
+                    # Pass the last generated token for repetition tracking
+                    last_token = generated_ids[0, n_generated]
+                    logits = patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
+
+                # Apply repetition penalty, temperature, min_p and top_p, and sample the next token.
+                next_token = sampler(logits)  # shape: (B, 1)
+
+                n_generated += 1
+                generated_ids[:, n_generated:n_generated + 1] = next_token
+
+                # Check for EOS token.
+                if next_token.view(-1) == self.hp.stop_speech_token:
+                    logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
+                    break
+
+                if chunk_size and n_generated - n_yielded >= chunk_size:
+                    yield generated_ids[:, n_yielded + 1:n_generated + 1].clone()
+                    n_yielded = n_generated
+
+                # Get embedding for the new token.
+                next_token_embed = self.speech_emb(next_token)
+                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+
+                # Once the schedule turns CFG off, the uncond row is evicted from the KV cache for good
+                if n_rows == 2 and cfg_schedule is not None:
+                    if not cfg_schedule.keep_cfg(n_generated, alignment_stream_analyzer):
+                        logger.info(f"Dropping the CFG uncond row after {n_generated} tokens")
+                        past = drop_uncond_row(past)
+                        n_rows = 1
+
+                #  For CFG
+                if n_rows == 2:
+                    next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+                # Forward pass with only the new token and the cached past.
+                output = patched_model(
+                    inputs_embeds=next_token_embed,
+                    past_key_values=past,
+                    return_dict=True,
+                    cache_position=cache_positions[len_prefill + i:len_prefill + i + 1],
+                )
+                # Update the kv_cache.
+                past = output.past_key_values
 
-    @torch.inference_mode()
-    def inference_turbo(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
-                        max_gen_len=1000):
+            if alignment_stream_analyzer is not None:
+                alignment_stream_analyzer.log_forced_eos()
 
-        logits_processors = LogitsProcessorList()
-        if temperature > 0 and temperature != 1.0:
-            logits_processors.append(TemperatureLogitsWarper(temperature))
-        if top_k > 0:
-            logits_processors.append(TopKLogitsWarper(top_k))
-        if top_p < 1.0:
-            logits_processors.append(TopPLogitsWarper(top_p))
-        if repetition_penalty != 1.0:
-            logits_processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        # The predicted tokens follow the BOS token in the buffer.
+        if n_generated > n_yielded or n_yielded == 0:
+            yield generated_ids[:, n_yielded + 1:n_generated + 1].clone()  # shape: (B, num_tokens)
 
+    @torch.inference_mode()
+    def inference_turbo(self, t3_cond, text_tokens, **kwargs) -> Tensor:
+        "Decodes the whole utterance with the GPT-2 backbone; see `inference_turbo_stream` for the arguments."
+        return torch.cat(list(self.inference_turbo_stream(t3_cond, text_tokens, **kwargs)), dim=1)
 
+    @torch.inference_mode()
+    def inference_turbo_stream(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95,
+                               repetition_penalty=1.2, max_gen_len=1000, state: Optional[T3InferenceState]=None,
+                               chunk_size: Optional[int]=None):
+        """
+        Yields the speech tokens (B, n) in blocks of `chunk_size` while decoding (None: one block at the end).
+        The stop token is never included.
+        """
         speech_start_token = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
         embeds, _ = self.prepare_input_embeds(
             t3_cond=t3_cond,
@@ -435,6 +544,17 @@ class T3(nn.Module):
         )
 
         generated_speech_tokens = []
+        sampler = T3Sampler(
+            speech_start_token.size(0),
+            self.hp.speech_tokens_dict_size,
+            speech_start_token.device,
+            temperature=temperature if temperature > 0 else 1.0,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            penalty_last=True,  # the processor order of the turbo model: temperature, top-k, top-p, penalty
+            generator=state.generator if state is not None else None,
+        )
 
         llm_outputs = self.tfmr(
             inputs_embeds=embeds,
@@ -447,12 +567,12 @@ class T3(nn.Module):
         speech_hidden = hidden_states[:, -1:]
         speech_logits = self.speech_head(speech_hidden)
 
-        processed_logits = logits_processors(speech_start_token, speech_logits[:, -1, :])
-        probs = F.softmax(processed_logits, dim=-1)
-        next_speech_token = torch.multinomial(probs, num_samples=1)
+        # (the first step is penalized for the start token it is prompted with, later ones for the generated tokens)
+        next_speech_token = sampler(speech_logits[:, -1, :], prompt_tokens=speech_start_token)
 
         generated_speech_tokens.append(next_speech_token)
         current_speech_token = next_speech_token
+        n_yielded = 0
 
         for _ in tqdm(range(max_gen_len)):
             current_speech_embed = self.speech_emb(current_speech_token)
@@ -466,25 +586,29 @@ class T3(nn.Module):
             hidden_states = llm_outputs[0]
             past_key_values = llm_outputs.past_key_values
             speech_logits = self.speech_head(hidden_states)
-
-            input_ids = torch.cat(generated_speech_tokens, dim=1)
-            processed_logits = logits_processors(input_ids, speech_logits[:, -1, :])
-            if torch.all(processed_logits == -float("inf")):
-                print("Warning: All logits are -inf")
+            # (the filters always keep the most likely token, so the processed logits are all -inf iff these are)
+            if torch.all(speech_logits[:, -1, :] == -float("inf")):
+                logger.warning("All logits are -inf")
                 break
 
-            probs = F.softmax(processed_logits, dim=-1)
-            next_speech_token = torch.multinomial(probs, num_samples=1)
+            next_speech_token = sampler(speech_logits[:, -1, :])
 
             generated_speech_tokens.append(next_speech_token)
             current_speech_token = next_speech_token
             if torch.all(next_speech_token == self.hp.stop_speech_token):
                 break
 
-        all_tokens = torch.cat(generated_speech_tokens, dim=1)
+            if chunk_size and len(generated_speech_tokens) - n_yielded >= chunk_size:
+                yield torch.cat(generated_speech_tokens[n_yielded:], dim=1)
+                n_yielded = len(generated_speech_tokens)
+
+        if n_yielded == len(generated_speech_tokens):
+            return
+        all_tokens = torch.cat(generated_speech_tokens[n_yielded:], dim=1)
 
         # Remove EOS token if present
         if all_tokens.size(1) > 0 and all_tokens[0, -1] == self.hp.stop_speech_token:
             all_tokens = all_tokens[:, :-1]
 
-        return all_tokens
+        if all_tokens.size(1) > 0 or n_yielded == 0:
+            yield all_tokens
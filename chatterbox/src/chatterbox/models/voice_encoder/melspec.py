@@ -1,8 +1,11 @@
 from functools import lru_cache
+from typing import List
 
 from scipy import signal
 import numpy as np
 import librosa
+import torch
+import torch.nn.functional as F
 
 
 @lru_cache()
@@ -51,6 +54,53 @@ def melspectrogram(wav, hp, pad=True):
     return mel   # (M, T)
 
 
+def melspectrogram_torch(wavs: List[torch.Tensor], hp, pad=True) -> List[torch.Tensor]:
+    """
+    Torch version of `melspectrogram` for a list of 1D wavs, computed in one batch on their device.
+    Each wav is padded on its own (as `librosa.stft` would) before they are batched, so the mels of a batch are
+    the same as one by one. Returns a (M, T) mel per wav.
+    """
+    device = wavs[0].device
+    if hp.preemphasis > 0:
+        wavs = [_preemphasis_torch(wav, hp) for wav in wavs]
+    if pad:
+        wavs = [F.pad(wav[None, None], (hp.n_fft // 2, hp.n_fft // 2), mode="reflect")[0, 0] for wav in wavs]
+    n_frames = [1 + (len(wav) - hp.n_fft) // hp.hop_size for wav in wavs]
+
+    batch = torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True)
+    spec_complex = torch.stft(
+        batch,
+        n_fft=hp.n_fft,
+        hop_length=hp.hop_size,
+        win_length=hp.win_size,
+        window=torch.hann_window(hp.win_size, device=device),
+        center=False,
+        return_complex=True,
+    )
+
+    # Get the magnitudes
+    spec_magnitudes = spec_complex.abs()
+
+    if hp.mel_power != 1.0:
+        spec_magnitudes = spec_magnitudes ** hp.mel_power
+
+    # Get the mel and convert magnitudes->db
+    mel = torch.from_numpy(mel_basis(hp)).to(device) @ spec_magnitudes
+    if hp.mel_type == "db":
+        mel = 20 * torch.log10(torch.clamp(mel, min=hp.stft_magnitude_min))
+
+    # Normalise the mel from db to 0,1
+    if hp.normalized_mels:
+        mel = _normalize(mel, hp)
+
+    return [m[:, :n] for m, n in zip(mel, n_frames)]
+
+
+def _preemphasis_torch(wav, hp):
+    wav = wav - hp.preemphasis * F.pad(wav, (1, 0))[:-1]
+    return torch.clamp(wav, -1, 1)
+
+
 def _stft(y, hp, pad=True):
     # NOTE: after 0.8, pad mode defaults to constant, setting this to reflect for
     #   historical consistency and streaming-version consistency
@@ -9,8 +9,9 @@ import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 
+from ..reference_audio import ReferenceAudio
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from .melspec import melspectrogram_torch
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -178,22 +179,17 @@ class VoiceEncoder(nn.Module):
             pad = torch.full((mels.size(0), len_diff, self.hp.num_mels), 0, dtype=torch.float32)
             mels = torch.cat((mels, pad.to(mels.device)), dim=1)
 
-        # Group all partials together so that we can batch them easily
-        partials = [
-            mel[i * frame_step: i * frame_step + self.hp.ve_partial_frames]
-            for mel, n_partial in zip(mels, n_partials) for i in range(n_partial)
-        ]
-        assert all(partials[0].shape == partial.shape for partial in partials)
-        partials = torch.stack(partials)
+        # Group all partials together so that we can batch them easily: the windows are strided views of the
+        # mels (B, n_windows, P, M), and the partials of all utterances are gathered in a single copy
+        windows = mels.unfold(1, self.hp.ve_partial_frames, frame_step).transpose(2, 3)
+        partials = torch.cat([wins[:n_partial] for wins, n_partial in zip(windows, n_partials)])
 
         # Forward the partials
         n_chunks = int(np.ceil(len(partials) / (batch_size or len(partials))))
         partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).cpu()
 
         # Reduce the partial embeds into full embeds and L2-normalize them
-        slices = np.concatenate(([0], np.cumsum(n_partials)))
-        raw_embeds = [torch.mean(partial_embeds[start:end], dim=0) for start, end in zip(slices[:-1], slices[1:])]
-        raw_embeds = torch.stack(raw_embeds)
+        raw_embeds = torch.stack([embeds.mean(dim=0) for embeds in partial_embeds.split(list(n_partials))])
         embeds = raw_embeds / torch.linalg.norm(raw_embeds, dim=1, keepdim=True)
 
         return embeds
@@ -269,6 +265,17 @@ class VoiceEncoder(nn.Module):
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        # mels of all the wavs in one batch, on the model's device
+        wavs = [torch.as_tensor(np.asarray(wav, dtype=np.float32), device=self.device) for wav in wavs]
+        mels = [mel.T for mel in melspectrogram_torch(wavs, self.hp)]
+        mel_lens = [len(mel) for mel in mels]
 
-        return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
+        return self.embeds_from_mels(pack(mels), mel_lens, as_spk=as_spk, batch_size=batch_size, **kwargs)
+
+    def embeds_from_refs(self, refs: List[ReferenceAudio], **kwargs):
+        """
+        Wrapper around embeds_from_wavs, for reference clips: their signals at the voice encoder's rate are
+        resampled once and shared with the other conditioning models.
+        """
+        wavs = [ref.wav(self.hp.sample_rate) for ref in refs]
+        return self.embeds_from_wavs(wavs, sample_rate=self.hp.sample_rate, **kwargs)
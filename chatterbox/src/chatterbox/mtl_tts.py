@@ -1,13 +1,9 @@
+import time
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List
 import os
-import tempfile
-import urllib.request
-import urllib.parse
-import re
 
-import boto3
-import librosa
 import torch
 import perth
 import torch.nn.functional as F
@@ -17,10 +13,18 @@ from huggingface_hub import snapshot_download
 from .models.t3 import T3
 from .models.t3.modules.t3_config import T3Config
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen import S3GEN_SR, S3GEN_BACKENDS, DERIVED_REF_KEYS, S3Gen, load_meanflow_s3gen
 from .models.tokenizers import MTLTokenizer
 from .models.voice_encoder import VoiceEncoder
+from .models.reference_audio import ReferenceAudio
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.inference_state import T3InferenceState
+from .models.t3.inference.cfg_schedule import CFGSchedule
+from .models.t3.inference.batch_scheduler import T3BatchScheduler
+from .streaming import stream_speech
+from .enrollment import enroll_references
+from .workers import ForkableTTS
+from .asset_cache import ReferenceAssetCache
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -125,7 +129,8 @@ class Conditionals:
     def save(self, fpath: Path):
         arg_dict = dict(
             t3=self.t3.__dict__,
-            gen=self.gen
+            # (without the entries derived with the flow's weights, see `S3Gen.prepare_ref_dict`)
+            gen={k: v for k, v in self.gen.items() if k not in DERIVED_REF_KEYS},
         )
         torch.save(arg_dict, fpath)
 
@@ -135,7 +140,7 @@ class Conditionals:
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
 
-class ChatterboxMultilingualTTS:
+class ChatterboxMultilingualTTS(ForkableTTS):
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
 
@@ -147,6 +152,7 @@ class ChatterboxMultilingualTTS:
         tokenizer: MTLTokenizer,
         device: str,
         conds: Conditionals = None,
+        asset_cache: ReferenceAssetCache = None,
     ):
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
@@ -155,6 +161,10 @@ class ChatterboxMultilingualTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        # downloads of remote reference clips (None: the process-wide `ReferenceAssetCache.shared()`)
+        self.asset_cache = asset_cache
+        self.t3_state = T3InferenceState()  # global RNG, so `torch.manual_seed` keeps working
+        self.t3_scheduler = None
         
         # Initialize watermarker, use dummy if not available
         try:
@@ -172,7 +182,13 @@ class ChatterboxMultilingualTTS:
         return SUPPORTED_LANGUAGES.copy()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxMultilingualTTS':
+    def from_local(cls, ckpt_dir, device, s3gen_backend="cfm", asset_cache=None) -> 'ChatterboxMultilingualTTS':
+        """
+        `s3gen_backend` picks the token-to-wav decoder (see `S3GEN_BACKENDS`): the 10-step "cfm" decoder of this
+        model, or the 2-step "meanflow" decoder of Chatterbox-Turbo (from `ckpt_dir` or downloaded).
+        `asset_cache` is the `ReferenceAssetCache` remote reference clips are fetched through.
+        """
+        assert s3gen_backend in S3GEN_BACKENDS, f"unknown S3Gen backend {s3gen_backend!r}, expected one of {S3GEN_BACKENDS}"
         ckpt_dir = Path(ckpt_dir)
         
         # Ensure device is a string for map_location
@@ -194,10 +210,13 @@ class ChatterboxMultilingualTTS:
         t3.load_state_dict(t3_state)
         t3.to(device).eval()
 
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            torch.load(ckpt_dir / "s3gen.pt", weights_only=True, map_location=device_str)
-        )
+        if s3gen_backend == "meanflow":
+            s3gen = load_meanflow_s3gen(ckpt_dir)
+        else:
+            s3gen = S3Gen()
+            s3gen.load_state_dict(
+                torch.load(ckpt_dir / "s3gen.pt", weights_only=True, map_location=device_str)
+            )
         s3gen.to(device).eval()
 
         tokenizer = MTLTokenizer(
@@ -207,76 +226,68 @@ class ChatterboxMultilingualTTS:
         conds = None
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=device_str).to(device)
+            conds.gen = s3gen.prepare_ref_dict(conds.gen)
 
-        return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        return cls(t3, s3gen, ve, tokenizer, device, conds=conds, asset_cache=asset_cache)
 
     @classmethod
-    def from_pretrained(cls, device: torch.device) -> 'ChatterboxMultilingualTTS':
+    def from_pretrained(cls, device: torch.device, s3gen_backend="cfm", asset_cache=None) -> 'ChatterboxMultilingualTTS':
+        allow_patterns = ["ve.pt", "t3_mtl23ls_v2.safetensors", "grapheme_mtl_merged_expanded_v1.json", "conds.pt", "Cangjie5_TC.json"]
+        if s3gen_backend == "cfm":
+            allow_patterns.append("s3gen.pt")
         ckpt_dir = Path(
             snapshot_download(
                 repo_id=REPO_ID,
                 repo_type="model",
                 revision="main", 
-                allow_patterns=["ve.pt", "t3_mtl23ls_v2.safetensors", "s3gen.pt", "grapheme_mtl_merged_expanded_v1.json", "conds.pt", "Cangjie5_TC.json"],
+                allow_patterns=allow_patterns,
                 token=os.getenv("HF_TOKEN"),
             )
         )
-        return cls.from_local(ckpt_dir, device)
+        return cls.from_local(ckpt_dir, device, s3gen_backend=s3gen_backend, asset_cache=asset_cache)
     
+    def enable_batching(self, max_batch_size=8):
+        """
+        Routes T3 decoding through a `T3BatchScheduler`, so that concurrent `generate` calls (eg. from forks in
+        several threads) are decoded in one batch. Forks created afterwards share the scheduler.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3BatchScheduler(self.t3, max_batch_size=max_batch_size)
+        return self.t3_scheduler
+
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        # Handle remote URLs by downloading to temporary file
-        if isinstance(wav_fpath, str) and (wav_fpath.startswith('http://') or wav_fpath.startswith('https://')):
+        self.conds = self.get_conditionals(wav_fpath, exaggeration=exaggeration)
+
+    def _load_reference(self, wav_fpath) -> ReferenceAudio:
+        "Decodes a reference clip from a local path or an http(s)/S3 URL, fetched through `asset_cache`."
+        if ReferenceAssetCache.is_remote(wav_fpath):
+            asset_cache = self.asset_cache or ReferenceAssetCache.shared()
             try:
-                # Create a temporary file with proper extension
-                parsed_url = urllib.parse.urlparse(wav_fpath)
-                file_ext = Path(parsed_url.path).suffix or '.flac'
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=file_ext)
-                temp_file.close()
-                
-                # Check if this is an S3 URL
-                s3_match = re.match(r'https?://([^.]+)\.s3(?:\.([^.]+))?\.amazonaws\.com/(.+)', wav_fpath)
-                if s3_match:
-                    # Use boto3 for S3 URLs (requires authentication)
-                    bucket_name = s3_match.group(1)
-                    region = s3_match.group(2) or 'us-east-1'  # Default to us-east-1 if no region
-                    object_key = s3_match.group(3)
-                    
-                    s3_client = boto3.client('s3', region_name=region)
-                    s3_client.download_file(bucket_name, object_key, temp_file.name)
-                else:
-                    # Use urllib for non-S3 URLs
-                    urllib.request.urlretrieve(wav_fpath, temp_file.name)
-                
-                actual_wav_path = temp_file.name
-                cleanup_temp = True
+                wav_fpath = asset_cache.fetch(wav_fpath)
             except Exception as e:
                 raise FileNotFoundError(f"Failed to download remote audio file {wav_fpath}: {str(e)}")
-        else:
-            actual_wav_path = wav_fpath
-            cleanup_temp = False
-        
-        try:
-            s3gen_ref_wav, _sr = librosa.load(actual_wav_path, sr=S3GEN_SR)
-        finally:
-            # Clean up temporary file if we created one
-            if cleanup_temp and os.path.exists(actual_wav_path):
-                os.unlink(actual_wav_path)
+        return ReferenceAudio.load(wav_fpath)
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+    def get_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        """
+        Builds the conditionals of a reference clip (local path or http(s)/S3 URL) without touching `self.conds`.
+        """
+        ## Load reference wav
+        # decoded once: each model takes its crop of it, at its rate
+        ref = self._load_reference(wav_fpath)
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = self.s3gen.embed_ref(ref.crop(self.DEC_COND_LEN / S3GEN_SR), device=self.device)
 
         # Speech cond prompt tokens
         t3_cond_prompt_tokens = None
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
+            t3_cond_prompt_wav = ref.crop(self.ENC_COND_LEN / S3_SR).wav(S3_SR)
+            t3_cond_prompt_tokens, _ = s3_tokzr.forward([t3_cond_prompt_wav], max_len=plen)
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
+        ve_embed = torch.from_numpy(self.ve.embeds_from_refs([ref]))
         ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
 
         t3_cond = T3Cond(
@@ -284,7 +295,21 @@ class ChatterboxMultilingualTTS:
             cond_prompt_speech_tokens=t3_cond_prompt_tokens,
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        return Conditionals(t3_cond, s3gen_ref_dict)
+
+    def enroll_voices(self, wav_fpaths, exaggeration=0.5, max_workers=8) -> List[Conditionals]:
+        """
+        Batched `get_conditionals` of several reference clips (eg. to import a voice library), see
+        `enroll_references`.
+        """
+        return enroll_references(
+            wav_fpaths, self.t3, self.s3gen, self.ve, Conditionals, self.device,
+            enc_cond_len=self.ENC_COND_LEN,
+            dec_cond_len=self.DEC_COND_LEN,
+            exaggeration=exaggeration,
+            max_workers=max_workers,
+            load=self._load_reference,
+        )
 
     def generate(
         self,
@@ -298,50 +323,45 @@ class ChatterboxMultilingualTTS:
         min_p=0.05,
         top_p=1.0,
         max_new_tokens=400,  # Default to 400 tokens (~8 seconds) for faster generation
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
     ):
-        # Validate language_id
-        if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
-            supported_langs = ", ".join(SUPPORTED_LANGUAGES.keys())
-            raise ValueError(
-                f"Unsupported language_id '{language_id}'. "
-                f"Supported languages: {supported_langs}"
-            )
-        
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
-
-        # Update exaggeration if needed
-        if float(exaggeration) != float(self.conds.t3.emotion_adv[0, 0, 0].item()):
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
-
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer.text_to_tokens(text, language_id=language_id.lower() if language_id else None).to(self.device)
-        text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+        """
+        Pass `conds` (eg. from `get_conditionals`) to call it from several threads, each on its own `fork()`;
+        see `chatterbox.workers` for the thread-safety contract.
 
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        `cfg_schedule` limits classifier-free guidance to the start of decoding, eg.
+        `CFGSchedule(until_started=True)` drops the unconditional row once the alignment settles.
+        """
+        conds, t3_cond, text_tokens = self._prepare_inputs(text, language_id, audio_prompt_path, exaggeration, conds)
 
         with torch.inference_mode():
-            speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
-                text_tokens=text_tokens,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                cfg_weight=cfg_weight,
-                repetition_penalty=repetition_penalty,
-                min_p=min_p,
-                top_p=top_p,
-            )
+            if self.t3_scheduler is not None:
+                speech_tokens = self.t3_scheduler.submit(
+                    t3_cond=t3_cond,
+                    text_tokens=text_tokens,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    cfg_weight=cfg_weight,
+                    cfg_schedule=cfg_schedule,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                    generator=self.t3_state.generator,
+                ).result()
+            else:
+                speech_tokens = self.t3.inference(
+                    t3_cond=t3_cond,
+                    text_tokens=text_tokens,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    cfg_weight=cfg_weight,
+                    cfg_schedule=cfg_schedule,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                    state=self.t3_state,
+                )
             # Extract only the conditional batch.
             speech_tokens = speech_tokens[0]
 
@@ -351,7 +371,7 @@ class ChatterboxMultilingualTTS:
 
             wav, _ = self.s3gen.inference(
                 speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+                ref_dict=conds.gen,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
@@ -361,3 +381,84 @@ class ChatterboxMultilingualTTS:
                 return watermarked_wav.detach().cpu().numpy()
             else:
                 return watermarked_wav
+
+    def generate_stream(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        max_new_tokens=400,
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
+        chunk_size=25,
+    ):
+        """
+        Streaming `generate`: yields `(wav, info)` as soon as audio is ready, with `wav` a watermarked (1, n)
+        chunk rendered from `chunk_size` more speech tokens (25 per second of audio) and `info` a
+        `StreamChunkInfo` (time to first audio, elapsed time, audio yielded so far).
+
+        NOTE: T3 always decodes on the calling thread here, even with a `t3_scheduler`, since the scheduler
+        only hands out finished sequences.
+        """
+        start_time = time.perf_counter()
+        conds, t3_cond, text_tokens = self._prepare_inputs(text, language_id, audio_prompt_path, exaggeration, conds)
+
+        token_blocks = self.t3.inference_stream(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            state=self.t3_state,
+            chunk_size=chunk_size,
+        )
+        try:
+            yield from stream_speech(
+                token_blocks, self.s3gen, self.watermarker, ref_dict=conds.gen, sr=self.sr, start_time=start_time,
+            )
+        finally:
+            # releases the KV cache and analyzer of `self.t3_state` as soon as the caller stops reading, not at GC
+            token_blocks.close()
+
+    def _prepare_inputs(self, text, language_id, audio_prompt_path, exaggeration, conds):
+        "Validates the language, resolves the conditionals and tokenizes `text` for T3 (two rows, for CFG)."
+        # Validate language_id
+        if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
+            supported_langs = ", ".join(SUPPORTED_LANGUAGES.keys())
+            raise ValueError(
+                f"Unsupported language_id '{language_id}'. "
+                f"Supported languages: {supported_langs}"
+            )
+        
+        if conds is None:
+            if audio_prompt_path:
+                self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
+
+        # Update exaggeration if needed
+        t3_cond: T3Cond = conds.t3
+        if float(exaggeration) != float(t3_cond.emotion_adv[0, 0, 0].item()):
+            t3_cond = t3_cond.with_exaggeration(exaggeration)
+
+        # Norm and tokenize text
+        text = punc_norm(text)
+        text_tokens = self.tokenizer.text_to_tokens(text, language_id=language_id.lower() if language_id else None).to(self.device)
+        text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
+        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return conds, t3_cond, text_tokens
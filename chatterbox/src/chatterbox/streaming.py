@@ -0,0 +1,120 @@
+import time
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .models.s3tokenizer import SPEECH_VOCAB_SIZE
+
+
+@dataclass
+class StreamChunkInfo:
+    """Timing of an audio chunk yielded by `generate_stream`, in seconds since the call."""
+    chunk_index: int
+    elapsed: float
+    time_to_first_audio: float
+    audio_seconds: float  # total audio yielded so far, including this chunk
+
+
+class StreamWatermarker:
+    """
+    Watermarks a waveform that arrives in chunks. The implicit (Perth) watermarker is meant for whole utterances,
+    not for short chunks cut at arbitrary points, so chunks are not watermarked on their own:
+        * each chunk is watermarked along with the last `context` seconds of audio before it, and only its own
+          samples are kept, so no sample is watermarked without left context;
+        * the last `overlap` seconds of each pass are held back, and cross-faded with their version from the next
+          pass, so that no seam is left where two passes meet.
+    This adds `overlap` seconds of latency; `flush` returns the held-back samples once the stream is done.
+    """
+
+    def __init__(self, watermarker, sr: int, context=1.0, overlap=0.02):
+        self.watermarker = watermarker
+        self.sr = sr
+        self.n_context = int(context * sr)
+        self.n_overlap = int(overlap * sr)
+        self._raw = np.zeros(0, dtype=np.float32)  # unwatermarked context, followed by the held-back samples
+        self._held = np.zeros(0, dtype=np.float32)  # watermarked samples not emitted yet (the end of `_raw`)
+
+    def push(self, wav: np.ndarray) -> np.ndarray:
+        "Watermarks the next chunk of the waveform, and returns the samples that are final."
+        wav = np.asarray(wav, dtype=np.float32)
+        if len(wav) == 0:
+            return wav
+        raw = np.concatenate([self._raw, wav])
+        watermarked = np.asarray(self.watermarker.apply_watermark(raw, sample_rate=self.sr), dtype=np.float32)
+        start = len(self._raw) - len(self._held)  # first sample not emitted yet
+        out = watermarked[start:]
+
+        # cross-fade the held-back samples from the previous pass into their new version
+        n_held = len(self._held)
+        if n_held > 0:
+            ramp = np.linspace(0.0, 1.0, n_held + 2, dtype=np.float32)[1:-1]
+            out = np.concatenate([self._held * (1.0 - ramp) + out[:n_held] * ramp, out[n_held:]])
+
+        n_emit = max(len(out) - self.n_overlap, 0)
+        self._held = out[n_emit:]
+        self._raw = raw[max(start + n_emit - self.n_context, 0):]
+        return out[:n_emit]
+
+    def flush(self) -> np.ndarray:
+        "The held-back samples, once the last chunk was pushed."
+        out, self._held = self._held, np.zeros(0, dtype=np.float32)
+        self._raw = np.zeros(0, dtype=np.float32)
+        return out
+
+
+def stream_speech(
+    token_blocks: Iterable[torch.Tensor],
+    s3gen,
+    watermarker,
+    ref_dict: dict,
+    sr: int,
+    n_cfm_timesteps=None,
+    tail_tokens: Optional[torch.Tensor] = None,
+    start_time: Optional[float] = None,
+) -> Iterator[Tuple[torch.Tensor, StreamChunkInfo]]:
+    """
+    Renders blocks of T3 speech tokens to watermarked (1, n) waveform chunks as they arrive, with their timing.
+
+    Special tokens (and everything from the stop token on) are dropped from each block; `tail_tokens` are
+    appended after the last one. The chunks are watermarked as one waveform (see `StreamWatermarker`), so the last
+    chunk is followed by a short one holding the held-back samples.
+    """
+    start_time = time.perf_counter() if start_time is None else start_time
+
+    def valid_blocks():
+        for block in token_blocks:
+            block = block[0]  # conditional row
+            invalid = (block >= SPEECH_VOCAB_SIZE).nonzero()
+            if len(invalid) > 0:
+                yield block[:invalid[0, 0]]
+                break
+            yield block
+        if tail_tokens is not None:
+            yield tail_tokens
+
+    def watermarked_chunks():
+        stream_watermarker = StreamWatermarker(watermarker, sr)
+        chunks = s3gen.inference_stream(valid_blocks(), ref_dict=ref_dict, n_cfm_timesteps=n_cfm_timesteps)
+        for chunk in chunks:
+            wav = stream_watermarker.push(chunk.squeeze(0).detach().cpu().numpy())
+            if len(wav) > 0:
+                yield wav
+        wav = stream_watermarker.flush()
+        if len(wav) > 0:
+            yield wav
+
+    ttfa, n_samples = None, 0
+    for index, wav in enumerate(watermarked_chunks()):
+        wav = torch.from_numpy(wav).unsqueeze(0)
+
+        elapsed = time.perf_counter() - start_time
+        ttfa = elapsed if ttfa is None else ttfa
+        n_samples += wav.size(1)
+        yield wav, StreamChunkInfo(
+            chunk_index=index,
+            elapsed=elapsed,
+            time_to_first_audio=ttfa,
+            audio_seconds=n_samples / sr,
+        )
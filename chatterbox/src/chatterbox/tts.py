@@ -1,7 +1,8 @@
+import time
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List
 
-import librosa
 import torch
 import perth
 import torch.nn.functional as F
@@ -10,10 +11,16 @@ from safetensors.torch import load_file
 
 from .models.t3 import T3
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen import S3GEN_SR, S3GEN_BACKENDS, DERIVED_REF_KEYS, S3Gen, load_meanflow_s3gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
+from .models.reference_audio import ReferenceAudio
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.inference_state import T3InferenceState
+from .models.t3.inference.cfg_schedule import CFGSchedule
+from .streaming import stream_speech
+from .enrollment import enroll_references
+from .workers import ForkableTTS
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -91,7 +98,8 @@ class Conditionals:
     def save(self, fpath: Path):
         arg_dict = dict(
             t3=self.t3.__dict__,
-            gen=self.gen
+            # (without the entries derived with the flow's weights, see `S3Gen.prepare_ref_dict`)
+            gen={k: v for k, v in self.gen.items() if k not in DERIVED_REF_KEYS},
         )
         torch.save(arg_dict, fpath)
 
@@ -103,7 +111,7 @@ class Conditionals:
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
 
-class ChatterboxTTS:
+class ChatterboxTTS(ForkableTTS):
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
 
@@ -123,10 +131,16 @@ class ChatterboxTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.t3_state = T3InferenceState()  # global RNG, so `torch.manual_seed` keeps working
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(cls, ckpt_dir, device, s3gen_backend="cfm") -> 'ChatterboxTTS':
+        """
+        `s3gen_backend` picks the token-to-wav decoder (see `S3GEN_BACKENDS`): the 10-step "cfm" decoder of this
+        model, or the 2-step "meanflow" decoder of Chatterbox-Turbo (from `ckpt_dir` or downloaded).
+        """
+        assert s3gen_backend in S3GEN_BACKENDS, f"unknown S3Gen backend {s3gen_backend!r}, expected one of {S3GEN_BACKENDS}"
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -148,10 +162,13 @@ class ChatterboxTTS:
         t3.load_state_dict(t3_state)
         t3.to(device).eval()
 
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
-        )
+        if s3gen_backend == "meanflow":
+            s3gen = load_meanflow_s3gen(ckpt_dir)
+        else:
+            s3gen = S3Gen()
+            s3gen.load_state_dict(
+                load_file(ckpt_dir / "s3gen.safetensors"), strict=False
+            )
         s3gen.to(device).eval()
 
         tokenizer = EnTokenizer(
@@ -161,11 +178,12 @@ class ChatterboxTTS:
         conds = None
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
+            conds.gen = s3gen.prepare_ref_dict(conds.gen)
 
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(cls, device, s3gen_backend="cfm") -> 'ChatterboxTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -174,28 +192,35 @@ class ChatterboxTTS:
                 print("MPS not available because the current MacOS version is not 12.3+ and/or you do not have an MPS-enabled device on this machine.")
             device = "cpu"
 
-        for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
+        fpaths = ["ve.safetensors", "t3_cfg.safetensors", "tokenizer.json", "conds.pt"]
+        if s3gen_backend == "cfm":
+            fpaths.append("s3gen.safetensors")
+        for fpath in fpaths:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, s3gen_backend=s3gen_backend)
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        self.conds = self.get_conditionals(wav_fpath, exaggeration=exaggeration)
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+    def get_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        """
+        Same as `prepare_conditionals`, but returns the `Conditionals` instead of storing them on the model.
+        """
+        ## Load reference wav (decoded once: each model takes its crop of it, at its rate)
+        ref = ReferenceAudio.load(wav_fpath)
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = self.s3gen.embed_ref(ref.crop(self.DEC_COND_LEN / S3GEN_SR), device=self.device)
 
         # Speech cond prompt tokens
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
+            t3_cond_prompt_wav = ref.crop(self.ENC_COND_LEN / S3_SR).wav(S3_SR)
+            t3_cond_prompt_tokens, _ = s3_tokzr.forward([t3_cond_prompt_wav], max_len=plen)
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
+        ve_embed = torch.from_numpy(self.ve.embeds_from_refs([ref]))
         ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
 
         t3_cond = T3Cond(
@@ -203,7 +228,20 @@ class ChatterboxTTS:
             cond_prompt_speech_tokens=t3_cond_prompt_tokens,
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        return Conditionals(t3_cond, s3gen_ref_dict)
+
+    def enroll_voices(self, wav_fpaths, exaggeration=0.5, max_workers=8) -> List[Conditionals]:
+        """
+        Batched `get_conditionals` of several reference clips (eg. to import a voice library), see
+        `enroll_references`.
+        """
+        return enroll_references(
+            wav_fpaths, self.t3, self.s3gen, self.ve, Conditionals, self.device,
+            enc_cond_len=self.ENC_COND_LEN,
+            dec_cond_len=self.DEC_COND_LEN,
+            exaggeration=exaggeration,
+            max_workers=max_workers,
+        )
 
     def generate(
         self,
@@ -215,43 +253,31 @@ class ChatterboxTTS:
         exaggeration=0.5,
         cfg_weight=0.5,
         temperature=0.8,
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
     ):
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+        """
+        Pass `conds` (eg. from `get_conditionals`) to call it from several threads, each on its own `fork()`;
+        see `chatterbox.workers` for the thread-safety contract.
 
-        # Update exaggeration if needed
-        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
-
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
-
-        if cfg_weight > 0.0:
-            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
-
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        `cfg_schedule` (eg. `CFGSchedule(max_tokens=50)`) stops CFG partway through decoding, which then
+        continues on the conditional row alone; by default CFG is applied to every token. `until_started`
+        schedules need the alignment analyzer of the multilingual model and raise a `ValueError` here.
+        """
+        conds, t3_cond, text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight, conds)
 
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
+                t3_cond=t3_cond,
                 text_tokens=text_tokens,
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
                 cfg_weight=cfg_weight,
+                cfg_schedule=cfg_schedule,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                state=self.t3_state,
             )
             # Extract only the conditional batch.
             speech_tokens = speech_tokens[0]
@@ -265,8 +291,78 @@ class ChatterboxTTS:
 
             wav, _ = self.s3gen.inference(
                 speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+                ref_dict=conds.gen,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
+        chunk_size=25,
+    ):
+        """
+        Like `generate`, but yields `(wav, info)` pairs while T3 is still sampling: every `chunk_size` speech
+        tokens (25 tokens = 1 s of audio) are rendered to a watermarked (1, n) waveform chunk. `info` is a
+        `StreamChunkInfo`, whose `time_to_first_audio` is the latency a listener perceives.
+        """
+        start_time = time.perf_counter()
+        conds, t3_cond, text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight, conds)
+
+        token_blocks = self.t3.inference_stream(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            state=self.t3_state,
+            chunk_size=chunk_size,
+        )
+        try:
+            yield from stream_speech(
+                token_blocks, self.s3gen, self.watermarker, ref_dict=conds.gen, sr=self.sr, start_time=start_time,
+            )
+        finally:
+            # releases the KV cache and analyzer of `self.t3_state` as soon as the caller stops reading, not at GC
+            token_blocks.close()
+
+    def _prepare_inputs(self, text, audio_prompt_path, exaggeration, cfg_weight, conds):
+        "Resolves the conditionals and tokenizes `text` for T3 (two rows with CFG)."
+        if conds is None:
+            if audio_prompt_path:
+                self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
+
+        # Update exaggeration if needed (on a per-call copy, the passed conds are never modified)
+        t3_cond: T3Cond = conds.t3
+        if exaggeration != t3_cond.emotion_adv[0, 0, 0]:
+            t3_cond = t3_cond.with_exaggeration(exaggeration)
+
+        # Norm and tokenize text
+        text = punc_norm(text)
+        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+
+        if cfg_weight > 0.0:
+            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
+        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return conds, t3_cond, text_tokens
@@ -1,9 +1,10 @@
 import os
 import math
+import time
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List
 
-import librosa
 import torch
 import perth
 import pyloudnorm as ln
@@ -14,12 +15,17 @@ from transformers import AutoTokenizer
 
 from .models.t3 import T3
 from .models.s3tokenizer import S3_SR
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen import S3GEN_SR, DERIVED_REF_KEYS, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
+from .models.reference_audio import ReferenceAudio
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.inference_state import T3InferenceState
 from .models.t3.modules.t3_config import T3Config
 from .models.s3gen.const import S3GEN_SIL
+from .streaming import stream_speech
+from .enrollment import enroll_references
+from .workers import ForkableTTS
 import logging
 logger = logging.getLogger(__name__)
 
@@ -95,7 +101,8 @@ class Conditionals:
     def save(self, fpath: Path):
         arg_dict = dict(
             t3=self.t3.__dict__,
-            gen=self.gen
+            # (without the entries derived with the flow's weights, see `S3Gen.prepare_ref_dict`)
+            gen={k: v for k, v in self.gen.items() if k not in DERIVED_REF_KEYS},
         )
         torch.save(arg_dict, fpath)
 
@@ -107,7 +114,7 @@ class Conditionals:
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
 
-class ChatterboxTurboTTS:
+class ChatterboxTurboTTS(ForkableTTS):
     ENC_COND_LEN = 15 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
 
@@ -127,6 +134,7 @@ class ChatterboxTurboTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.t3_state = T3InferenceState()  # global RNG, so `torch.manual_seed` keeps working
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
@@ -179,6 +187,7 @@ class ChatterboxTurboTTS:
         builtin_voice = ckpt_dir / "conds.pt"
         if builtin_voice.exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
+            conds.gen = s3gen.prepare_ref_dict(conds.gen)
 
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
@@ -215,27 +224,34 @@ class ChatterboxTurboTTS:
         return wav
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True):
-        ## Load and norm reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        self.conds = self.get_conditionals(wav_fpath, exaggeration=exaggeration, norm_loudness=norm_loudness)
+
+    def _load_reference(self, wav_fpath, norm_loudness=True) -> ReferenceAudio:
+        ref = ReferenceAudio.load(wav_fpath)
 
-        assert len(s3gen_ref_wav) / _sr > 5.0, "Audio prompt must be longer than 5 seconds!"
+        assert ref.duration > 5.0, "Audio prompt must be longer than 5 seconds!"
 
         if norm_loudness:
-            s3gen_ref_wav = self.norm_loudness(s3gen_ref_wav, _sr)
+            ref = ReferenceAudio(self.norm_loudness(ref.samples, ref.sr), ref.sr)
+        return ref
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+    def get_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True) -> Conditionals:
+        """Returns the conditionals for `wav_fpath`; unlike `prepare_conditionals`, `self.conds` is left as is."""
+        ## Load and norm reference wav
+        # decoded once: each model takes its crop of it, at its rate
+        ref = self._load_reference(wav_fpath, norm_loudness)
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = self.s3gen.embed_ref(ref.crop(self.DEC_COND_LEN / S3GEN_SR), device=self.device)
 
         # Speech cond prompt tokens
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
+            t3_cond_prompt_wav = ref.crop(self.ENC_COND_LEN / S3_SR).wav(S3_SR)
+            t3_cond_prompt_tokens, _ = s3_tokzr.forward([t3_cond_prompt_wav], max_len=plen)
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
+        ve_embed = torch.from_numpy(self.ve.embeds_from_refs([ref]))
         ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
 
         t3_cond = T3Cond(
@@ -243,7 +259,21 @@ class ChatterboxTurboTTS:
             cond_prompt_speech_tokens=t3_cond_prompt_tokens,
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        return Conditionals(t3_cond, s3gen_ref_dict)
+
+    def enroll_voices(self, wav_fpaths, exaggeration=0.5, norm_loudness=True, max_workers=8) -> List[Conditionals]:
+        """
+        Batched `get_conditionals` of several reference clips (eg. to import a voice library), see
+        `enroll_references`.
+        """
+        return enroll_references(
+            wav_fpaths, self.t3, self.s3gen, self.ve, Conditionals, self.device,
+            enc_cond_len=self.ENC_COND_LEN,
+            dec_cond_len=self.DEC_COND_LEN,
+            exaggeration=exaggeration,
+            max_workers=max_workers,
+            load=lambda wav_fpath: self._load_reference(wav_fpath, norm_loudness),
+        )
 
     def generate(
         self,
@@ -257,27 +287,24 @@ class ChatterboxTurboTTS:
         temperature=0.8,
         top_k=1000,
         norm_loudness=True,
+        conds: Conditionals = None,
     ):
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
-
-        if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
-            logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
-
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
-        text_tokens = text_tokens.input_ids.to(self.device)
+        """
+        Pass `conds` (eg. from `get_conditionals`) to call it from several threads, each on its own `fork()`;
+        see `chatterbox.workers` for the thread-safety contract.
+        """
+        conds, text_tokens = self._prepare_inputs(
+            text, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness, conds,
+        )
 
         speech_tokens = self.t3.inference_turbo(
-            t3_cond=self.conds.t3,
+            t3_cond=conds.t3,
             text_tokens=text_tokens,
             temperature=temperature,
             top_k=top_k,
             top_p=top_p,
             repetition_penalty=repetition_penalty,
+            state=self.t3_state,
         )
 
         # Remove OOV tokens and add silence to end
@@ -288,9 +315,72 @@ class ChatterboxTurboTTS:
 
         wav, _ = self.s3gen.inference(
             speech_tokens=speech_tokens,
-            ref_dict=self.conds.gen,
+            ref_dict=conds.gen,
             n_cfm_timesteps=2,
         )
         wav = wav.squeeze(0).detach().cpu().numpy()
         watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.00,
+        top_p=0.95,
+        audio_prompt_path=None,
+        exaggeration=0.0,
+        cfg_weight=0.0,
+        temperature=0.8,
+        top_k=1000,
+        norm_loudness=True,
+        conds: Conditionals = None,
+        chunk_size=25,
+    ):
+        """
+        Yields `(wav, info)` while the tokens are still being sampled, instead of returning the whole
+        utterance: `wav` is a watermarked (1, n) chunk covering `chunk_size` more speech tokens (1 s per 25),
+        `info` a `StreamChunkInfo` with the time to first audio.
+        """
+        start_time = time.perf_counter()
+        conds, text_tokens = self._prepare_inputs(
+            text, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness, conds,
+        )
+
+        token_blocks = self.t3.inference_turbo_stream(
+            t3_cond=conds.t3,
+            text_tokens=text_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            state=self.t3_state,
+            chunk_size=chunk_size,
+        )
+        silence = torch.tensor([S3GEN_SIL, S3GEN_SIL, S3GEN_SIL]).long().to(self.device)
+        try:
+            yield from stream_speech(
+                token_blocks, self.s3gen, self.watermarker, ref_dict=conds.gen, sr=self.sr,
+                n_cfm_timesteps=2, tail_tokens=silence, start_time=start_time,
+            )
+        finally:
+            # stops decoding as soon as the caller stops reading, not at GC
+            token_blocks.close()
+
+    def _prepare_inputs(self, text, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness, conds):
+        "Resolves the conditionals and tokenizes `text` with the GPT-2 tokenizer."
+        if conds is None:
+            if audio_prompt_path:
+                self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
+
+        if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
+            logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
+
+        # Norm and tokenize text
+        text = punc_norm(text)
+        text_tokens = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
+        text_tokens = text_tokens.input_ids.to(self.device)
+        return conds, text_tokens
@@ -8,6 +8,7 @@ from safetensors.torch import load_file
 
 from .models.s3tokenizer import S3_SR
 from .models.s3gen import S3GEN_SR, S3Gen
+from .models.reference_audio import ReferenceAudio
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -75,10 +76,8 @@ class ChatterboxVC:
 
     def set_target_voice(self, wav_fpath):
         ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        self.ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        ref = ReferenceAudio.load(wav_fpath)
+        self.ref_dict = self.s3gen.embed_ref(ref.crop(self.DEC_COND_LEN / S3GEN_SR), device=self.device)
 
     def generate(
         self,
@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+from .mtl_tts import Conditionals
+
+
+logger = logging.getLogger(__name__)
+
+# Version of persisted conditionals: bump it whenever the conditionals of a clip change (embedding models, crop
+# lengths, serialization), so that stale files and shipped artifacts are ignored rather than loaded.
+CONDS_ARTIFACT_VERSION = 1
+
+
+def content_hash(src: Union[str, Path, bytes], asset_cache=None) -> str:
+    """
+    sha256 of a reference clip. Raw bytes and local files are hashed by content. Remote URLs are
+    hashed by content through `asset_cache` (a `ReferenceAssetCache`, which downloads them once and
+    then only revalidates them); without one, by the URL itself.
+    """
+    if asset_cache is not None and asset_cache.is_remote(src):
+        return asset_cache.content_hash(src)
+    h = hashlib.sha256()
+    if isinstance(src, bytes):
+        h.update(src)
+    elif Path(str(src)).is_file():
+        with open(src, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    else:
+        h.update(str(src).encode("utf-8"))
+    return h.hexdigest()
+
+
+def with_exaggeration(conds: Conditionals, exaggeration: float) -> Conditionals:
+    """
+    Returns a new `Conditionals` that shares every tensor with `conds` except `t3.emotion_adv` (see
+    `T3Cond.with_exaggeration`). The `gen` dict is shallow-copied because `S3Gen` casts its values in place.
+    """
+    return Conditionals(conds.t3.with_exaggeration(exaggeration), dict(conds.gen))
+
+
+class VoiceConditioningStore:
+    """
+    Caches the `Conditionals` of reference voices so that a clip is only embedded once.
+
+    Entries are keyed by `(voice_id, content_hash)`, so a voice whose clip changes gets a new entry.
+    They are kept in memory with an LRU bound and persisted to `cache_dir` via `Conditionals.save`,
+    so they also survive restarts. Entries are stored once per voice; exaggeration is applied per
+    request by swapping `emotion_adv` (see `with_exaggeration`).
+    """
+
+    def __init__(self, cache_dir=None, max_entries=32, device="cpu"):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.device = device
+        self._entries = OrderedDict()  # key -> Conditionals
+        self._lock = threading.Lock()
+        self._build_locks = {}  # key -> Lock, so concurrent misses build only once
+
+    @staticmethod
+    def key(voice_id: str, chash: str) -> str:
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", voice_id)
+        return f"{safe_id}-{chash[:16]}"
+
+    @staticmethod
+    def artifact_name(voice_id: str, chash: str) -> str:
+        "File name of the persisted conditionals of a voice, also used for artifacts shipped alongside its audio."
+        return f"{VoiceConditioningStore.key(voice_id, chash)}.v{CONDS_ARTIFACT_VERSION}.pt"
+
+    def _path(self, key: str) -> Optional[Path]:
+        return None if self.cache_dir is None else self.cache_dir / f"{key}.v{CONDS_ARTIFACT_VERSION}.pt"
+
+    def artifact_path(self, voice_id: str, chash: str) -> Optional[Path]:
+        "Path of the persisted conditionals of a voice, if it has been `put` (and the store has a `cache_dir`)."
+        path = self._path(self.key(voice_id, chash))
+        return path if path is not None and path.exists() else None
+
+    def _remember(self, key: str, conds: Conditionals):
+        with self._lock:
+            self._entries[key] = conds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                logger.debug(f"Evicted voice conditionals {evicted}")
+
+    def _lookup(self, key: str) -> Optional[Conditionals]:
+        with self._lock:
+            conds = self._entries.get(key)
+            if conds is not None:
+                self._entries.move_to_end(key)
+                return conds
+
+        path = self._path(key)
+        if path is not None and path.exists():
+            try:
+                conds = Conditionals.load(path, map_location="cpu").to(self.device)
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable voice conditionals {path}: {e}")
+                return None
+            self._remember(key, conds)
+            return conds
+        return None
+
+    def get(self, voice_id: str, chash: str, exaggeration: Optional[float] = None) -> Optional[Conditionals]:
+        conds = self._lookup(self.key(voice_id, chash))
+        if conds is None or exaggeration is None:
+            return conds
+        return with_exaggeration(conds, exaggeration)
+
+    def put(self, voice_id: str, chash: str, conds: Conditionals):
+        key = self.key(voice_id, chash)
+        path = self._path(key)
+        if path is not None:
+            # write-then-rename so a concurrent reader never sees a partial file; the temp file is unique because
+            # pool workers may persist the same voice at once
+            fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            os.close(fd)
+            try:
+                conds.save(tmp_name)
+                os.replace(tmp_name, path)
+            except BaseException:
+                Path(tmp_name).unlink(missing_ok=True)
+                raise
+        self._remember(key, conds)
+
+    def get_or_create(
+        self,
+        voice_id: str,
+        chash: str,
+        build_fn: Callable[[], Conditionals],
+        exaggeration: Optional[float] = None,
+    ) -> Conditionals:
+        """
+        Returns the cached conditionals for this voice, calling `build_fn` (eg. `prepare_conditionals`)
+        on a miss. Concurrent misses for the same key wait for a single build.
+        """
+        key = self.key(voice_id, chash)
+        conds = self._lookup(key)
+        if conds is None:
+            with self._lock:
+                build_lock = self._build_locks.setdefault(key, threading.Lock())
+            with build_lock:
+                conds = self._lookup(key)
+                if conds is None:
+                    logger.info(f"Building voice conditionals for '{voice_id}' ({key})")
+                    conds = build_fn()
+                    self.put(voice_id, chash, conds)
+            with self._lock:
+                self._build_locks.pop(key, None)
+
+        if exaggeration is None:
+            return conds
+        return with_exaggeration(conds, exaggeration)
+
+    def invalidate(self, voice_id: str):
+        """Drops every entry of `voice_id`, in memory and on disk."""
+        safe_id = self.key(voice_id, "")[:-1]
+        with self._lock:
+            for key in [k for k in self._entries if k.rsplit("-", 1)[0] == safe_id]:
+                del self._entries[key]
+        if self.cache_dir is not None:
+            for path in self.cache_dir.glob(f"{safe_id}-*.pt"):
+                if path.stem.rsplit("-", 1)[0] == safe_id:
+                    path.unlink(missing_ok=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
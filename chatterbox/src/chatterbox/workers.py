@@ -0,0 +1,31 @@
+"""
+Thread-safety contract of the TTS models (`ChatterboxTTS`, `ChatterboxTurboTTS`, `ChatterboxMultilingualTTS`):
+
+- `generate(..., conds=...)` and `generate_stream(..., conds=...)` read the modules of the model and write nothing
+  on the instance except its sampling state, `t3_state`. `conds` is left untouched (exaggeration is applied to a
+  copy), so one `Conditionals` can be shared by any number of calls.
+- Without `conds`, `self.conds` is used, and `audio_prompt_path` replaces it: that form must not be called
+  concurrently.
+- `fork()` returns a worker that shares every module with its model (T3, S3Gen, voice encoder, tokenizer,
+  watermarker, and the T3 batch scheduler if any) and owns only its `conds` and `t3_state`. Concurrent calls must
+  each run on their own fork, with `conds`.
+- T3 decoding is safe to run from several forks at once. S3Gen and the watermarker are shared too, but are not
+  guaranteed to be thread-safe, so a server that needs strict isolation keeps one full model per worker (see
+  `MODEL_POOL_SHARED_WEIGHTS` in api_server.py).
+"""
+import copy
+
+from .models.t3.inference.inference_state import T3InferenceState
+
+
+class ForkableTTS:
+    "Mixin of the TTS models providing `fork`, see the module docstring for what it shares."
+
+    def fork(self, seed=None):
+        """
+        Returns a worker over the same modules (no weights are copied) with its own sampling state, seeded with
+        `seed` (random if None). Meant for one worker thread calling `generate(conds=...)`, see `chatterbox.workers`.
+        """
+        worker = copy.copy(self)
+        worker.t3_state = T3InferenceState.create(self.device, seed)
+        return worker
@@ -0,0 +1,111 @@
+"""
+`ReferenceAssetCache` against a local HTTP server standing in for S3 / a CDN (it answers conditional requests with
+304, like them): how many requests each fetch makes, and which blob it serves.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from chatterbox.asset_cache import ReferenceAssetCache
+
+
+@pytest.fixture
+def origin(tmp_path):
+    "Serves `voice.wav`, recording the status of every response; `delay` slows down each request."
+    serve_dir = tmp_path / "origin"
+    serve_dir.mkdir()
+    origin = SimpleNamespace(statuses=[], delay=0.0, clip=serve_dir / "voice.wav")
+
+    class Handler(SimpleHTTPRequestHandler):
+        def send_response(self, code, message=None):
+            origin.statuses.append(code)
+            super().send_response(code, message)
+
+        def do_GET(self):
+            time.sleep(origin.delay)
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=str(serve_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin.url = f"http://127.0.0.1:{server.server_address[1]}/{origin.clip.name}"
+    write_clip(origin, b"take 1" * 1000, mtime=1_700_000_000)
+    yield origin
+    server.shutdown()
+    server.server_close()
+
+
+def write_clip(origin, data, mtime):
+    # Last-Modified has a 1s resolution: set it rather than sleep between versions
+    origin.clip.write_bytes(data)
+    os.utime(origin.clip, (mtime, mtime))
+
+
+def test_fresh_fetch_makes_no_request(origin, tmp_path):
+    cache = ReferenceAssetCache(cache_dir=tmp_path / "cache", revalidate_after=3600)
+    blob = cache.fetch(origin.url)
+    assert origin.statuses == [200]
+    assert blob.read_bytes() == origin.clip.read_bytes()
+
+    assert cache.fetch(origin.url) == blob
+    assert origin.statuses == [200]
+
+
+def test_not_modified_keeps_the_blob(origin, tmp_path):
+    cache = ReferenceAssetCache(cache_dir=tmp_path / "cache", revalidate_after=0)
+    blob = cache.fetch(origin.url)
+
+    assert cache.fetch(origin.url) == blob
+    assert cache.fetch(origin.url) == blob
+    assert origin.statuses == [200, 304, 304]
+    assert len(list((tmp_path / "cache" / "blobs").iterdir())) == 1
+
+
+def test_changed_clip_gets_a_new_blob(origin, tmp_path):
+    cache = ReferenceAssetCache(cache_dir=tmp_path / "cache", revalidate_after=0)
+    old_blob = cache.fetch(origin.url)
+    old_hash = cache.content_hash(origin.url)
+
+    write_clip(origin, b"take 2" * 1000, mtime=1_700_000_010)
+    new_blob = cache.fetch(origin.url)
+    assert new_blob != old_blob
+    assert new_blob.read_bytes() == b"take 2" * 1000
+    assert old_blob.read_bytes() == b"take 1" * 1000
+    assert cache.content_hash(origin.url) != old_hash
+    assert origin.statuses == [200, 304, 200, 304]
+
+
+def test_restart_reuses_the_record_on_disk(origin, tmp_path):
+    blob = ReferenceAssetCache(cache_dir=tmp_path / "cache", revalidate_after=3600).fetch(origin.url)
+
+    # within `revalidate_after` of the first download, even in another process
+    assert ReferenceAssetCache(cache_dir=tmp_path / "cache", revalidate_after=3600).fetch(origin.url) == blob
+    assert origin.statuses == [200]
+    # after it, revalidated rather than downloaded again
+    assert ReferenceAssetCache(cache_dir=tmp_path / "cache", revalidate_after=0).fetch(origin.url) == blob
+    assert origin.statuses == [200, 304]
+    assert not list((tmp_path / "cache" / "urls").glob("*.tmp"))
+
+
+@pytest.mark.parametrize("n", [2, 8])
+def test_concurrent_cold_fetches_download_once(origin, tmp_path, n):
+    cache = ReferenceAssetCache(cache_dir=tmp_path / "cache")
+    origin.delay = 0.2  # so the fetches overlap
+    barrier = threading.Barrier(n)
+
+    def fetch(_):
+        barrier.wait()
+        return cache.fetch(origin.url)
+
+    with ThreadPoolExecutor(n) as pool:
+        blobs = set(pool.map(fetch, range(n)))
+    assert origin.statuses == [200]
+    assert len(blobs) == 1
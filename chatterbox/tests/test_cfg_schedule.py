@@ -0,0 +1,34 @@
+"""
+`CFGSchedule` parsing, and the rejection of `until_started` on models without an alignment analyzer.
+"""
+import pytest
+
+from chatterbox.models.t3.inference.cfg_schedule import CFGSchedule
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("always", CFGSchedule()),
+    ("first:30", CFGSchedule(max_tokens=30)),
+    ("until_started", CFGSchedule(until_started=True)),
+    ("first:30+until_started", CFGSchedule(max_tokens=30, until_started=True)),
+])
+def test_parse(spec, expected):
+    assert CFGSchedule.parse(spec) == expected
+
+
+def test_parse_rejects_unknown_criteria():
+    with pytest.raises(ValueError):
+        CFGSchedule.parse("until_done")
+
+
+def test_until_started_needs_an_analyzer():
+    CFGSchedule(max_tokens=30).validate(has_alignment_analyzer=False)
+    CFGSchedule(until_started=True).validate(has_alignment_analyzer=True)
+    with pytest.raises(ValueError, match="alignment analyzer"):
+        CFGSchedule(max_tokens=30, until_started=True).validate(has_alignment_analyzer=False)
+
+
+def test_keep_cfg():
+    schedule = CFGSchedule(max_tokens=3)
+    assert [schedule.keep_cfg(n) for n in range(5)] == [True, True, True, False, False]
+    assert CFGSchedule().keep_cfg(10_000)
@@ -0,0 +1,61 @@
+"""
+`enroll_voices` (batched) must give the same conditionals as `get_conditionals` called once per clip. Checked
+with randomly initialized conditioning models on synthetic clips, including two of equal length (embedded in one
+CAMPPlus / tokenizer batch) and one at another sample rate.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+from chatterbox.models.s3gen import S3Gen
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.voice_encoder import VoiceEncoder
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    # only the T3 config is used to embed references, so the T3 weights are not built
+    t3 = SimpleNamespace(hp=T3Config.english_only())
+    return ChatterboxTTS(t3, S3Gen().eval(), VoiceEncoder().eval(), tokenizer=None, device="cpu")
+
+
+@pytest.fixture
+def clips(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i, (seconds, sr) in enumerate([(3.0, 24000), (4.5, 24000), (4.5, 24000), (5.2, 44100), (12.0, 16000)]):
+        t = np.arange(int(seconds * sr)) / sr
+        wav = 0.3 * np.sin(2 * np.pi * (120 + 40 * i) * t) * (1 + np.sin(2 * np.pi * 3 * t))
+        wav += 0.05 * rng.standard_normal(len(t))
+        path = tmp_path / f"clip_{i}.wav"
+        sf.write(path, wav.astype(np.float32), sr)
+        paths.append(str(path))
+    return paths
+
+
+def assert_same_conds(a, b):
+    torch.testing.assert_close(a.t3.speaker_emb, b.t3.speaker_emb, rtol=1e-4, atol=1e-5)
+    assert torch.equal(a.t3.cond_prompt_speech_tokens, b.t3.cond_prompt_speech_tokens)
+    torch.testing.assert_close(a.t3.emotion_adv, b.t3.emotion_adv)
+    assert a.gen.keys() == b.gen.keys()
+    for key, value in a.gen.items():
+        if torch.is_tensor(value) and value.is_floating_point():
+            torch.testing.assert_close(value, b.gen[key], rtol=1e-4, atol=1e-4, msg=key)
+        elif torch.is_tensor(value):
+            assert torch.equal(value, b.gen[key]), key
+        else:
+            assert value == b.gen[key], key
+
+
+def test_enroll_voices_matches_get_conditionals(model, clips):
+    sequential = [model.get_conditionals(path, exaggeration=0.7) for path in clips]
+    batched = model.enroll_voices(clips, exaggeration=0.7, max_workers=3)
+
+    assert len(batched) == len(clips)
+    for a, b in zip(sequential, batched):
+        assert_same_conds(a, b)
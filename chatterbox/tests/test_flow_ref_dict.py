@@ -0,0 +1,54 @@
+"""
+The flow must render the same mels from a ref dict whose reference-only inputs were precomputed by
+`S3Gen.prepare_ref_dict` (projected x-vector, masked prompt mels) as from the bare ref dict: for one voice, and for
+a batch of voices with prompts of different lengths. Checked on a randomly initialized S3Gen.
+"""
+import pytest
+import torch
+
+from chatterbox.models.s3gen import DERIVED_REF_KEYS, S3Gen
+
+
+@pytest.fixture(scope="module")
+def s3gen():
+    torch.manual_seed(0)
+    return S3Gen().eval()
+
+
+def make_ref(seed, n_tokens):
+    g = torch.Generator().manual_seed(seed)
+    return dict(
+        prompt_token=torch.randint(0, 6561, (1, n_tokens), generator=g),
+        prompt_token_len=torch.tensor([n_tokens]),
+        prompt_feat=torch.randn(1, 2 * n_tokens, 80, generator=g),
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192, generator=g),
+    )
+
+
+def bare(ref_dict):
+    return {k: v for k, v in ref_dict.items() if k not in DERIVED_REF_KEYS}
+
+
+def render(s3gen, tokens, ref_dict, lens=None):
+    torch.manual_seed(1)  # same CFM noise
+    return s3gen.flow_inference(tokens, ref_dict=ref_dict, n_cfm_timesteps=2, finalize=True, speech_token_lens=lens)
+
+
+def test_precomputed_ref_matches_bare_ref(s3gen):
+    ref_dict = make_ref(0, n_tokens=30)
+    prepared = s3gen.prepare_ref_dict(ref_dict)
+    assert set(DERIVED_REF_KEYS) <= prepared.keys()
+    assert not set(DERIVED_REF_KEYS) & ref_dict.keys()  # the caller's dict is left as it is
+
+    tokens = torch.randint(0, 6561, (1, 20), generator=torch.Generator().manual_seed(2))
+    torch.testing.assert_close(render(s3gen, tokens, prepared), render(s3gen, tokens, ref_dict))
+
+
+def test_precomputed_ragged_batch_matches_bare_ref(s3gen):
+    collated = s3gen.collate_ref_dicts([make_ref(3, n_tokens=30), make_ref(4, n_tokens=22)])
+    assert set(DERIVED_REF_KEYS) <= collated.keys()
+
+    tokens = torch.randint(0, 6561, (2, 20), generator=torch.Generator().manual_seed(5))
+    lens = torch.tensor([20, 14])
+    torch.testing.assert_close(render(s3gen, tokens, collated, lens), render(s3gen, tokens, bare(collated), lens))
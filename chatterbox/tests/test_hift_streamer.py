@@ -0,0 +1,84 @@
+"""
+`HiFTStreamer` must vocode an utterance pushed in chunks as one `HiFTGenerator.inference` pass over the whole mel
+does: checked on a small random HiFT, with chunks of any size, against the receptive field of `decode` and the
+chunk-invariance of the NSF source.
+"""
+import pytest
+import torch
+
+from chatterbox.models.s3gen.f0_predictor import ConvRNNF0Predictor
+from chatterbox.models.s3gen.hifigan import HiFTGenerator, HiFTStreamer
+
+
+@pytest.fixture
+def hift():
+    torch.manual_seed(0)
+    hift = HiFTGenerator(
+        base_channels=32,
+        nb_harmonics=2,
+        sampling_rate=24000,
+        upsample_rates=[4, 3],
+        upsample_kernel_sizes=[8, 7],
+        istft_params={"n_fft": 8, "hop_len": 2},
+        resblock_kernel_sizes=[3, 5],
+        resblock_dilation_sizes=[[1, 3], [1, 3]],
+        source_resblock_kernel_sizes=[5, 3],
+        source_resblock_dilation_sizes=[[1, 3], [1, 3]],
+        f0_predictor=ConvRNNF0Predictor(cond_channels=16),
+    )
+    with torch.no_grad():
+        hift.f0_predictor.classifier.bias.fill_(150.0)  # voiced, so that the sine path is exercised
+    return hift.eval()
+
+
+def hop(hift):
+    return int(hift.f0_upsamp.scale_factor)
+
+
+def make_mel(seed, n_frames):
+    return torch.randn(1, 80, n_frames, generator=torch.Generator().manual_seed(seed))
+
+
+def test_receptive_field_is_the_dependency_span(hift):
+    "The samples of a frame depend on the mel and source frames exactly `receptive_field()` away, not further."
+    n_frames, t, H = 64, 32, hop(hift)
+    mel = make_mel(0, n_frames).requires_grad_()
+    source = torch.randn(1, 1, n_frames * H, generator=torch.Generator().manual_seed(1)).requires_grad_()
+    wav = hift.decode(x=mel, s=source)
+    wav[:, t * H:(t + 1) * H].sum().backward()
+
+    mel_frames = mel.grad[0].abs().sum(0).nonzero()
+    source_frames = source.grad[0, 0].nonzero() // H
+    first = min(mel_frames.min().item(), source_frames.min().item())
+    last = max(mel_frames.max().item(), source_frames.max().item())
+    assert max(t - first, last - t) == hift.receptive_field()
+
+
+def test_source_does_not_depend_on_chunking(hift):
+    f0 = 100 + 200 * torch.rand(2, 40, 1, generator=torch.Generator().manual_seed(2))
+    f0[:, 10:15] = 0  # unvoiced
+    torch.manual_seed(3)
+    whole, _, _ = hift.m_source(f0)
+
+    torch.manual_seed(3)
+    state = {}
+    chunks = [hift.m_source(f0[:, a:b], sine_state=state)[0] for a, b in [(0, 7), (7, 8), (8, 33), (33, 40)]]
+    assert torch.equal(torch.cat(chunks, dim=1), whole)
+
+
+@pytest.mark.parametrize("chunks", [[48], [1] * 48, [5, 17, 3, 14, 9]])
+def test_streamed_matches_inference(hift, chunks):
+    mel = make_mel(4, sum(chunks))
+    torch.manual_seed(5)
+    expected, _ = hift.inference(mel)
+
+    torch.manual_seed(5)
+    streamer = HiFTStreamer(hift)
+    wavs, start = [], 0
+    for i, n in enumerate(chunks):
+        wavs.append(streamer.push(mel[:, :, start:start + n], finalize=i == len(chunks) - 1))
+        start += n
+    streamed = torch.cat(wavs, dim=1)
+
+    assert streamed.shape == expected.shape
+    torch.testing.assert_close(streamed, expected, rtol=0, atol=1e-6)
@@ -0,0 +1,67 @@
+"""
+`prefix_cache_key` identifies a conditioning by content, reading its tensors back from the device only once per
+voice: per-request copies made with `T3Cond.with_exaggeration` reuse the digest of the voice.
+"""
+import pytest
+import torch
+
+from chatterbox.models.t3.inference.prefix_cache import prefix_cache_key
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+
+
+def make_cond(seed, exaggeration=0.5):
+    g = torch.Generator().manual_seed(seed)
+    return T3Cond(
+        speaker_emb=torch.randn(1, 256, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 150), generator=g),
+        emotion_adv=exaggeration * torch.ones(1, 1, 1),
+    )
+
+
+def key(cond):
+    return prefix_cache_key(cond, torch.float32, "cpu")
+
+
+def test_equal_content_same_key():
+    assert key(make_cond(0)) == key(make_cond(0))
+    assert key(make_cond(0)) != key(make_cond(1))
+    assert key(make_cond(0, exaggeration=0.5)) != key(make_cond(0, exaggeration=0.7))
+    assert prefix_cache_key(make_cond(0), torch.float32, "cpu") != prefix_cache_key(make_cond(0), torch.float16, "cpu")
+
+
+def test_with_exaggeration_does_not_read_the_tensors(monkeypatch):
+    voice = make_cond(0)
+    key(voice)
+
+    def no_read(self, names):
+        raise AssertionError(f"read back {names}")
+
+    monkeypatch.setattr(T3Cond, "_digest", no_read)
+    a, b, c = voice.with_exaggeration(0.7), voice.with_exaggeration(0.7), voice.with_exaggeration(0.3)
+    assert a.speaker_emb is voice.speaker_emb
+    assert torch.equal(a.emotion_adv, 0.7 * torch.ones(1, 1, 1))
+    assert key(a) == key(b)
+    assert key(a) != key(c)
+    assert key(a) != key(voice)
+
+
+def test_cached_digest_is_dropped_on_dtype_cast():
+    cond = make_cond(0)
+    before = key(cond)
+    cond.to(dtype=torch.float16)
+    assert key(cond) != before
+    assert key(cond) == key(make_cond(0).to(dtype=torch.float16))
+
+
+@pytest.mark.parametrize("exaggeration", [0.5, 0.7, 1.3])
+def test_with_exaggeration_keys_like_a_fresh_cond(exaggeration):
+    "The same voice at the same exaggeration hits the same prefix cache entry, whichever way it was built."
+    assert key(make_cond(0, exaggeration=0.5).with_exaggeration(exaggeration)) == key(make_cond(0, exaggeration))
+
+
+@pytest.mark.parametrize("exaggeration", [0.5, 0.7])
+def test_digest_survives_save_and_load(tmp_path, exaggeration):
+    cond = make_cond(0).with_exaggeration(exaggeration)
+    expected = key(cond)
+    cond.save(tmp_path / "cond.pt")
+    assert key(T3Cond.load(tmp_path / "cond.pt")) == expected
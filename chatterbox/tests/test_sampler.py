@@ -0,0 +1,174 @@
+"""
+`process_logits` must filter the logits exactly as the HF processor chains it replaces: the one of `T3.inference`
+(repetition penalty first) and the one of the turbo model (repetition penalty last), with scalar, per-row list and
+tensor parameters alike.
+"""
+import math
+
+import pytest
+import torch
+from transformers import (
+    LogitsProcessorList,
+    MinPLogitsWarper,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from chatterbox.models.t3.inference.sampler import TOP_K_PREFILTER, T3Sampler, process_logits, sample_next_tokens
+
+
+V = 6563
+
+
+def make_logits(seed, batch_size=3, scale=4.0):
+    "Peaked enough for a top-p < 1 nucleus to fit in the prefilter, like a trained model's."
+    g = torch.Generator().manual_seed(seed)
+    return scale * torch.randn(batch_size, V, generator=g)
+
+
+def make_history(seed, batch_size=3, n=40):
+    g = torch.Generator().manual_seed(seed)
+    return torch.randint(0, V, (batch_size, n), generator=g)
+
+
+def counts(history):
+    token_counts = torch.zeros(history.size(0), V, dtype=torch.int32)
+    return token_counts.scatter_add_(1, history, torch.ones_like(history, dtype=torch.int32))
+
+
+def hf_inference_chain(history, logits, temperature, min_p, top_p, repetition_penalty):
+    "The processors of the original `T3.inference`."
+    logits = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)(history, logits.clone())
+    if temperature != 1.0:
+        logits = logits / temperature
+    logits = MinPLogitsWarper(min_p=min_p)(history, logits)
+    return TopPLogitsWarper(top_p=top_p)(history, logits)
+
+
+def hf_turbo_chain(history, logits, temperature, top_k, top_p, repetition_penalty):
+    "The processors of the original `T3.inference_turbo`."
+    processors = LogitsProcessorList()
+    if temperature > 0 and temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if top_k > 0:
+        processors.append(TopKLogitsWarper(top_k))
+    if top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    if repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    return processors(history, logits.clone())
+
+
+def assert_same_logits(actual, expected):
+    assert torch.equal(torch.isinf(actual), torch.isinf(expected))
+    finite = ~torch.isinf(expected)
+    torch.testing.assert_close(actual[finite], expected[finite])
+
+
+def per_row(values, kind):
+    if kind == "list":
+        return list(values)
+    if kind == "tensor":
+        return torch.tensor(values)
+    return values[0]
+
+
+@pytest.mark.parametrize("kind", ["scalar", "list", "tensor"])
+@pytest.mark.parametrize("temperature, min_p, top_p, repetition_penalty", [
+    (0.8, 0.05, 1.0, 1.2),
+    (1.0, 0.0, 0.95, 2.0),
+    (0.7, 0.02, 0.8, 1.0),
+])
+def test_inference_order(kind, temperature, min_p, top_p, repetition_penalty):
+    logits, history = make_logits(0), make_history(1)
+    actual = process_logits(
+        logits,
+        counts(history),
+        temperature=per_row([temperature] * 3, kind),
+        min_p=per_row([min_p] * 3, kind),
+        top_p=per_row([top_p] * 3, kind),
+        repetition_penalty=per_row([repetition_penalty] * 3, kind),
+    )
+    assert_same_logits(actual, hf_inference_chain(history, logits, temperature, min_p, top_p, repetition_penalty))
+
+
+@pytest.mark.parametrize("kind", ["scalar", "list", "tensor"])
+@pytest.mark.parametrize("temperature, top_k, top_p, repetition_penalty", [
+    (0.8, 1000, 0.95, 1.2),  # the defaults of `inference_turbo`
+    (0.8, 0, 0.95, 1.2),
+    (1.0, 50, 1.0, 1.5),
+    (0.6, 0, 1.0, 1.2),
+])
+def test_turbo_order(kind, temperature, top_k, top_p, repetition_penalty):
+    logits, history = make_logits(2), make_history(3)
+    actual = process_logits(
+        logits,
+        counts(history),
+        temperature=per_row([temperature] * 3, kind),
+        top_k=top_k,
+        top_p=per_row([top_p] * 3, kind),
+        repetition_penalty=per_row([repetition_penalty] * 3, kind),
+        penalty_last=True,
+    )
+    assert_same_logits(actual, hf_turbo_chain(history, logits, temperature, top_k, top_p, repetition_penalty))
+
+
+@pytest.mark.parametrize("kind", ["list", "tensor"])
+def test_prefilter_is_per_row(kind):
+    "A row with top_p = 1 samples from the full vocab, whatever the other rows and the type of `top_p`."
+    logits = make_logits(4, scale=0.1)  # flat: most of the mass is outside the prefilter
+    actual = process_logits(logits, top_p=per_row([1.0, 0.9, 1.0], kind))
+    assert torch.equal(actual[0], logits[0])
+    assert torch.equal(actual[2], logits[2])
+    assert torch.equal(actual, process_logits(logits, top_p=[1.0, 0.9, 1.0]))
+    # a row whose nucleus does not fit in the prefilter keeps the tokens outside it rather than being truncated
+    assert (~torch.isinf(actual[1])).sum() > TOP_K_PREFILTER
+    assert torch.equal(process_logits(logits[:1], top_p=per_row([1.0], kind)), logits[:1])
+
+
+def test_sampling_matches_hf():
+    "Same generator, same samples as softmax + multinomial over the HF-processed logits."
+    logits, history = make_logits(5), make_history(6)
+    hf_logits = hf_turbo_chain(history, logits, 0.8, 1000, 0.95, 1.2)
+    expected = torch.multinomial(torch.softmax(hf_logits, dim=-1), 1, generator=torch.Generator().manual_seed(7))
+    actual = sample_next_tokens(
+        logits, counts(history), temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
+        penalty_last=True, generators=torch.Generator().manual_seed(7),
+    )
+    assert torch.equal(actual, expected)
+
+
+def test_sampler_matches_turbo_loop():
+    """
+    The first two steps of the turbo decode loop sample what the original HF chain did: the first one penalizes the
+    start token it is prompted with, the second one only the token generated so far.
+    """
+    start = torch.full((1, 1), 6561)
+    sampler = T3Sampler(1, V, "cpu", temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
+                        penalty_last=True, generator=torch.Generator().manual_seed(3))
+    g = torch.Generator().manual_seed(3)
+    history = start
+    for step in range(2):
+        logits = make_logits(10 + step, batch_size=1)
+        logits[0, 6561] = logits.max() + 1.0  # make the penalty of the start token matter
+        hf_logits = hf_turbo_chain(history, logits, 0.8, 1000, 0.95, 1.2)
+        assert_same_logits(
+            process_logits(logits, counts(history), temperature=0.8, top_k=1000, top_p=0.95,
+                           repetition_penalty=1.2, penalty_last=True),
+            hf_logits,
+        )
+        expected = torch.multinomial(torch.softmax(hf_logits, dim=-1), 1, generator=g)
+        actual = sampler(logits, prompt_tokens=start if step == 0 else None)
+        assert torch.equal(actual, expected)
+        history = expected if step == 0 else torch.cat([history, expected], dim=1)
+        # the start token is never counted as generated
+        assert torch.equal(sampler.token_counts, counts(history))
+
+
+def test_all_filtered_keeps_most_likely():
+    logits = make_logits(9)
+    logits[:, 1:] = -math.inf
+    processed = process_logits(logits, temperature=0.5, top_k=10, top_p=0.1, min_p=0.5)
+    assert torch.equal(torch.isinf(processed), torch.isinf(logits))
@@ -0,0 +1,40 @@
+"""
+`SineGen` integrates the phase at frame rate: without noise, its sine waves must be those of the original
+formula, a cumsum of the f0 upsampled to the sample rate.
+"""
+import numpy as np
+import pytest
+import torch
+
+from chatterbox.models.s3gen.hifigan import SineGen
+
+
+SR, U, HARMONICS, SINE_AMP, NOISE_STD, VOICED = 24000, 480, 8, 0.1, 0.003, 10
+
+
+def baseline(f0, phase_vec):
+    "The original sample-rate SineGen, without its noise, in float64."
+    f0 = f0.double().repeat_interleave(U, dim=-1)  # nearest upsampling to the sample rate
+    F_mat = torch.cat([f0 * (i + 1) / SR for i in range(HARMONICS + 1)], dim=1)
+    theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
+    sine_waves = SINE_AMP * torch.sin(theta_mat + phase_vec.double())
+    uv = (f0 > VOICED).double()
+    noise_amp = uv * NOISE_STD + (1 - uv) * SINE_AMP / 3
+    return sine_waves * uv, uv, noise_amp
+
+
+@pytest.mark.parametrize("n_frames", [1, 7, 200])
+def test_matches_sample_rate_formula(n_frames):
+    g = torch.Generator().manual_seed(n_frames)
+    f0 = 80 + 300 * torch.rand(2, 1, n_frames, generator=g)
+    f0[:, :, n_frames // 3:n_frames // 2] = 0  # unvoiced
+    phase_vec = (2 * torch.rand(2, HARMONICS + 1, 1, generator=g) - 1) * np.pi
+    phase_vec[:, 0] = 0
+
+    sine_gen = SineGen(SR, HARMONICS, SINE_AMP, NOISE_STD, VOICED, upsample_scale=U)
+    sine_waves, uv, noise_amp = sine_gen(f0, state={"phase_vec": phase_vec.unsqueeze(-1)}, add_noise=False)
+
+    expected_sines, expected_uv, expected_noise_amp = baseline(f0, phase_vec)
+    assert torch.equal(uv.double(), expected_uv)
+    torch.testing.assert_close(noise_amp.double(), expected_noise_amp, rtol=1e-6, atol=0)
+    torch.testing.assert_close(sine_waves.double(), expected_sines, rtol=0, atol=1e-5)
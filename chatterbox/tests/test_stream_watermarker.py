@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from chatterbox.streaming import StreamWatermarker
+
+
+SR = 24000
+
+
+class IdentityWatermarker:
+    def __init__(self):
+        self.calls = []
+
+    def apply_watermark(self, wav, sample_rate):
+        self.calls.append(len(wav))
+        return wav
+
+
+class GainWatermarker:
+    "A stand-in whose output depends on the whole pass, like a neural watermarker."
+
+    def apply_watermark(self, wav, sample_rate):
+        return wav * (1.0 + 0.3 * np.tanh(len(wav) / sample_rate))
+
+
+def stream(watermarker, wav, chunk_sizes, **kwargs):
+    stream_watermarker = StreamWatermarker(watermarker, SR, **kwargs)
+    out, start = [], 0
+    for n in chunk_sizes:
+        out.append(stream_watermarker.push(wav[start:start + n]))
+        start += n
+    out.append(stream_watermarker.flush())
+    return out
+
+
+@pytest.mark.parametrize("chunk_sizes", [[SR] * 4, [10, 300, SR // 2, 7, 2 * SR, 1]])
+def test_stream_keeps_every_sample_once(chunk_sizes):
+    wav = np.random.default_rng(0).standard_normal(sum(chunk_sizes)).astype(np.float32)
+    out = stream(IdentityWatermarker(), wav, chunk_sizes)
+    np.testing.assert_allclose(np.concatenate(out), wav, atol=1e-6)
+
+
+def test_chunks_are_watermarked_with_left_context():
+    watermarker = IdentityWatermarker()
+    chunk_sizes = [SR // 2] * 6
+    stream(watermarker, np.zeros(sum(chunk_sizes), dtype=np.float32), chunk_sizes, context=1.0, overlap=0.02)
+    # every pass past the first second covers the chunk, the held-back samples and a second of context
+    n_overlap = int(0.02 * SR)
+    assert watermarker.calls[0] == SR // 2
+    assert all(n == SR + n_overlap + SR // 2 for n in watermarker.calls[3:])
+
+
+def test_held_back_samples_delay_output_by_overlap():
+    chunk_sizes = [SR] * 3
+    out = stream(IdentityWatermarker(), np.ones(sum(chunk_sizes), dtype=np.float32), chunk_sizes, overlap=0.05)
+    n_overlap = int(0.05 * SR)
+    assert [len(o) for o in out] == [SR - n_overlap, SR, SR, n_overlap]
+
+
+def test_no_seam_between_passes():
+    chunk_sizes = [int(0.73 * SR)] * 5
+    t = np.arange(sum(chunk_sizes)) / SR
+    wav = (0.5 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    out = np.concatenate(stream(GainWatermarker(), wav, chunk_sizes))
+    # passes of different lengths get different gains (up to 1.28x): without the cross-fade, the gain steps
+    # where two passes meet would make the largest sample-to-sample step about 1.8x that of the sine
+    max_step = np.abs(np.diff(wav)).max()
+    assert np.abs(np.diff(out)).max() <= 1.35 * max_step
@@ -0,0 +1,129 @@
+"""
+`T3BatchScheduler` must decode every request exactly as `T3.inference` does on its own, whatever else shares the
+batch: checked with greedy decoding on a small random Llama, with requests arriving mid-decode, finishing at
+different steps (left-padded KV merge, per-row position ids, `_retire` trimming) and dropping their CFG row.
+"""
+import threading
+
+import pytest
+import torch
+
+from chatterbox.models.t3 import llama_configs
+from chatterbox.models.t3.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.inference.batch_scheduler import T3BatchScheduler
+from chatterbox.models.t3.inference.cfg_schedule import CFGSchedule
+
+
+# greedy: min_p=1 keeps only the most likely token
+GREEDY = dict(temperature=1.0, top_p=1.0, min_p=1.0, repetition_penalty=1.0)
+
+
+@pytest.fixture
+def t3(monkeypatch):
+    monkeypatch.setitem(llama_configs.LLAMA_CONFIGS, "Llama_test", dict(
+        llama_configs.LLAMA_CONFIGS["Llama_520M"],
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        head_dim=16,
+        attn_implementation="eager",
+    ))
+    hp = T3Config.english_only()
+    hp.llama_config_name = "Llama_test"
+    hp.use_perceiver_resampler = False
+    torch.manual_seed(0)
+    # float64 so that batched and unbatched logits cannot flip an argmax
+    return T3(hp).double().eval()
+
+
+def make_request(hp, seed, n_text):
+    g = torch.Generator().manual_seed(seed)
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size, generator=g, dtype=torch.float64),
+        emotion_adv=0.5 * torch.ones(1, 1, 1, dtype=torch.float64),
+    )
+    text = torch.randint(1, hp.start_text_token, (n_text,), generator=g)
+    text = torch.cat([torch.tensor([hp.start_text_token]), text, torch.tensor([hp.stop_text_token])])
+    return dict(t3_cond=t3_cond, text_tokens=torch.stack([text, text]))
+
+
+def decode_manually(scheduler, arrivals):
+    """
+    Drives the scheduler's decode loop on this thread: `arrivals` maps a step index to the requests submitted
+    before that step, so requests deterministically join a batch that is already decoding.
+    """
+    futures, step = [], 0
+    while step <= max(arrivals) or scheduler._active or not scheduler._queue.empty():
+        for request in arrivals.get(step, []):
+            futures.append(scheduler.submit(**request))
+        with torch.inference_mode():
+            scheduler._admit(block=False)
+            if scheduler._active:
+                scheduler._step()
+        step += 1
+    return [f.result() for f in futures]
+
+
+def test_batched_decoding_matches_inference(t3):
+    hp = t3.hp
+    requests = [
+        dict(make_request(hp, 1, n_text=5), max_new_tokens=12, cfg_weight=0.5),
+        dict(make_request(hp, 2, n_text=11), max_new_tokens=7, cfg_weight=0.5, cfg_schedule=CFGSchedule(max_tokens=3)),
+        dict(make_request(hp, 3, n_text=8), max_new_tokens=9, cfg_weight=0.0),
+    ]
+    expected = [t3.inference(**request, **GREEDY) for request in requests]
+
+    scheduler = T3BatchScheduler(t3, max_batch_size=2)
+    # run the decode loop by hand
+    scheduler.close()
+    scheduler._closed = False
+
+    # the second request joins after 2 steps, the third waits for a free slot
+    requests = [dict(request, **GREEDY) for request in requests]
+    results = decode_manually(scheduler, {0: requests[:1], 2: requests[1:]})
+
+    assert scheduler._cache is None and scheduler._mask is None
+    for result, reference in zip(results, expected):
+        assert result.shape == reference.shape
+        assert torch.equal(result.cpu(), reference.cpu())
+
+
+def test_scheduler_thread_matches_inference(t3):
+    hp = t3.hp
+    requests = [
+        dict(make_request(hp, seed, n_text=4 + 3 * seed), max_new_tokens=6 + 2 * seed, cfg_weight=0.5, **GREEDY)
+        for seed in range(3)
+    ]
+    expected = [t3.inference(**request) for request in requests]
+
+    scheduler = T3BatchScheduler(t3, max_batch_size=3)
+    try:
+        results = [f.result(timeout=60) for f in [scheduler.submit(**request) for request in requests]]
+    finally:
+        scheduler.close()
+
+    for result, reference in zip(results, expected):
+        assert torch.equal(result.cpu(), reference.cpu())
+
+
+def test_submit_only_enqueues(t3, monkeypatch):
+    "The conditioning prefix is looked up (and prefilled) on the decode thread, not on the submitting one."
+    threads = []
+    conditioning_prefix = t3.conditioning_prefix
+
+    def spy(t3_cond):
+        threads.append(threading.current_thread().name)
+        return conditioning_prefix(t3_cond)
+
+    monkeypatch.setattr(t3, "conditioning_prefix", spy)
+    scheduler = T3BatchScheduler(t3)
+    try:
+        request = dict(make_request(t3.hp, 4, n_text=6), max_new_tokens=4, cfg_weight=0.5, **GREEDY)
+        scheduler.submit(**request).result(timeout=60)
+    finally:
+        scheduler.close()
+    assert threads == ["t3-batch-scheduler"]
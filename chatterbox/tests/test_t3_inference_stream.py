@@ -0,0 +1,96 @@
+"""
+`T3.inference_stream` on a small random multilingual Llama: the alignment analyzer keeps receiving the attentions
+of every decode step when a server resumes the generator on another thread, and a stream closed halfway hands the
+KV cache and analyzer of its `T3InferenceState` back to the next call.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from chatterbox.models.t3 import llama_configs
+from chatterbox.models.t3.t3 import T3
+from chatterbox.models.t3.modules.t3_config import T3Config
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from chatterbox.models.t3.inference import inference_state
+from chatterbox.models.t3.inference.inference_state import T3InferenceState
+
+
+@pytest.fixture
+def t3(monkeypatch):
+    monkeypatch.setitem(llama_configs.LLAMA_CONFIGS, "Llama_test", dict(
+        llama_configs.LLAMA_CONFIGS["Llama_520M"],
+        hidden_size=64,
+        intermediate_size=128,
+        # deep and wide enough for `LLAMA_ALIGNED_HEADS`
+        num_hidden_layers=14,
+        num_attention_heads=16,
+        num_key_value_heads=16,
+        head_dim=4,
+    ))
+    hp = T3Config.multilingual()
+    hp.llama_config_name = "Llama_test"
+    hp.use_perceiver_resampler = False
+    torch.manual_seed(0)
+    return T3(hp).eval()
+
+
+def make_request(hp, seed=0, n_text=16):
+    g = torch.Generator().manual_seed(seed)
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size, generator=g),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    text = torch.randint(1, hp.start_text_token, (n_text,), generator=g)
+    text = torch.cat([torch.tensor([hp.start_text_token]), text, torch.tensor([hp.stop_text_token])])
+    return dict(t3_cond=t3_cond, text_tokens=torch.stack([text, text]))
+
+
+def test_stream_resumed_on_another_thread_feeds_the_analyzer(t3, monkeypatch):
+    steps = []  # (thread, shape of the first aligned head) seen by every `step`
+    step = AlignmentStreamAnalyzer.step
+
+    def spy(self, logits, next_token=None):
+        steps.append((threading.get_ident(), tuple(self.last_aligned_attns[0].shape)))
+        return step(self, logits, next_token=next_token)
+
+    monkeypatch.setattr(AlignmentStreamAnalyzer, "step", spy)
+
+    state = T3InferenceState.create(seed=0)
+    stream = t3.inference_stream(**make_request(t3.hp), max_new_tokens=6, chunk_size=1, state=state)
+    next(stream)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(list, stream).result()
+
+    # the prefill attentions on this thread, then one new query per decode step on the pool's thread
+    (prefill_thread, (_, n_keys)), *decode = steps
+    assert prefill_thread == threading.get_ident()
+    assert decode
+    for k, (thread, shape) in enumerate(decode, start=1):
+        assert thread != threading.get_ident()
+        assert shape == (1, n_keys + k)
+
+
+def test_closed_stream_releases_the_state(t3, monkeypatch):
+    state = T3InferenceState.create(seed=0)
+    request = make_request(t3.hp)
+    stream = t3.inference_stream(**request, max_new_tokens=6, chunk_size=1, state=state)
+    next(stream)
+    kv_cache, analyzer = state.kv_cache, state.analyzer
+    assert kv_cache is not None and analyzer is not None
+    assert state.kv_cache_lock.locked() and state.analyzer_lock.locked()
+
+    # the client goes away halfway (`generate_stream` closes its T3 stream when it is closed itself)
+    stream.close()
+    assert not state.kv_cache_lock.locked() and not state.analyzer_lock.locked()
+    assert not analyzer.hook_handles
+
+    def no_new_cache(*args, **kwargs):
+        raise AssertionError("allocated a new KV cache")
+
+    monkeypatch.setattr(inference_state, "new_static_cache", no_new_cache)
+    t3.inference(**request, max_new_tokens=6, state=state)
+    assert state.kv_cache is kv_cache
+    assert state.analyzer is analyzer
@@ -0,0 +1,54 @@
+"""`melspectrogram_torch` (batched) must match the numpy `melspectrogram`, clip by clip."""
+import numpy as np
+import pytest
+import torch
+
+from chatterbox.models.voice_encoder.config import VoiceEncConfig
+from chatterbox.models.voice_encoder.melspec import melspectrogram, melspectrogram_torch
+
+
+class DbMelConfig(VoiceEncConfig):
+    "Exercises the branches the default config skips."
+    preemphasis = 0.97
+    mel_power = 1.0
+    mel_type = "db"
+    normalized_mels = True
+
+
+def make_wavs(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    wavs = []
+    for n in lengths:
+        t = np.arange(n) / 16000
+        wav = 0.4 * np.sin(2 * np.pi * rng.uniform(80, 400) * t) + 0.05 * rng.standard_normal(n)
+        wavs.append(wav.astype(np.float32))
+    return wavs
+
+
+def assert_mels_match(wavs, hp, pad):
+    mels = melspectrogram_torch([torch.from_numpy(wav) for wav in wavs], hp, pad=pad)
+    assert len(mels) == len(wavs)
+    for wav, mel in zip(wavs, mels):
+        expected = melspectrogram(wav, hp, pad=pad)
+        assert mel.shape == expected.shape
+        np.testing.assert_allclose(mel.numpy(), expected, rtol=1e-3, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize("hp", [VoiceEncConfig(), DbMelConfig()], ids=["amp", "db"])
+@pytest.mark.parametrize("pad", [True, False])
+def test_single_clip(hp, pad):
+    assert_mels_match(make_wavs([16000]), hp, pad)
+
+
+@pytest.mark.parametrize("hp", [VoiceEncConfig(), DbMelConfig()], ids=["amp", "db"])
+@pytest.mark.parametrize("pad", [True, False])
+def test_ragged_batch(hp, pad):
+    # the shortest clip yields a single frame without padding
+    assert_mels_match(make_wavs([16000, 23456, 401, 8000, 16000]), hp, pad)
+
+
+def test_batch_equals_one_by_one():
+    wavs = [torch.from_numpy(wav) for wav in make_wavs([12000, 30000, 5000])]
+    batched = melspectrogram_torch(wavs, VoiceEncConfig())
+    for wav, mel in zip(wavs, batched):
+        torch.testing.assert_close(mel, melspectrogram_torch([wav], VoiceEncConfig())[0])
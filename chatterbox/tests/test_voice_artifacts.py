@@ -0,0 +1,203 @@
+"""
+Voice conditionals shipped next to the audio (here `VOICE_ARTIFACTS_DIR`, the local stand-in for S3): an upload
+ships them, another server loads them instead of embedding the clip, and a reload only drops the conditionals of
+voices whose audio changed.
+"""
+from pathlib import Path
+
+import pytest
+import torch
+
+from chatterbox.mtl_tts import Conditionals
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.voice_store import CONDS_ARTIFACT_VERSION, VoiceConditioningStore, content_hash
+
+
+@pytest.fixture(scope="module")
+def srv(tmp_path_factory):
+    root = tmp_path_factory.mktemp("server")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("S3_ENABLED", "false")
+        mp.setenv("VOICE_CONDS_DIR", str(root / "voice_conds"))
+        mp.setenv("VOICE_ARTIFACTS_DIR", str(root / "artifacts"))
+        mp.setenv("REFERENCE_ASSET_DIR", str(root / "reference_assets"))
+        mp.syspath_prepend(str(Path(__file__).resolve().parent.parent))
+        import api_server
+    return api_server
+
+
+@pytest.fixture
+def config():
+    "The config file, in memory."
+    return {"voices": {}, "characters": {}}
+
+
+@pytest.fixture
+def server(srv, config, tmp_path, monkeypatch):
+    "A fresh server state: no voices and an empty conditionals store."
+    monkeypatch.setattr(srv, "VOICE_LIBRARY", {})
+    monkeypatch.setattr(srv, "VOICE_CONTENT_HASHES", {})
+    monkeypatch.setattr(srv, "VOICE_ARTIFACTS_DIR", str(tmp_path / "artifacts"))
+    monkeypatch.setattr(srv, "VOICE_CONDS_STORE", VoiceConditioningStore(cache_dir=tmp_path / "conds_a"))
+    monkeypatch.setattr(srv, "MODEL_POOL", None)
+    monkeypatch.setattr(srv, "load_config_file", lambda: (config, None))
+    monkeypatch.setattr(srv, "save_config_file", lambda new_config, config_path=None: config.update(new_config))
+    return srv
+
+
+def fake_conds(seed):
+    g = torch.Generator().manual_seed(seed)
+    t3 = T3Cond(
+        speaker_emb=torch.randn(1, 256, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 150), generator=g),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    gen = dict(
+        prompt_token=torch.randint(0, 6561, (1, 250), generator=g),
+        prompt_feat=torch.randn(1, 500, 80, generator=g),
+        embedding=torch.randn(1, 192, generator=g),
+    )
+    return Conditionals(t3, gen)
+
+
+def assert_same_conds(a, b):
+    assert torch.equal(a.t3.speaker_emb, b.t3.speaker_emb)
+    assert torch.equal(a.t3.cond_prompt_speech_tokens, b.t3.cond_prompt_speech_tokens)
+    assert a.gen.keys() == b.gen.keys()
+    for key, value in a.gen.items():
+        assert torch.equal(value, b.gen[key]), key
+
+
+class NoModel:
+    "Stands for a pooled model on a server that must not embed any clip."
+
+    def get_conditionals(self, *args, **kwargs):
+        raise AssertionError("the reference clip was embedded")
+
+
+class FakePool:
+    def __init__(self, conds):
+        self.conds = conds
+        self.borrowed = 0
+
+    def get_model(self, timeout=None):
+        self.borrowed += 1
+        return self
+
+    def return_model(self, model):
+        self.borrowed -= 1
+
+    def get_conditionals(self, wav_fpath, exaggeration=0.5):
+        return self.conds
+
+
+def add_voice(server, config, voice_id, audio_path, conds):
+    chash = content_hash(audio_path.read_bytes())
+    voice = {"name": voice_id, "audio_url": str(audio_path), "content_hash": chash}
+    if conds is not None:
+        voice["conds_url"] = server.ship_voice_conditionals(voice_id, chash, conds)
+        voice["conds_version"] = CONDS_ARTIFACT_VERSION
+    config["voices"][voice_id] = dict(voice)
+    return chash
+
+
+def restart(server, monkeypatch, tmp_path, name):
+    "Another server: same config and artifacts, but nothing cached."
+    monkeypatch.setattr(server, "VOICE_LIBRARY", {})
+    monkeypatch.setattr(server, "VOICE_CONTENT_HASHES", {})
+    monkeypatch.setattr(server, "VOICE_CONDS_STORE", VoiceConditioningStore(cache_dir=tmp_path / name))
+    server.reload_voices_and_characters()
+
+
+def test_ship_does_not_need_a_persisted_store(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "VOICE_CONDS_STORE", VoiceConditioningStore(cache_dir=None))
+    conds = fake_conds(0)
+    conds_url = server.ship_voice_conditionals("alice", "ab" * 32, conds)
+
+    assert Path(conds_url).parent == tmp_path / "artifacts"
+    assert Path(conds_url).name == VoiceConditioningStore.artifact_name("alice", "ab" * 32)
+    assert_same_conds(Conditionals.load(conds_url), conds)
+    assert [p.name for p in (tmp_path / "artifacts").iterdir()] == [Path(conds_url).name]
+
+
+def test_ship_fetch_reload(server, config, tmp_path, monkeypatch):
+    audio = tmp_path / "alice.wav"
+    audio.write_bytes(b"alice, take 1")
+    conds_v1 = fake_conds(1)
+    chash_v1 = add_voice(server, config, "alice", audio, conds_v1)
+
+    # a new server loads the shipped conditionals at reload, and serves them without embedding the clip
+    restart(server, monkeypatch, tmp_path, "conds_b")
+    assert_same_conds(server.VOICE_CONDS_STORE.get("alice", chash_v1), conds_v1)
+    assert_same_conds(server.get_voice_conditionals(NoModel(), "alice", 0.5), conds_v1)
+    assert server.VOICE_CONDS_STORE.artifact_path("alice", chash_v1) is not None
+
+    # reloading an unchanged config keeps them
+    server.reload_voices_and_characters()
+    assert server.VOICE_CONDS_STORE.artifact_path("alice", chash_v1) is not None
+
+    # the clip is replaced in place and its new conditionals shipped: the stale ones are dropped, the new loaded
+    audio.write_bytes(b"alice, take 2")
+    conds_v2 = fake_conds(2)
+    chash_v2 = add_voice(server, config, "alice", audio, conds_v2)
+    server.reload_voices_and_characters()
+    assert server.VOICE_CONDS_STORE.artifact_path("alice", chash_v1) is None
+    assert server.VOICE_CONDS_STORE.get("alice", chash_v1) is None
+    assert server.VOICE_CONDS_STORE.artifact_path("alice", chash_v2) is not None
+    assert_same_conds(server.get_voice_conditionals(NoModel(), "alice", 0.5), conds_v2)
+
+
+def test_request_path_does_not_hash_the_clip(server, config, tmp_path, monkeypatch):
+    audio = tmp_path / "dave.wav"
+    audio.write_bytes(b"dave")
+    conds = fake_conds(5)
+    chash = add_voice(server, config, "dave", audio, conds)
+    restart(server, monkeypatch, tmp_path, "conds_b")
+
+    def no_hash(*args, **kwargs):
+        raise AssertionError("the clip was hashed on the request path")
+
+    monkeypatch.setattr(server, "content_hash", no_hash)
+    assert_same_conds(server.get_voice_conditionals(NoModel(), "dave", 0.5), conds)
+
+    # a voice no reload has seen yet uses the hash recorded at upload
+    server.VOICE_CONTENT_HASHES.clear()
+    assert_same_conds(server.get_voice_conditionals(NoModel(), "dave", 0.5), conds)
+    assert server.VOICE_CONTENT_HASHES["dave"] == chash
+
+
+def test_stale_artifact_is_not_loaded(server, config, tmp_path, monkeypatch):
+    audio = tmp_path / "bob.wav"
+    audio.write_bytes(b"bob, take 1")
+    add_voice(server, config, "bob", audio, fake_conds(3))
+    # the clip changes but the config still points at the artifact of the old one
+    audio.write_bytes(b"bob, take 2")
+
+    restart(server, monkeypatch, tmp_path, "conds_b")
+    assert len(server.VOICE_CONDS_STORE) == 0
+    with pytest.raises(AssertionError, match="embedded"):
+        server.get_voice_conditionals(NoModel(), "bob", 0.5)
+
+
+def test_precompute_skipped_without_pool(server):
+    assert server.precompute_voice_conditionals(b"carol", "carol.wav", "carol", content_hash(b"carol")) is None
+
+
+def test_precompute_in_background(server, config, tmp_path, monkeypatch):
+    conds = fake_conds(4)
+    pool = FakePool(conds)
+    monkeypatch.setattr(server, "MODEL_POOL", pool)
+    audio = tmp_path / "carol.wav"
+    audio.write_bytes(b"carol")
+    chash = add_voice(server, config, "carol", audio, None)
+    server.VOICE_LIBRARY["carol"] = dict(config["voices"]["carol"])
+
+    thread = server.precompute_voice_conditionals(audio.read_bytes(), "carol.wav", "carol", chash)
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert pool.borrowed == 0
+
+    for voice in (server.VOICE_LIBRARY["carol"], config["voices"]["carol"]):
+        assert voice["conds_version"] == CONDS_ARTIFACT_VERSION
+        assert_same_conds(Conditionals.load(voice["conds_url"]), conds)
+    assert_same_conds(server.VOICE_CONDS_STORE.get("carol", chash), conds)